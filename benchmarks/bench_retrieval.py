@@ -0,0 +1,141 @@
+"""
+早期消息检索基准测试
+生成指定条数的合成中文对话消息，测量BM25索引的全量构建、增量添加和每轮检索的耗时
+
+用法：
+    python -m benchmarks.bench_retrieval --messages 100000 --queries 500
+    python -m benchmarks.bench_retrieval --database   # 经由临时SQLite数据库，包含增量读取新消息的耗时
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.retrieval import BM25Index, MessageRetriever  # noqa: E402
+
+# 合成语料：由常用汉字随机组成词表，消息中的词按Zipf分布抽取
+_CHARS = ('的一是不了人我在有他这中大来上国个到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么'
+          '心多天而能好都然没日于起还发成事只作当想看文无开手十用主行方又如前所本见经头面公同三已老从动两长知民样现分将外'
+          '但身些与高意进把法此实回二理美点月明其种声全工己话儿者向情部正名定女问力机给等几很业最间新什打便位因重被走电四'
+          '第门相次东政海口使教西再平真听世气信北少关并内加化由却代军产入先山五太水万市眼体别处总才场师书比住员九笑性通目'
+          '华报立马命张活难神数件安表原车白应路期叫死常提感金何更反合放做系计或司利受光王果亲界及今京务制解各任至清物台象'
+          '记边共风战干接它许八特觉望直服毛林题建南度统色字请交爱让认算论百吃义科怎元社术结六功指思非流每青管夫连远资队跟')
+_VOCAB_SIZE = 20000
+
+
+def make_vocabulary(rng: random.Random) -> tuple:
+    """生成词表和Zipf分布的累计权重"""
+    words = set()
+    while len(words) < _VOCAB_SIZE:
+        words.add(''.join(rng.choice(_CHARS) for _ in range(rng.choice((1, 2, 2, 2, 3)))))
+    words = sorted(words)
+    rng.shuffle(words)
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, len(words) + 1):
+        total += 1.0 / rank
+        cum_weights.append(total)
+    return words, cum_weights
+
+
+def make_message(rng: random.Random, vocabulary: tuple) -> str:
+    """生成一条合成消息"""
+    words, cum_weights = vocabulary
+    return ''.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(4, 30)))
+
+
+def percentile(values: List[float], q: float) -> float:
+    """按最近秩法计算分位数"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def report(name: str, samples_ms: List[float]):
+    """打印一组耗时的分位数"""
+    print(f"{name:<24} p50={percentile(samples_ms, 0.5):8.3f}ms  p95={percentile(samples_ms, 0.95):8.3f}ms"
+          f"  p99={percentile(samples_ms, 0.99):8.3f}ms  mean={statistics.mean(samples_ms):8.3f}ms")
+
+
+def bench_index(messages: List[str], queries: List[str], top_k: int):
+    """直接测量BM25Index"""
+    index = BM25Index()
+    start = time.perf_counter()
+    for doc_id, text in enumerate(messages, start=1):
+        index.add(doc_id, text, text)
+    build_seconds = time.perf_counter() - start
+    print(f"构建索引: {len(messages)}条消息 {build_seconds:.2f}s"
+          f"（每条{build_seconds / len(messages) * 1e6:.1f}us），{len(index.postings)}个词")
+
+    # 每轮对话新增两条消息（用户输入和回复）
+    add_samples = []
+    next_id = len(messages) + 1
+    for query in queries:
+        start = time.perf_counter()
+        index.add(next_id, query, query)
+        add_samples.append((time.perf_counter() - start) * 1000)
+        next_id += 1
+    report('增量添加（每条）', add_samples)
+
+    search_samples = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, top_k)
+        search_samples.append((time.perf_counter() - start) * 1000)
+    report('检索（每轮）', search_samples)
+
+
+def bench_database(messages: List[str], queries: List[str], top_k: int):
+    """经由临时数据库测量MessageRetriever，包含从messages表增量读取新消息"""
+    from src.database import Database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database = Database(os.path.join(tmpdir, 'bench.db'), durability='sync')
+        session_id = database.create_session()
+        database._write(
+            'INSERT INTO messages (session_id, timestamp, role, content) VALUES (?, CURRENT_TIMESTAMP, ?, ?)',
+            [(session_id, '用户' if i % 2 == 0 else '赵敏敏', text) for i, text in enumerate(messages)],
+            many=True
+        )
+        retriever = MessageRetriever(database, top_k=top_k)
+
+        start = time.perf_counter()
+        retriever.retrieve(session_id, queries[0])
+        print(f"首次检索（读取并索引{len(messages)}条消息）: {time.perf_counter() - start:.2f}s")
+
+        turn_samples = []
+        for query in queries:
+            database.add_message(session_id, '用户', query)
+            start = time.perf_counter()
+            retriever.retrieve(session_id, query, {query})
+            turn_samples.append((time.perf_counter() - start) * 1000)
+        report('每轮（读取新消息+检索）', turn_samples)
+        database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='早期消息检索基准测试')
+    parser.add_argument('--messages', type=int, default=100000, help='语料消息数')
+    parser.add_argument('--queries', type=int, default=500, help='检索次数')
+    parser.add_argument('--top-k', type=int, default=3, help='每次检索返回的消息数')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    parser.add_argument('--database', action='store_true', help='经由临时SQLite数据库测量')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng)
+    messages = [make_message(rng, vocabulary) for _ in range(args.messages)]
+    queries = [make_message(rng, vocabulary) for _ in range(args.queries)]
+    if args.database:
+        bench_database(messages, queries, args.top_k)
+    else:
+        bench_index(messages, queries, args.top_k)
+
+
+if __name__ == '__main__':
+    main()
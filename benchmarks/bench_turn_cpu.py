@@ -0,0 +1,137 @@
+"""
+每轮对话的本地CPU开销基准测试
+对比三项开销：
+1. 新建会话时读取配置：每次重新解析YAML，与进程内共享、只检查文件修改时间的Config
+2. 估算对话历史的token数：逐字匹配中文，与按连续片段计数
+3. 每轮构建调度Agent、sys1、sys2三个prompt：各Agent各自格式化对话历史，与三者共用一个FormattedHistory
+
+用法：
+    python -m benchmarks.bench_turn_cpu --turns 2000 --history 20
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.config import Config  # noqa: E402
+from src.context import ContextBuilder, FormattedHistory, estimate_tokens, format_message  # noqa: E402
+from src.prompt_store import RenderedPrompt, parse_template, render_template  # noqa: E402
+
+_CHARS = '的一是不了人我在有他这中大来上个到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么心多天而能好'
+
+# 逐字匹配中文的token估算（按连续片段计数之前的实现），作为对照
+_CJK_CHAR = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_PIECE = re.compile(r'[A-Za-z0-9]+|\S')
+
+
+def per_char_estimate_tokens(text: str) -> int:
+    """逐字匹配中文的token估算，结果与estimate_tokens相同"""
+    tokens = len(_CJK_CHAR.findall(text))
+    for piece in _PIECE.findall(_CJK_CHAR.sub(' ', text)):
+        tokens += (len(piece) + 3) // 4 if piece[0].isascii() and piece[0].isalnum() else 1
+    return tokens
+
+
+def make_history(rng: random.Random, length: int) -> List[Dict[str, Any]]:
+    """生成对话历史：会话摘要 + 用户和赵敏敏交替的消息，部分回复带sys2的思考过程"""
+    history = [{'role': '早前对话摘要', 'content': ''.join(rng.choices(_CHARS, k=300)), 'pinned': True}]
+    for index in range(length):
+        message = {'role': '用户' if index % 2 == 0 else '赵敏敏',
+                   'content': ''.join(rng.choices(_CHARS, k=rng.randint(20, 200)))}
+        if index % 2 == 1 and rng.random() < 0.3:
+            message['thinking'] = ''.join(rng.choices(_CHARS, k=rng.randint(300, 1200)))
+        history.append(message)
+    return history
+
+
+def build_prompts(agents: List[Dict[str, Any]], history: List[Dict[str, Any]], user_input: str):
+    """与BaseAgent._build_prompt相同的方式构建各Agent的prompt"""
+    for agent in agents:
+        lines, trimmed_tokens = agent['builder'].build(history)
+        segments = render_template(agent['parsed'], {
+            'dialogue_history': [line + "\n" for line in lines[:-1]] + lines[-1:],
+            'user_input': user_input
+        })
+        RenderedPrompt(segments, user_input, trimmed_tokens)
+
+
+def measure(func: Callable[[], None], repeat: int, rounds: int = 5) -> float:
+    """重复执行，返回多轮中最快一轮的每次平均耗时（微秒）"""
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        best = min(best, (time.perf_counter() - start) / repeat * 1e6)
+    return best
+
+
+def measure_turns(func: Callable[[List[Dict[str, Any]], str], None], turns: list, rounds: int = 5) -> float:
+    """依次执行每一轮，返回多轮中最快一轮的每轮平均耗时（微秒）；每轮开始前清空token估算缓存"""
+    best = float('inf')
+    for _ in range(rounds):
+        estimate_tokens.cache_clear()
+        start = time.perf_counter()
+        for history, user_input in turns:
+            func(history, user_input)
+        best = min(best, (time.perf_counter() - start) / len(turns) * 1e6)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='每轮对话的本地CPU开销基准测试')
+    parser.add_argument('--turns', type=int, default=2000, help='模拟的对话轮数')
+    parser.add_argument('--history', type=int, default=20, help='对话窗口中的消息数')
+    parser.add_argument('--sessions', type=int, default=200, help='模拟新建会话（读取配置）的次数')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    args = parser.parse_args()
+
+    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               'config', 'prompt_config.yaml')
+
+    def parse_yaml():
+        with open(config_path, 'r', encoding='utf-8') as f:
+            yaml.safe_load(f)
+
+    parse_us = measure(parse_yaml, args.sessions)
+    shared_us = measure(Config, args.sessions)
+    print(f"新建会话读取配置: 每次解析YAML {parse_us:9.1f}us   共享配置 {shared_us:9.1f}us"
+          f"   节省 {parse_us - shared_us:9.1f}us/会话")
+
+    agents_config = Config().get_agents_config()
+    agents = [{'builder': ContextBuilder(agents_config[name].get('context')),
+               'parsed': parse_template(agents_config[name]['prompt_template'])}
+              for name in ('dispatcher', 'sys1', 'sys2')]
+
+    # 每轮的消息内容都不同，与真实对话一样不会命中上一轮的格式化结果
+    rng = random.Random(args.seed)
+    turns = []
+    for _ in range(args.turns):
+        history = make_history(rng, args.history)
+        turns.append((history, history[-1]['content']))
+    lines = [format_message(msg, True) for history, _ in turns for msg in history]
+
+    def count_tokens(estimate: Callable[[str], int]) -> Callable[[], None]:
+        return lambda: [estimate(line) for line in lines]
+
+    per_char_us = measure(count_tokens(per_char_estimate_tokens), 1, 3) / len(turns)
+    run_us = measure(count_tokens(estimate_tokens.__wrapped__), 1, 3) / len(turns)
+    print(f"估算一轮历史的token: 逐字匹配 {per_char_us:9.1f}us   按片段计数 {run_us:9.1f}us"
+          f"   节省 {per_char_us - run_us:9.1f}us/轮")
+
+    separate_us = measure_turns(lambda history, user_input: build_prompts(agents, list(history), user_input), turns)
+    shared_turn_us = measure_turns(
+        lambda history, user_input: build_prompts(agents, FormattedHistory(history), user_input), turns)
+    print(f"每轮构建3个prompt:  各自格式化 {separate_us:9.1f}us   共用格式化 {shared_turn_us:9.1f}us"
+          f"   节省 {separate_us - shared_turn_us:9.1f}us/轮（{args.history}条消息）")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+"""
+端到端压测
+同时打开N个 /ws/chat 会话，每个会话依次回放一段对话，统计吞吐量、每轮耗时和首个token时间的分位数，
+以及服务端（/metrics中的event_loop_lag_seconds）和压测端自身的事件循环延迟
+
+对话来源：
+- Markdown文件：提取 ">用户：" 开头的行作为一段对话（默认为目标与落地方案.md中的测试用例）
+- JSONL文件：每行为一段对话，可以是字符串列表或带turns字段的对象；
+  其他对象取title（或content、body）字段，所有行合为一段对话（例如requests.jsonl）
+
+用法：
+    python -m benchmarks.mock_model_server --port 8010 &
+    DASHSCOPE_BASE_URL=http://127.0.0.1:8010/v1 python run_web.py &
+    python -m benchmarks.load_test --sessions 50 --repeat 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import urllib.request
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import websockets
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 一轮对话结束时服务端发送的消息类型
+FINAL_TYPES = ('message', 'sys2-response', 'error')
+
+# Markdown测试用例中的用户输入
+_USER_LINE = re.compile(r'^>\s*用户[：:]\s*(.+?)\s*$')
+
+
+def load_conversations(path: str) -> List[List[str]]:
+    """读取要回放的对话
+    Args:
+        path: Markdown或JSONL文件路径
+    Returns:
+        List[List[str]]: 对话列表，每段对话为依次发送的用户输入
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    if not path.endswith('.jsonl'):
+        turns = [match.group(1) for match in map(_USER_LINE.match, lines) if match]
+        return [turns] if turns else []
+
+    conversations, single = [], []
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if isinstance(item, list):
+            conversations.append([str(turn) for turn in item])
+        elif isinstance(item, dict) and isinstance(item.get('turns'), list):
+            conversations.append([str(turn) for turn in item['turns']])
+        elif isinstance(item, dict):
+            text = item.get('title') or item.get('content') or item.get('body')
+            if text:
+                single.append(str(text))
+    if single:
+        conversations.append(single)
+    return [conversation for conversation in conversations if conversation]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """按最近秩法计算分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """一组耗时（毫秒）的p50/p95/p99、平均值和最大值"""
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.5),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'mean': statistics.mean(values) if values else None,
+        'max': max(values) if values else None
+    }
+
+
+def scrape_histogram(metrics_url: str, name: str) -> Optional[Tuple[List[Tuple[float, float]], float, float]]:
+    """读取/metrics中一个无标签直方图的累计桶计数
+    Args:
+        metrics_url: /metrics地址
+        name: 直方图名称
+    Returns:
+        Optional[Tuple]: ([(桶上界, 累计计数)], 总和, 总数)；无法读取时返回None
+    """
+    try:
+        with urllib.request.urlopen(metrics_url, timeout=5) as response:
+            text = response.read().decode('utf-8')
+    except OSError:
+        return None
+    buckets, total, count = [], 0.0, 0.0
+    for line in text.splitlines():
+        if line.startswith(f'{name}_bucket{{le="'):
+            bound = line[len(name) + 12:line.index('"}')]
+            buckets.append((float('inf') if bound == '+Inf' else float(bound), float(line.rsplit(' ', 1)[1])))
+        elif line.startswith(f'{name}_sum '):
+            total = float(line.rsplit(' ', 1)[1])
+        elif line.startswith(f'{name}_count '):
+            count = float(line.rsplit(' ', 1)[1])
+    if not buckets:
+        return None
+    return buckets, total, count
+
+
+def histogram_quantiles(before: Tuple, after: Tuple) -> Dict[str, Optional[float]]:
+    """由压测前后两次读取的直方图之差估算分位数（桶内线性插值，单位毫秒）"""
+    buckets = [(bound, count - old) for (bound, count), (_, old) in zip(after[0], before[0])]
+    count = after[2] - before[2]
+    result = {'count': int(count), 'mean': (after[1] - before[1]) / count * 1000 if count else None}
+    for label, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        result[label] = None
+        if not count:
+            continue
+        rank = q * count
+        lower_bound, lower_count = 0.0, 0.0
+        for bound, cumulative in buckets:
+            if cumulative >= rank:
+                if bound == float('inf'):
+                    value = lower_bound  # 超出最大的桶，只能给出下界
+                else:
+                    share = (rank - lower_count) / (cumulative - lower_count) if cumulative > lower_count else 1.0
+                    value = lower_bound + (bound - lower_bound) * share
+                result[label] = value * 1000
+                break
+            lower_bound, lower_count = bound, cumulative
+    return result
+
+
+class LoopLagProbe:
+    """采样压测进程自身的事件循环延迟，延迟过大说明压测端已成为瓶颈"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected) * 1000)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def run_session(url: str, conversation: List[str], repeat: int, think_time: float,
+                      timeout: float, results: Dict[str, Any]):
+    """打开一个WebSocket会话，依次发送对话中的用户输入并等待每轮的完整回复
+    Args:
+        url: /ws/chat地址
+        conversation: 用户输入列表
+        repeat: 对话回放的次数
+        think_time: 两轮之间的间隔（秒）
+        timeout: 每轮等待回复的超时时间（秒）
+        results: 汇总结果，记录每轮耗时、首个token时间和错误
+    """
+    try:
+        async with websockets.connect(url, max_size=None, open_timeout=timeout) as websocket:
+            # 连接后服务端先下发会话令牌
+            while json.loads(await asyncio.wait_for(websocket.recv(), timeout)).get('type') != 'session':
+                pass
+            for _ in range(repeat):
+                for text in conversation:
+                    start = time.perf_counter()
+                    first_token = None
+                    await websocket.send(text)
+                    while True:
+                        message = json.loads(await asyncio.wait_for(websocket.recv(), timeout))
+                        kind = message.get('type')
+                        if kind == 'ping':
+                            await websocket.send('pong')
+                            continue
+                        if kind == 'session':
+                            continue
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        if kind in FINAL_TYPES:
+                            break
+                    end = time.perf_counter()
+                    if kind == 'error':
+                        results['errors'].append(message.get('content', ''))
+                    else:
+                        results['turn_ms'].append((end - start) * 1000)
+                        results['ttft_ms'].append((first_token - start) * 1000)
+                        results['turn_types'][kind] = results['turn_types'].get(kind, 0) + 1
+                    if think_time:
+                        await asyncio.sleep(think_time)
+    except Exception as e:
+        results['failed_sessions'].append(f"{type(e).__name__}: {e}")
+
+
+async def run_load_test(url: str, conversations: List[List[str]], sessions: int, repeat: int = 1,
+                        think_time: float = 0.0, ramp_up: float = 0.0, timeout: float = 120.0,
+                        metrics_url: Optional[str] = None) -> Dict[str, Any]:
+    """并发回放对话并汇总结果
+    Args:
+        url: /ws/chat地址
+        conversations: 要回放的对话，各会话依次轮流使用
+        sessions: 并发会话数
+        repeat: 每个会话回放对话的次数
+        think_time: 两轮之间的间隔（秒）
+        ramp_up: 在这段时间（秒）内均匀地建立所有会话
+        timeout: 每轮等待回复的超时时间（秒）
+        metrics_url: 服务端/metrics地址，用于读取事件循环延迟
+    Returns:
+        Dict[str, Any]: 压测结果
+    """
+    results = {'turn_ms': [], 'ttft_ms': [], 'errors': [], 'failed_sessions': [], 'turn_types': {}}
+    lag_before = scrape_histogram(metrics_url, 'event_loop_lag_seconds') if metrics_url else None
+    probe = LoopLagProbe()
+    probe.start()
+
+    async def delayed(index: int):
+        if ramp_up:
+            await asyncio.sleep(ramp_up * index / sessions)
+        await run_session(url, conversations[index % len(conversations)], repeat, think_time, timeout, results)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(delayed(index) for index in range(sessions)))
+    elapsed = time.perf_counter() - start
+    await probe.stop()
+
+    lag_after = scrape_histogram(metrics_url, 'event_loop_lag_seconds') if metrics_url else None
+    turns = len(results['turn_ms'])
+    return {
+        'sessions': sessions,
+        'elapsed_seconds': elapsed,
+        'turns': turns,
+        'errors': len(results['errors']),
+        'failed_sessions': len(results['failed_sessions']),
+        'throughput_turns_per_second': turns / elapsed if elapsed else 0.0,
+        'turn_types': results['turn_types'],
+        'turn_latency_ms': summarize(results['turn_ms']),
+        'ttft_ms': summarize(results['ttft_ms']),
+        'server_loop_lag_ms': histogram_quantiles(lag_before, lag_after) if lag_before and lag_after else None,
+        'client_loop_lag_ms': summarize(probe.samples),
+        'error_samples': (results['errors'] + results['failed_sessions'])[:5]
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """把压测结果格式化为文本"""
+    def row(name: str, stats: Optional[Dict[str, Any]]) -> str:
+        if not stats or not stats.get('count'):
+            return f"{name:<18} 无数据"
+        cells = '  '.join(f"{key}={stats[key]:9.1f}" for key in ('p50', 'p95', 'p99', 'mean')
+                          if stats.get(key) is not None)
+        return f"{name:<18} {cells}  (n={stats['count']})"
+
+    lines = [
+        f"会话数 {report['sessions']}  完成 {report['turns']} 轮  错误 {report['errors']}"
+        f"  失败的会话 {report['failed_sessions']}  耗时 {report['elapsed_seconds']:.1f}s",
+        f"吞吐量 {report['throughput_turns_per_second']:.2f} 轮/秒  回复类型 {report['turn_types']}",
+        row('每轮耗时(ms)', report['turn_latency_ms']),
+        row('首个token(ms)', report['ttft_ms']),
+        row('服务端循环延迟(ms)', report['server_loop_lag_ms']),
+        row('压测端循环延迟(ms)', report['client_loop_lag_ms'])
+    ]
+    lines.extend(f"  错误示例: {sample}" for sample in report['error_samples'])
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端压测：并发回放WebSocket对话')
+    parser.add_argument('--url', default='ws://127.0.0.1:8001/ws/chat', help='/ws/chat地址')
+    parser.add_argument('--metrics-url', help='服务端/metrics地址，默认由--url推出；为none时不读取')
+    parser.add_argument('--conversations', default=os.path.join(_ROOT, '目标与落地方案.md'),
+                        help='要回放的对话（Markdown测试用例或JSONL）')
+    parser.add_argument('--sessions', type=int, default=20, help='并发会话数')
+    parser.add_argument('--repeat', type=int, default=1, help='每个会话回放对话的次数')
+    parser.add_argument('--think-time', type=float, default=0.0, help='两轮之间的间隔（秒）')
+    parser.add_argument('--ramp-up', type=float, default=0.0, help='在这段时间（秒）内均匀地建立所有会话')
+    parser.add_argument('--timeout', type=float, default=120.0, help='每轮等待回复的超时时间（秒）')
+    parser.add_argument('--json', help='把结果以JSON写入该文件')
+    args = parser.parse_args()
+
+    conversations = load_conversations(args.conversations)
+    if not conversations:
+        sys.exit(f"未能从{args.conversations}中读取到对话")
+    metrics_url = args.metrics_url
+    if metrics_url is None:
+        parts = urlsplit(args.url)
+        metrics_url = f"{'https' if parts.scheme == 'wss' else 'http'}://{parts.netloc}/metrics"
+    elif metrics_url == 'none':
+        metrics_url = None
+
+    report = asyncio.run(run_load_test(args.url, conversations, args.sessions, args.repeat, args.think_time,
+                                       args.ramp_up, args.timeout, metrics_url))
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
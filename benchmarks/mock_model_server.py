@@ -0,0 +1,242 @@
+"""
+本地模拟模型服务
+提供与百炼平台OpenAI兼容模式相同的 /v1/chat/completions 接口，模拟ModelAPI用到的三个模型，
+不产生费用、不依赖网络，用于压测和基准测试
+
+每个模型可分别配置首个token的延迟分布（对数正态）、输出速度（token/秒）、输出长度、
+推理内容长度（deepseek-r1）和注入的错误率；支持流式输出（stream_options.include_usage）。
+调度模型按prompt的哈希值稳定地返回sys1或sys2，相同的输入总是得到相同的决策。
+
+用法：
+    python -m benchmarks.mock_model_server --port 8010
+    python -m benchmarks.mock_model_server --error-rate 0.05 --latency-scale 0.5 --profile profile.json
+然后以 DASHSCOPE_BASE_URL=http://127.0.0.1:8010/v1 启动Web应用
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+import zlib
+from typing import Any, Dict, Iterator, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 各模型的默认参数：
+# ttft_ms为首个token延迟的中位数，ttft_sigma为对数正态分布的sigma；tokens_per_second为输出速度；
+# output_tokens、reasoning_tokens为输出和推理内容的token数范围；error_rate为返回错误的比例
+DEFAULT_PROFILES = {
+    'tongyi-intent-detect-v3': {
+        'ttft_ms': 250, 'ttft_sigma': 0.3, 'tokens_per_second': 200,
+        'output_tokens': [1, 1], 'reasoning_tokens': [0, 0], 'error_rate': 0.0
+    },
+    'qwen2.5-14b-instruct-1m': {
+        'ttft_ms': 350, 'ttft_sigma': 0.4, 'tokens_per_second': 60,
+        'output_tokens': [20, 120], 'reasoning_tokens': [0, 0], 'error_rate': 0.0
+    },
+    'deepseek-r1': {
+        'ttft_ms': 1200, 'ttft_sigma': 0.5, 'tokens_per_second': 30,
+        'output_tokens': [80, 300], 'reasoning_tokens': [150, 600], 'error_rate': 0.0
+    },
+}
+
+# 生成回复用的汉字，模拟时按一个汉字一个token计
+_CHARS = '的一是不了人我在有他这中大来上个到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么心多天而能好'
+
+
+def estimate_prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    """粗略估算输入token数：每个字符约0.8个token"""
+    return int(sum(len(str(message.get('content', ''))) for message in messages) * 0.8)
+
+
+class MockModels:
+    """按模型参数生成延迟、回复和错误"""
+
+    def __init__(self, profiles: Dict[str, Dict[str, Any]], latency_scale: float = 1.0,
+                 speed_scale: float = 1.0, sys2_ratio: float = 0.3, tokens_per_chunk: int = 1,
+                 seed: int = None):
+        """初始化
+        Args:
+            profiles: 模型名称 -> 模型参数
+            latency_scale: 首个token延迟的倍数
+            speed_scale: 输出速度的倍数
+            sys2_ratio: 调度模型返回sys2的比例
+            tokens_per_chunk: 流式输出时每个chunk包含的token数
+            seed: 随机种子
+        """
+        self.profiles = profiles
+        self.latency_scale = latency_scale
+        self.speed_scale = speed_scale
+        self.sys2_ratio = sys2_ratio
+        self.tokens_per_chunk = max(1, tokens_per_chunk)
+        self.rng = random.Random(seed)
+        self.stats = {'requests': 0, 'streams': 0, 'errors': 0}
+
+    def ttft(self, profile: Dict[str, Any]) -> float:
+        """抽取首个token的延迟（秒）"""
+        median = profile['ttft_ms'] / 1000 * self.latency_scale
+        return median * math.exp(self.rng.gauss(0, profile.get('ttft_sigma', 0)))
+
+    def token_interval(self, profile: Dict[str, Any]) -> float:
+        """两个token之间的间隔（秒）"""
+        return 1.0 / (profile['tokens_per_second'] * self.speed_scale)
+
+    def text(self, token_range: List[int]) -> str:
+        """按token数范围生成一段文本"""
+        low, high = token_range
+        return ''.join(self.rng.choices(_CHARS, k=self.rng.randint(low, high))) if high > 0 else ''
+
+    def reply(self, model: str, profile: Dict[str, Any], messages: List[Dict[str, Any]]) -> str:
+        """生成回复：调度模型按prompt的哈希值返回sys1或sys2，其他模型返回随机文本"""
+        if model == 'tongyi-intent-detect-v3':
+            prompt = str(messages[-1].get('content', '')) if messages else ''
+            return 'sys2' if zlib.crc32(prompt.encode('utf-8')) % 1000 < self.sys2_ratio * 1000 else 'sys1'
+        return self.text(profile['output_tokens'])
+
+    def should_fail(self, profile: Dict[str, Any]) -> bool:
+        """按错误率决定本次请求是否返回错误"""
+        return self.rng.random() < profile.get('error_rate', 0.0)
+
+    def chunks(self, text: str) -> Iterator[str]:
+        """把文本按tokens_per_chunk切分为流式输出的片段"""
+        for start in range(0, len(text), self.tokens_per_chunk):
+            yield text[start:start + self.tokens_per_chunk]
+
+
+def create_app(models: MockModels) -> FastAPI:
+    """创建模拟服务的FastAPI应用
+    Args:
+        models: 模拟模型
+    Returns:
+        FastAPI: 应用实例
+    """
+    app = FastAPI(title="模拟模型服务")
+
+    def error_response(status_code: int, message: str, error_type: str) -> JSONResponse:
+        """返回OpenAI格式的错误"""
+        return JSONResponse(status_code=status_code,
+                            content={'error': {'message': message, 'type': error_type, 'code': error_type}})
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get('model')
+        messages = body.get('messages') or []
+        profile = models.profiles.get(model)
+        if profile is None:
+            return error_response(404, f"The model `{model}` does not exist", 'model_not_found')
+
+        models.stats['requests'] += 1
+        ttft = models.ttft(profile)
+        if models.should_fail(profile):
+            # 错误在等待首个token的延迟后返回，429和500都会被ModelAPI重试
+            models.stats['errors'] += 1
+            await asyncio.sleep(ttft)
+            if models.rng.random() < 0.5:
+                return error_response(429, '模拟服务注入的限流错误', 'rate_limit_exceeded')
+            return error_response(500, '模拟服务注入的内部错误', 'internal_error')
+
+        reasoning = models.text(profile['reasoning_tokens'])
+        content = models.reply(model, profile, messages)
+        input_tokens = estimate_prompt_tokens(messages)
+        usage = {'prompt_tokens': input_tokens, 'completion_tokens': len(reasoning) + len(content),
+                 'total_tokens': input_tokens + len(reasoning) + len(content)}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        interval = models.token_interval(profile)
+
+        if not body.get('stream'):
+            await asyncio.sleep(ttft + interval * (len(reasoning) + len(content)))
+            message = {'role': 'assistant', 'content': content}
+            if reasoning:
+                message['reasoning_content'] = reasoning
+            return {
+                'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+                'usage': usage
+            }
+
+        models.stats['streams'] += 1
+        include_usage = (body.get('stream_options') or {}).get('include_usage', False)
+
+        def chunk(delta: Dict[str, Any], finish_reason: str = None) -> str:
+            payload = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                       'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        async def stream():
+            loop = asyncio.get_running_loop()
+            # 按预定时间表输出，避免多次sleep的误差累积
+            deadline = loop.time() + ttft
+            await asyncio.sleep(ttft)
+            yield chunk({'role': 'assistant', 'content': ''})
+            for field, text in (('reasoning_content', reasoning), ('content', content)):
+                for piece in models.chunks(text):
+                    deadline += interval * len(piece)
+                    await asyncio.sleep(max(0.0, deadline - loop.time()))
+                    yield chunk({field: piece})
+            yield chunk({}, 'stop')
+            if include_usage:
+                payload = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                           'model': model, 'choices': [], 'usage': usage}
+                yield f"data: {json.dumps(payload)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type='text/event-stream')
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {'object': 'list', 'data': [{'id': name, 'object': 'model'} for name in models.profiles]}
+
+    @app.get("/stats")
+    async def get_stats():
+        """已处理的请求数、流式请求数和注入的错误数"""
+        return models.stats
+
+    return app
+
+
+def load_profiles(path: str = None, error_rate: float = None) -> Dict[str, Dict[str, Any]]:
+    """读取模型参数：默认参数 + JSON文件中的覆盖项
+    Args:
+        path: JSON文件路径，格式为 {模型名称: {参数名: 值}}，可只包含需要修改的参数
+        error_rate: 统一设置所有模型的错误率
+    Returns:
+        Dict[str, Dict[str, Any]]: 模型名称 -> 模型参数
+    """
+    profiles = {name: dict(profile) for name, profile in DEFAULT_PROFILES.items()}
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            for name, overrides in json.load(f).items():
+                profiles.setdefault(name, dict(DEFAULT_PROFILES['qwen2.5-14b-instruct-1m'])).update(overrides)
+    if error_rate is not None:
+        for profile in profiles.values():
+            profile['error_rate'] = error_rate
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟模型服务（OpenAI兼容接口）')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=8010, help='监听端口')
+    parser.add_argument('--profile', help='覆盖模型参数的JSON文件')
+    parser.add_argument('--error-rate', type=float, help='统一设置所有模型的错误率')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='首个token延迟的倍数')
+    parser.add_argument('--speed-scale', type=float, default=1.0, help='输出速度的倍数')
+    parser.add_argument('--sys2-ratio', type=float, default=0.3, help='调度模型返回sys2的比例')
+    parser.add_argument('--tokens-per-chunk', type=int, default=1, help='流式输出时每个chunk的token数')
+    parser.add_argument('--seed', type=int, help='随机种子')
+    args = parser.parse_args()
+
+    models = MockModels(load_profiles(args.profile, args.error_rate), args.latency_scale, args.speed_scale,
+                        args.sys2_ratio, args.tokens_per_chunk, args.seed)
+    print(f"模拟模型服务: http://{args.host}:{args.port}/v1")
+    uvicorn.run(create_app(models), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
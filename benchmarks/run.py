@@ -0,0 +1,545 @@
+"""
+每轮对话热路径的微基准测试套件
+模型调用替换为立即返回的固定结果，只测量本地的CPU和数据库I/O开销：
+- dialogue: DialogueManager.process_input完整一轮（调度、sys1/sys2、写入消息和日志）
+- context: 调度Agent、sys1、sys2按各自的token预算选取并格式化对话历史
+- sys2: 从很长的R1输出中分离思考过程和回复（完整文本和流式增量两种方式）
+- database: add_message、add_system_log（sync/async两种持久性）；
+  在合成的大数据库（默认100万条日志）上执行get_logs，包括按时间、全文检索和LIKE检索
+
+每个基准先自动确定每轮的执行次数（每轮不少于--min-time秒），再执行--rounds轮，
+记录每次执行耗时的最小值、中位数、平均值和标准差（与timeit相同，计时期间暂停垃圾回收）。结果可保存为JSON，
+与之前保存的结果对比时，最小值（受其他进程干扰最小）变慢超过--threshold的基准标记为回归，并以退出码1结束。
+合成的日志数据库缓存在--data-dir中，相同行数的重复运行直接使用。
+
+用法：
+    python -m benchmarks.run --output base.json
+    python -m benchmarks.run --filter database --log-rows 100000
+    python -m benchmarks.run --baseline base.json --output new.json
+    python -m benchmarks.run --compare base.json new.json --threshold 0.1
+"""
+import argparse
+import atexit
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+_CHARS = '的一是不了人我在有他这中大来上个到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么心多天而能好'
+
+# 已注册的基准：(名称, 准备函数)；准备函数接收Suite，返回要计时的无参函数
+BENCHMARKS: List[Tuple[str, Callable[['Suite'], Callable[[], Any]]]] = []
+
+
+def benchmark(name: str):
+    """注册一个基准
+    Args:
+        name: 基准名称，按"分组.名称[参数]"命名
+    """
+    def register(setup: Callable[['Suite'], Callable[[], Any]]):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+class Suite:
+    """基准之间共享的运行环境：随机数、临时目录和合成的日志数据库"""
+
+    def __init__(self, tmpdir: str, data_dir: str, log_rows: int, seed: int = 42):
+        self.tmpdir = tmpdir
+        self.data_dir = data_dir
+        self.log_rows = log_rows
+        self.rng = random.Random(seed)
+        self._log_db = None
+        self._cleanups = []
+        self._files = 0
+
+    def temp_path(self, prefix: str) -> str:
+        """临时目录中一个新的数据库文件路径"""
+        self._files += 1
+        return os.path.join(self.tmpdir, f'{prefix}_{self._files}.db')
+
+    def text(self, low: int, high: int) -> str:
+        """生成指定长度范围的随机中文文本"""
+        return ''.join(self.rng.choices(_CHARS, k=self.rng.randint(low, high)))
+
+    def on_cleanup(self, func: Callable[[], Any]):
+        """登记基准结束后需要执行的清理"""
+        self._cleanups.append(func)
+
+    def cleanup(self):
+        """执行并清空已登记的清理"""
+        while self._cleanups:
+            self._cleanups.pop()()
+
+    def log_database(self):
+        """合成的日志数据库（首次使用时生成，之后复用）"""
+        if self._log_db is None:
+            from src.database import Database
+            os.makedirs(self.data_dir, exist_ok=True)
+            path = os.path.join(self.data_dir, f'logs_{self.log_rows}.db')
+            ready = os.path.exists(path + '.ready')
+            if not ready and os.path.exists(path):
+                os.remove(path)
+            database = Database(path, durability='sync')
+            if not ready:
+                populate_logs(database, self.log_rows, random.Random(7))
+                open(path + '.ready', 'w').close()
+            self._log_db = database
+        return self._log_db
+
+    def close(self):
+        self.cleanup()
+        if self._log_db is not None:
+            self._log_db.close()
+
+
+def populate_logs(database: Any, rows: int, rng: random.Random, batch: int = 20000):
+    """向数据库写入合成的会话和系统日志，时间均匀分布在最近30天内
+    Args:
+        database: Database实例（sync持久性）
+        rows: 日志条数
+        rng: 随机数
+        batch: 每次提交的条数
+    """
+    start = time.perf_counter()
+    sessions = max(1, rows // 50)
+    now = datetime.now()
+    database._write('INSERT INTO sessions (start_time, status) VALUES (?, ?)',
+                    [(now - timedelta(days=30), 'ended')] * sessions, many=True)
+    agents = [('dispatcher', 'tongyi-intent-detect-v3'), ('sys1', 'qwen2.5-14b-instruct-1m'),
+              ('sys2', 'deepseek-r1')]
+    step = timedelta(days=30) / rows
+    first = now - timedelta(days=30)
+    for offset in range(0, rows, batch):
+        values = []
+        for index in range(offset, min(rows, offset + batch)):
+            agent, model = agents[index % 3]
+            user_input = ''.join(rng.choices(_CHARS, k=rng.randint(5, 40)))
+            output = 'sys1' if agent == 'dispatcher' else ''.join(rng.choices(_CHARS, k=rng.randint(20, 200)))
+            values.append((index // 50 + 1, first + step * index, agent, '', output, rng.randint(200, 8000),
+                           rng.randint(200, 3000), len(output), model, 'success', None, None, user_input))
+        database._write(
+            '''INSERT INTO system_logs
+               (session_id, timestamp, agent_name, input_text, output_text, response_time_ms,
+                input_tokens, output_tokens, model_name, status, error_message, first_token_ms, user_input)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            values, many=True
+        )
+    print(f"生成合成日志数据库: {rows}条日志, {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+def stub_model_api(suite: Suite):
+    """把模型调用替换为立即返回的固定结果：调度每三轮选一次sys2，sys2返回很长的思考过程"""
+    from src.model_api import api
+
+    turn = {'count': 0}
+    thinking = '\n\n'.join(suite.text(200, 400) for _ in range(10))
+
+    def call_intent(prompt: str):
+        turn['count'] += 1
+        return ('sys2' if turn['count'] % 3 == 0 else 'sys1'), 1, len(prompt), 1, None
+
+    def call_qwen(prompt: str):
+        return suite.text(20, 120), 1, len(prompt), 60, None
+
+    def call_deepseek(prompt: str):
+        return f"{thinking}\n\n[回复]\n{suite.text(100, 300)}", 1, len(prompt), 2000, None
+
+    async def acall(func: Callable, prompt: str):
+        return func(prompt)
+
+    api.call_intent, api.call_qwen, api.call_deepseek = call_intent, call_qwen, call_deepseek
+    api.acall_intent = lambda prompt, priority=None: acall(call_intent, prompt)
+    api.acall_qwen = lambda prompt, priority=None: acall(call_qwen, prompt)
+    api.acall_deepseek = lambda prompt, priority=None: acall(call_deepseek, prompt)
+
+
+def make_history(suite: Suite, length: int = 20) -> List[Dict[str, Any]]:
+    """生成对话窗口：会话摘要 + 用户和赵敏敏交替的消息，部分回复带思考过程"""
+    history = [{'role': '早前对话摘要', 'content': suite.text(200, 300), 'pinned': True}]
+    for index in range(length):
+        message = {'role': '用户' if index % 2 == 0 else '赵敏敏', 'content': suite.text(20, 200)}
+        if index % 2 == 1 and suite.rng.random() < 0.3:
+            message['thinking'] = suite.text(300, 1200)
+        history.append(message)
+    return history
+
+
+def long_r1_output(suite: Suite, marker: bool = True) -> str:
+    """生成很长的R1输出：约2万字分段的思考过程，加上回复"""
+    thinking = '\n\n'.join(suite.text(300, 700) for _ in range(40))
+    reply = suite.text(300, 800)
+    return f"{thinking}\n\n[回复]\n{reply}" if marker else f"{thinking}\n\n{reply}"
+
+
+@benchmark('dialogue.process_input')
+def bench_process_input(suite: Suite):
+    from src.dialogue_manager import DialogueManager
+    stub_model_api(suite)
+    manager = DialogueManager()
+    inputs = [suite.text(5, 60) for _ in range(500)]
+    # 先填满对话窗口，计时的是稳定状态下的一轮
+    for text in inputs[:12]:
+        manager.process_input(text)
+    position = {'index': 0}
+
+    def run():
+        position['index'] = (position['index'] + 1) % len(inputs)
+        manager.process_input(inputs[position['index']])
+    suite.on_cleanup(manager.end_session)
+    return run
+
+
+def _bench_context(agent_names: Tuple[str, ...]):
+    """各Agent按token预算选取对话历史；每次使用新的对话窗口并清空token估算缓存，与真实的每轮一致"""
+    def setup(suite: Suite):
+        from src.config import Config
+        from src.context import ContextBuilder, FormattedHistory, estimate_tokens
+        agents_config = Config().get_agents_config()
+        builders = [ContextBuilder(agents_config[name].get('context')) for name in agent_names]
+        histories = [make_history(suite) for _ in range(200)]
+        position = {'index': 0}
+
+        def run():
+            position['index'] = (position['index'] + 1) % len(histories)
+            estimate_tokens.cache_clear()
+            history = FormattedHistory(histories[position['index']])
+            for builder in builders:
+                builder.build(history)
+        return run
+    return setup
+
+
+for _name in ('dispatcher', 'sys1', 'sys2'):
+    benchmark(f'context.build[{_name}]')(_bench_context((_name,)))
+benchmark('context.build[all_agents]')(_bench_context(('dispatcher', 'sys1', 'sys2')))
+
+
+def _bench_retrieval(messages: int, cold: bool):
+    """检索早期消息；cold为True时每次新建检索器，计时的是读取会话全部消息并建立BM25索引的冷启动（进程重启或索引被淘汰后的第一轮）"""
+    def setup(suite: Suite):
+        from src.database import Database
+        from src.retrieval import MessageRetriever
+        database = Database(suite.temp_path(f'retrieval_{messages}'), durability='sync')
+        suite.on_cleanup(database.close)
+        session_id = database.create_session()
+        for index in range(messages):
+            database.add_message(session_id, '用户' if index % 2 == 0 else '赵敏敏', suite.text(20, 200))
+        queries = [suite.text(5, 60) for _ in range(200)]
+        retriever = MessageRetriever(database)
+        retriever.retrieve(session_id, queries[0])
+        position = {'index': 0}
+
+        def run():
+            position['index'] = (position['index'] + 1) % len(queries)
+            target = MessageRetriever(database) if cold else retriever
+            target.retrieve(session_id, queries[position['index']])
+        return run
+    return setup
+
+
+for _messages in (200, 2000):
+    benchmark(f'retrieval.cold_build[{_messages}]')(_bench_retrieval(_messages, cold=True))
+benchmark('retrieval.retrieve[2000]')(_bench_retrieval(2000, cold=False))
+
+
+@benchmark('sys2.split_response[long]')
+def bench_split_response(suite: Suite):
+    from src.agents import Sys2Agent
+    from src.config import Config
+    agent = Sys2Agent(Config().get_agents_config()['sys2'])
+    text = long_r1_output(suite)
+    return lambda: agent._split_response(text)
+
+
+@benchmark('sys2.split_response[no_marker]')
+def bench_split_response_fallback(suite: Suite):
+    from src.agents import Sys2Agent
+    from src.config import Config
+    agent = Sys2Agent(Config().get_agents_config()['sys2'])
+    text = long_r1_output(suite, marker=False)
+    return lambda: agent._split_response(text)
+
+
+@benchmark('sys2.stream_parser[long]')
+def bench_stream_parser(suite: Suite):
+    from src.agents import Sys2ResponseParser
+    text = long_r1_output(suite)
+    # 流式输出时每个chunk约为几个字
+    chunks = [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def run():
+        parser = Sys2ResponseParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.flush()
+        parser.result()
+    return run
+
+
+def _write_database(suite: Suite, durability: str):
+    """新建临时数据库，结束时写入队列中剩余的数据并关闭"""
+    from src.database import Database
+    database = Database(suite.temp_path(f'writes_{durability}'), durability=durability)
+    suite.on_cleanup(database.close)
+    return database
+
+
+def _bench_add_message(durability: str):
+    def setup(suite: Suite):
+        database = _write_database(suite, durability)
+        session_id = database.create_session()
+        texts = [suite.text(20, 200) for _ in range(200)]
+        position = {'index': 0}
+
+        def run():
+            position['index'] = (position['index'] + 1) % len(texts)
+            database.add_message(session_id, '赵敏敏', texts[position['index']])
+        return run
+    return setup
+
+
+def _bench_add_system_log(durability: str):
+    """与Agent相同的方式写日志：prompt由模板、历史消息和用户输入组成，按片段去重存储"""
+    def setup(suite: Suite):
+        database = _write_database(suite, durability)
+        session_id = database.create_session()
+        template = suite.text(500, 500)
+        messages = [f"用户: {suite.text(20, 200)}\n" for _ in range(40)]
+        inputs = [suite.text(5, 60) for _ in range(200)]
+        outputs = [suite.text(20, 200) for _ in range(200)]
+        position = {'index': 0}
+
+        def run():
+            index = position['index'] = (position['index'] + 1) % len(inputs)
+            # 对话窗口每轮向后滑动两条消息
+            window = [messages[(index * 2 + offset) % len(messages)] for offset in range(20)]
+            segments = [template, *window, inputs[index]]
+            database.add_system_log(session_id, 'sys1', ''.join(segments), outputs[index], 800, 1200, 60,
+                                    'qwen2.5-14b-instruct-1m', 'success', input_segments=segments,
+                                    user_input=inputs[index])
+        return run
+    return setup
+
+
+for _durability in ('sync', 'batched', 'async'):
+    benchmark(f'database.add_message[{_durability}]')(_bench_add_message(_durability))
+    benchmark(f'database.add_system_log[{_durability}]')(_bench_add_system_log(_durability))
+
+
+def _bench_get_logs(kind: str):
+    def setup(suite: Suite):
+        database = suite.log_database()
+        now = datetime.now()
+        if kind == 'recent':
+            return lambda: database.get_logs()
+        if kind == 'time_range':
+            start, end = (now - timedelta(days=10)).isoformat(), (now - timedelta(days=9)).isoformat()
+            return lambda: database.get_logs(start_time=start, end_time=end)
+        # 检索词取自已有日志的用户输入：全文检索用4个字，两个字时退回到LIKE
+        sample = database.get_logs_page(page_size=1, fields=['user_input'])['logs'][0]['user_input']
+        term = sample[:4] if kind == 'search_fts' else sample[:2]
+        return lambda: database.get_logs(search_text=term)
+    return setup
+
+
+for _kind in ('recent', 'time_range', 'search_fts', 'search_like'):
+    benchmark(f'database.get_logs[{_kind}]')(_bench_get_logs(_kind))
+
+
+def measure(func: Callable[[], Any], rounds: int, min_time: float) -> Dict[str, Any]:
+    """计时：先确定每轮的执行次数（每轮不少于min_time秒），再执行rounds轮；计时期间暂停垃圾回收
+    Args:
+        func: 要计时的函数
+        rounds: 轮数
+        min_time: 每轮的最短时间（秒）
+    Returns:
+        Dict[str, Any]: 每次执行耗时（微秒）的min/median/mean/stddev，以及轮数和每轮的执行次数
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    samples = []
+    for _ in range(rounds):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            samples.append((time.perf_counter() - start) / number * 1e6)
+        finally:
+            gc.enable()
+    return {
+        'min_us': min(samples),
+        'median_us': statistics.median(samples),
+        'mean_us': statistics.mean(samples),
+        'stddev_us': statistics.pstdev(samples),
+        'rounds': rounds,
+        'number': number
+    }
+
+
+def git_commit() -> Optional[str]:
+    """当前的git提交，无法获取时返回None"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(names: List[str], rounds: int, min_time: float, data_dir: str, log_rows: int) -> Dict[str, Any]:
+    """运行选中的基准
+    Args:
+        names: 要运行的基准名称
+        rounds: 每个基准的轮数
+        min_time: 每轮的最短时间（秒）
+        data_dir: 合成日志数据库的缓存目录
+        log_rows: 合成日志数据库的日志条数
+    Returns:
+        Dict[str, Any]: {"meta": 运行环境, "benchmarks": {名称: 计时结果}}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        suite = Suite(tmpdir, data_dir, log_rows)
+        try:
+            for name, setup in BENCHMARKS:
+                if name not in names:
+                    continue
+                func = setup(suite)
+                results[name] = measure(func, rounds, min_time)
+                suite.cleanup()
+                print(f"{name:<36} min {format_us(results[name]['min_us']):>10}"
+                      f"  median {format_us(results[name]['median_us']):>10}"
+                      f"  ±{results[name]['stddev_us'] / results[name]['median_us'] * 100:5.1f}%", flush=True)
+        finally:
+            suite.close()
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'rounds': rounds,
+            'min_time': min_time,
+            'log_rows': log_rows
+        },
+        'benchmarks': results
+    }
+
+
+def format_us(value: float) -> str:
+    """按数量级输出耗时"""
+    if value >= 1e6:
+        return f"{value / 1e6:.2f}s"
+    if value >= 1e3:
+        return f"{value / 1e3:.2f}ms"
+    return f"{value:.1f}us"
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> Tuple[str, List[str]]:
+    """对比两次运行的最小值
+    Args:
+        baseline: 基线结果
+        current: 本次结果
+        threshold: 变慢超过该比例时视为回归
+    Returns:
+        Tuple[str, List[str]]: (对比表格, 回归的基准名称)
+    """
+    lines = [f"{'基准':<34} {'基线':>12} {'本次':>12} {'变化':>8}"]
+    regressions = []
+    keys = ['python']
+    if any(name.startswith('database.get_logs') for name in baseline['benchmarks']) and \
+            any(name.startswith('database.get_logs') for name in current['benchmarks']):
+        keys.append('log_rows')
+    for key in keys:
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            lines.append(f"注意: 两次运行的{key}不同（{baseline['meta'].get(key)} / {current['meta'].get(key)}）")
+    for name in sorted(set(baseline['benchmarks']) | set(current['benchmarks'])):
+        old = baseline['benchmarks'].get(name)
+        new = current['benchmarks'].get(name)
+        if old is None or new is None:
+            lines.append(f"{name:<36} {format_us(old['min_us']) if old else '-':>12}"
+                         f" {format_us(new['min_us']) if new else '-':>12}")
+            continue
+        change = new['min_us'] / old['min_us'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  回归'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = '  提升'
+        lines.append(f"{name:<36} {format_us(old['min_us']):>12} {format_us(new['min_us']):>12}"
+                     f" {change * 100:+7.1f}%{flag}")
+    return '\n'.join(lines), regressions
+
+
+def load_result(path: str) -> Dict[str, Any]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='每轮对话热路径的微基准测试')
+    parser.add_argument('--filter', action='append', help='只运行名称包含该字符串的基准，可指定多次')
+    parser.add_argument('--list', action='store_true', help='列出所有基准')
+    parser.add_argument('--rounds', type=int, default=5, help='每个基准的轮数')
+    parser.add_argument('--min-time', type=float, default=0.2, help='每轮的最短时间（秒）')
+    parser.add_argument('--log-rows', type=int, default=1000000, help='合成日志数据库的日志条数')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'dual_sys_exp_bench'),
+                        help='合成日志数据库的缓存目录')
+    parser.add_argument('--output', help='把结果以JSON写入该文件')
+    parser.add_argument('--baseline', help='运行后与该JSON结果对比')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help='只对比两个已保存的结果')
+    parser.add_argument('--threshold', type=float, default=0.1, help='最小值变慢超过该比例时视为回归')
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(name for name, _ in BENCHMARKS))
+        return
+    if args.compare:
+        table, regressions = compare(load_result(args.compare[0]), load_result(args.compare[1]), args.threshold)
+        print(table)
+        sys.exit(1 if regressions else 0)
+
+    # 模型调用已替换为固定结果，只需要一个占位的API密钥；对话管理器使用临时数据库
+    os.environ.setdefault('DASHSCOPE_API_KEY', 'benchmark')
+    db_dir = tempfile.mkdtemp(prefix='dual_sys_exp_bench_')
+    os.environ['DIALOGUE_DB_PATH'] = os.path.join(db_dir, 'dialogue.db')
+    # 先于数据库模块登记，退出时在全局数据库关闭之后删除
+    atexit.register(shutil.rmtree, db_dir, True)
+    names = [name for name, _ in BENCHMARKS if not args.filter or any(part in name for part in args.filter)]
+    result = run_suite(names, args.rounds, args.min_time, args.data_dir, args.log_rows)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        table, regressions = compare(load_result(args.baseline), result, args.threshold)
+        print()
+        print(table)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,19 @@
 """
 Web应用启动脚本
+
+用法：
+    python run_web.py [--workers 4]
 """
+import argparse
 import uvicorn
 import socket
 import os
+import secrets
 import subprocess
 import sys
+import tempfile
 import time
-from src.web.app import app
+from src.config import Config
 
 def check_port_in_use(port):
     """检查端口是否被占用
@@ -96,14 +102,42 @@ def free_port(port):
         print(f"未找到占用端口 {port} 的进程")
         return False
 
+def prepare_workers(workers):
+    """多个worker时准备各进程共享的环境变量（子进程继承）
+    
+    Args:
+        workers: worker进程数
+    """
+    if workers <= 1:
+        return
+    sessions_config = Config().get_runtime_config().get('sessions', {}) or {}
+    # 会话状态必须放在共享存储中，任一worker才能继续处理任一会话
+    if (os.getenv('SESSION_STORE') or sessions_config.get('store', 'memory')) == 'memory':
+        os.environ['SESSION_STORE'] = 'sqlite'
+        print("多个worker不能使用进程内的会话状态存储，已改用sqlite")
+    # 各worker使用相同的会话令牌签名密钥，重连到任一worker都能校验
+    if not (os.getenv('SESSION_SECRET') or sessions_config.get('secret')):
+        os.environ['SESSION_SECRET'] = secrets.token_hex(32)
+    # 各worker的监控指标写入同一目录，由/metrics合并
+    if not os.getenv('METRICS_MULTIPROC_DIR'):
+        metrics_config = Config().get_runtime_config().get('metrics', {}) or {}
+        os.environ['METRICS_MULTIPROC_DIR'] = (metrics_config.get('multiprocess_dir')
+                                               or tempfile.mkdtemp(prefix='dual_sys_metrics_'))
+
 if __name__ == "__main__":
     PORT = 8001
     
+    parser = argparse.ArgumentParser(description='启动Web应用')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker进程数')
+    args = parser.parse_args()
+    
     # 尝试释放端口
     if check_port_in_use(PORT):
         if not free_port(PORT):
             print(f"无法释放端口 {PORT}，应用将退出")
             sys.exit(1)
     
-    print(f"启动Web应用，监听端口: {PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    prepare_workers(args.workers)
+    print(f"启动Web应用，监听端口: {PORT}，worker数: {args.workers}")
+    # 多个worker时uvicorn需要以导入字符串的方式加载应用
+    uvicorn.run("src.web.app:app", host="0.0.0.0", port=PORT, workers=args.workers)
@@ -2,11 +2,148 @@
 Agent实现模块
 定义了系统中所有Agent的基类和具体实现
 """
+import asyncio  # 导入异步支持
+import hashlib  # 用于计算上下文摘要
+import os  # 用于拼接缓存文件路径
+import time  # 用于统计缓存查询耗时
+import random  # 用于按比例抽样对照调用
 from abc import ABC, abstractmethod  # 导入抽象基类支持
-from typing import Dict, List, Optional, Any, Tuple  # 导入类型提示
+from contextlib import contextmanager  # 用于记录被取消的模型调用
+from typing import Dict, List, Optional, Any, Tuple, AsyncIterator, Iterator  # 导入类型提示
 from src.config import Config  # 导入配置类
 from src.model_api import api  # 导入模型API
 from src.database import db  # 导入数据库
+from src.router import LABELS, LocalRouter, extract_user_input, normalize_text, parse_decision  # 导入本地路由
+from src.cache import ResponseCache, TTLCache  # 导入缓存
+from src.prompt_store import RenderedPrompt, parse_template, render_template  # 导入prompt片段渲染
+from src.metrics import dispatch_decisions  # 导入调度指标
+from src.tracing import tracer  # 导入链路追踪
+from src.context import ContextBuilder, estimate_tokens  # 导入按token预算选取对话历史的上下文构建器
+
+# 进程内共享的本地路由，首次使用时从历史调度日志训练
+_local_router: Optional[LocalRouter] = None
+
+# 进程内共享的调度决策缓存
+_decision_cache: Optional[TTLCache] = None
+
+# 清空标记文件：多个worker各有自己的调度决策缓存，任一worker清空时更新该文件，
+# 其他worker发现修改时间变化后在下次查询缓存前清空
+_decision_cache_flush_path = os.path.join(os.path.dirname(db.db_path), 'decision_cache.flush')
+_decision_cache_flushed_at: Optional[int] = None  # 本进程已经处理过的标记修改时间
+
+def _flush_marker_mtime() -> Optional[int]:
+    """清空标记文件的修改时间（纳秒），文件不存在时返回None"""
+    try:
+        return os.stat(_decision_cache_flush_path).st_mtime_ns
+    except OSError:
+        return None
+
+def get_decision_cache(config: Dict[str, Any]) -> TTLCache:
+    """获取进程内共享的调度决策缓存，按配置更新容量和有效期（修改配置后无需重启）
+    Args:
+        config: decision_cache配置
+    Returns:
+        TTLCache: 缓存实例
+    """
+    global _decision_cache, _decision_cache_flushed_at
+    if _decision_cache is None:
+        _decision_cache = TTLCache(
+            max_size=config.get('max_size', 4096),
+            ttl_seconds=config.get('ttl_seconds', 3600)
+        )
+        _decision_cache_flushed_at = _flush_marker_mtime()
+    else:
+        _decision_cache.max_size = config.get('max_size', 4096)
+        _decision_cache.ttl_seconds = config.get('ttl_seconds', 3600)
+    return _decision_cache
+
+def sync_decision_cache():
+    """其他worker清空过调度决策缓存时，清空本进程的缓存"""
+    global _decision_cache_flushed_at
+    flushed_at = _flush_marker_mtime()
+    if flushed_at != _decision_cache_flushed_at:
+        _decision_cache_flushed_at = flushed_at
+        if _decision_cache is not None:
+            _decision_cache.clear()
+
+def flush_decision_caches() -> int:
+    """清空所有worker的调度决策缓存：本进程立即清空，其他worker在下次查询缓存前清空
+    Returns:
+        int: 本进程清除的条目数
+    """
+    global _decision_cache_flushed_at
+    with open(_decision_cache_flush_path, 'w', encoding='utf-8') as f:
+        f.write(str(time.time_ns()))
+    _decision_cache_flushed_at = _flush_marker_mtime()
+    return _decision_cache.clear() if _decision_cache is not None else 0
+
+def get_local_router(agent_name: str, prompt_template: str, config: Dict[str, Any]) -> LocalRouter:
+    """获取进程内共享的本地路由，首次调用时用system_logs中的调度记录训练
+    Args:
+        agent_name: 调度Agent名称，用于筛选训练数据
+        prompt_template: 调度Agent的prompt模板，用于从日志中还原用户输入
+        config: local_router配置
+    Returns:
+        LocalRouter: 本地路由实例
+    """
+    global _local_router
+    if _local_router is None:
+        router = LocalRouter(config)
+        samples = []
+        for row in db.get_agent_decisions(agent_name, config.get('training_limit', 5000)):
+            label = row['output_text'].strip().lower()
+            # 按片段存储的日志直接记录了用户输入，旧日志从完整prompt中还原
+            user_input = row['user_input'] or extract_user_input(row['input_text'], prompt_template)
+            if label in LABELS and user_input:
+                samples.append((user_input, label))
+        router.fit(samples)
+        _local_router = router
+    return _local_router
+
+# 进程内共享的sys1回复缓存
+_response_cache: Optional[ResponseCache] = None
+
+def get_response_cache(config: Dict[str, Any]) -> ResponseCache:
+    """获取进程内共享的sys1回复缓存
+    Args:
+        config: response_cache配置
+    Returns:
+        ResponseCache: 缓存实例
+    """
+    global _response_cache
+    if _response_cache is None:
+        persist_path = None
+        if config.get('persist', False):
+            # 默认与dialogue.db放在同一目录
+            persist_path = config.get('persist_path') or os.path.join(
+                os.path.dirname(db.db_path), 'response_cache.db'
+            )
+        _response_cache = ResponseCache(
+            max_entries=config.get('max_entries', 10000),
+            max_bytes=config.get('max_bytes', 16 * 1024 * 1024),
+            max_distance=config.get('max_distance', 3),
+            persist_path=persist_path
+        )
+    return _response_cache
+
+class CallProgress:
+    """进行中的模型调用：记录开始时间和已收到的输出，调用被取消时据此记录日志"""
+    
+    def __init__(self):
+        self.start_time = time.time()
+        self.first_token_ms = None  # 首个token的到达时间（毫秒）
+        self.text_parts = []  # 已收到的回复片段
+        self.reasoning_parts = []  # 已收到的推理内容片段
+        
+    def received(self, text: str, reasoning: bool = False):
+        """记录收到的一个输出片段
+        Args:
+            text: 片段内容
+            reasoning: 是否为推理内容（不计入输出文本，但计入输出token）
+        """
+        if self.first_token_ms is None:
+            self.first_token_ms = int((time.time() - self.start_time) * 1000)
+        (self.reasoning_parts if reasoning else self.text_parts).append(text)
 
 class BaseAgent(ABC):
     """Agent基类，定义了所有Agent的通用接口和属性"""
@@ -20,6 +157,9 @@ class BaseAgent(ABC):
         self.model = config.get('model', '')  # 使用的模型名称
         self.role = config.get('role', '')  # Agent的角色描述
         self.prompt_template = config.get('prompt_template', '')  # prompt模板
+        self._parsed_template = parse_template(self.prompt_template)  # 预解析的模板（进程内共享）
+        self.context_builder = ContextBuilder(config.get('context'))  # 按token预算选取对话历史
+        self.last_usage = (0, 0)  # 最近一次调用的(输入tokens, 输出tokens)
 
     @abstractmethod
     def process(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> str:
@@ -33,14 +173,53 @@ class BaseAgent(ABC):
         """
         pass
 
-    def _log_api_call(self, session_id: int, input_text: str, output: Tuple[str, int, int, int, Optional[str]]):
+    @abstractmethod
+    async def aprocess(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> Any:
+        """处理用户输入的异步版本，返回值与process一致
+        Args:
+            user_input: 用户的输入文本
+            dialogue_history: 对话历史记录列表
+            session_id: 当前会话ID
+        Returns:
+            Any: Agent的回复
+        """
+        pass
+
+    def _build_prompt(self, user_input: str, dialogue_history: List[Dict[str, str]]) -> str:
+        """构建prompt，填充对话历史和用户输入
+        Args:
+            user_input: 用户的输入文本
+            dialogue_history: 对话历史记录列表
+        Returns:
+            str: 完整的prompt文本，同时保留模板片段、历史消息和用户输入，供日志去重存储
+        """
+        with tracer.span('prompt.format', agent=self.name) as span:
+            # 按token预算从最新的消息向前选取对话历史
+            lines, trimmed_tokens = self.context_builder.build(dialogue_history)
+            if span is not None:
+                span.set_attribute('history_messages', len(lines))
+                span.set_attribute('trimmed_tokens', trimmed_tokens)
+            # 对话历史的各行以换行连接，每条消息作为一个可去重的片段
+            history = [line + "\n" for line in lines[:-1]] + lines[-1:]
+            segments = render_template(self._parsed_template, {
+                'dialogue_history': history,
+                'user_input': user_input
+            })
+            return RenderedPrompt(segments, user_input, trimmed_tokens)
+
+    def _log_api_call(self, session_id: int, input_text: str, output: Tuple[str, int, int, int, Optional[str]],
+                      first_token_ms: Optional[int] = None, status: Optional[str] = None):
         """记录API调用日志
         Args:
             session_id: 会话ID
             input_text: 输入文本
             output: API调用返回的元组(输出文本, 响应时间, 输入tokens, 输出tokens, 错误信息)
+            first_token_ms: 首个token的到达时间（毫秒，仅流式调用）
+            status: 日志状态，为None时按是否有错误信息记为success或error；为error时抛出异常
         """
         output_text, response_time, input_tokens, output_tokens, error = output
+        status = status or ('error' if error else 'success')
+        self.last_usage = (input_tokens, output_tokens)
         db.add_system_log(
             session_id=session_id,
             agent_name=self.name,
@@ -50,15 +229,76 @@ class BaseAgent(ABC):
             input_tokens=input_tokens,
             output_tokens=output_tokens,
             model_name=self.model,
-            status='error' if error else 'success',
-            error_message=error
+            status=status,
+            error_message=error,
+            first_token_ms=first_token_ms,
+            input_segments=getattr(input_text, 'segments', None),
+            user_input=getattr(input_text, 'user_input', None),
+            context_trimmed_tokens=getattr(input_text, 'context_trimmed_tokens', None),
+            queue_wait_ms=api.last_queue_wait_ms(),
+            hedge_status=api.last_hedge_status()
         )
-        if error:
+        if status == 'error':
             raise Exception(error)
         return output_text
 
+    def _log_stream_call(self, session_id: int, input_text: str, done: Dict[str, Any]) -> str:
+        """记录流式API调用日志
+        Args:
+            session_id: 会话ID
+            input_text: 输入文本
+            done: 流式调用结束时的done事件
+        Returns:
+            str: 完整的输出文本
+        """
+        output = (done['text'], done['response_time_ms'], done['input_tokens'],
+                  done['output_tokens'], done['error'])
+        return self._log_api_call(session_id, input_text, output, first_token_ms=done['first_token_ms'])
+
+    @contextmanager
+    def _cancellable_call(self, session_id: int, input_text: str) -> Iterator[CallProgress]:
+        """包裹一次模型调用：调用被取消（客户端断开、发送了新消息或cancel帧）时，
+        以cancelled状态记录已收到的部分输出和估算的token数，然后继续向上传递取消
+        Args:
+            session_id: 会话ID
+            input_text: 输入文本
+        Yields:
+            CallProgress: 流式调用时用于记录已收到的输出片段
+        """
+        progress = CallProgress()
+        try:
+            yield progress
+        except (asyncio.CancelledError, GeneratorExit):
+            # 取消时拿不到服务端返回的token使用情况，按已收到的内容估算
+            output_text = "".join(progress.text_parts)
+            output_tokens = sum(estimate_tokens(part) for part in ("".join(progress.reasoning_parts), output_text) if part)
+            output = (output_text, int((time.time() - progress.start_time) * 1000),
+                      estimate_tokens(input_text), output_tokens, "调用已取消")
+            self._log_api_call(session_id, input_text, output, first_token_ms=progress.first_token_ms,
+                               status='cancelled')
+            raise
+
 class DispatcherAgent(BaseAgent):
     """调度Agent：决定使用哪个子系统回复"""
+    def __init__(self, config: Dict[str, Any]):
+        """初始化调度Agent，按配置启用本地路由
+        Args:
+            config: Agent的配置信息字典
+        """
+        super().__init__(config)
+        router_config = config.get('local_router') or {}
+        self.local_router = None
+        if router_config.get('enabled', False):
+            self.local_router = get_local_router(self.name, self.prompt_template, router_config)
+        # 调度决策缓存：键为归一化的用户输入加最近几条对话的摘要
+        cache_config = config.get('decision_cache') or {}
+        self.decision_cache = None
+        if cache_config.get('enabled', False):
+            self.decision_cache = get_decision_cache(cache_config)
+        self.cache_context_turns = cache_config.get('context_turns', 2)
+        # 正在进行的对照调用，保留引用避免任务被回收
+        self._shadow_tasks = set()
+
     def process(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> str:
         """处理用户输入，决定使用哪个子系统
         Args:
@@ -68,31 +308,194 @@ class DispatcherAgent(BaseAgent):
         Returns:
             str: 'sys1'或'sys2'，表示选择的子系统
         """
+        # 命中决策缓存时直接返回
+        cache_key = self._cache_key(user_input, dialogue_history)
+        cached = self._cached_decision(session_id, user_input, cache_key)
+        if cached:
+            return cached
+        
+        # 本地路由置信度足够时直接返回
+        local = self._route_locally(user_input)
+        if self._is_confident(local):
+            remote_label = None
+            if self._should_shadow():
+                prompt = self._build_prompt(user_input, dialogue_history)
+                remote_label = self._remote_label(session_id, prompt, api.call_intent(prompt))
+            self._log_local_decision(session_id, user_input, local, remote_label)
+            return local['label']
+        
         # 构建prompt，填充对话历史和用户输入
-        prompt = self.prompt_template.format(
-            dialogue_history=self._format_history(dialogue_history),
-            user_input=user_input
-        )
+        prompt = self._build_prompt(user_input, dialogue_history)
         # 调用通义意图识别模型并记录日志
         output = api.call_intent(prompt)
-        return self._log_api_call(session_id, prompt, output)
+        result = self._log_api_call(session_id, prompt, output)
+        return self._remote_decision(session_id, user_input, local, result, cache_key)
+
+    async def aprocess(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> str:
+        """异步决定使用哪个子系统，返回值与process一致"""
+        cache_key = self._cache_key(user_input, dialogue_history)
+        cached = self._cached_decision(session_id, user_input, cache_key)
+        if cached:
+            return cached
+        
+        local = self._route_locally(user_input)
+        if self._is_confident(local):
+            if self._should_shadow():
+                # 对照调用放在后台执行，不占用本轮的响应时间
+                prompt = self._build_prompt(user_input, dialogue_history)
+                task = asyncio.create_task(self._ashadow(session_id, user_input, prompt, local))
+                self._shadow_tasks.add(task)
+                task.add_done_callback(self._shadow_tasks.discard)
+            else:
+                self._log_local_decision(session_id, user_input, local, None)
+            return local['label']
+        
+        prompt = self._build_prompt(user_input, dialogue_history)
+        with self._cancellable_call(session_id, prompt):
+            output = await api.acall_intent(prompt)
+        result = self._log_api_call(session_id, prompt, output)
+        return self._remote_decision(session_id, user_input, local, result, cache_key)
 
-    def _format_history(self, history: List[Dict[str, str]]) -> str:
-        """格式化对话历史
+    def _cache_key(self, user_input: str, dialogue_history: List[Dict[str, str]]) -> Optional[str]:
+        """计算决策缓存的键
         Args:
-            history: 对话历史记录列表
+            user_input: 用户的输入文本
+            dialogue_history: 对话历史记录列表（可能已包含本轮用户输入）
+        Returns:
+            Optional[str]: 缓存键，未启用缓存时返回None
+        """
+        if self.decision_cache is None:
+            return None
+        history = dialogue_history
+        if history and history[-1].get('content') == user_input:
+            history = history[:-1]
+        context = history[-self.cache_context_turns:] if self.cache_context_turns > 0 else []
+        digest = hashlib.sha1()
+        for msg in context:
+            digest.update(f"{msg.get('role', '')}\x1f{msg.get('content', '')}\x1e".encode('utf-8'))
+        return f"{normalize_text(user_input)}|{digest.hexdigest()}"
+
+    def _cached_decision(self, session_id: int, user_input: str, cache_key: Optional[str]) -> Optional[str]:
+        """查询决策缓存，命中时记录路由日志
+        Returns:
+            Optional[str]: 缓存的决策，未命中时返回None
+        """
+        if cache_key is None:
+            return None
+        sync_decision_cache()
+        decision = self.decision_cache.get(cache_key)
+        if decision:
+            dispatch_decisions.inc(decision, 'cache')
+            db.add_routing_log(
+                session_id=session_id,
+                user_input=user_input,
+                source='cache',
+                final_label=decision
+            )
+        return decision
+
+    def _route_locally(self, user_input: str) -> Optional[Dict[str, Any]]:
+        """使用本地路由判断
+        Args:
+            user_input: 用户的输入文本
         Returns:
-            str: 格式化后的对话历史文本
+            Optional[Dict[str, Any]]: 本地判断结果，未启用或无法判断时返回None
         """
-        formatted = []
-        for msg in history:
-            role = msg.get('role', '')  # 获取发言角色
-            content = msg.get('content', '')  # 获取发言内容
-            formatted.append(f"{role}: {content}")  # 格式化为"角色: 内容"的形式
-        return "\n".join(formatted)  # 用换行符连接所有对话记录
+        if self.local_router is None:
+            return None
+        return self.local_router.route(user_input)
+
+    def _is_confident(self, local: Optional[Dict[str, Any]]) -> bool:
+        """本地判断的置信度是否达到阈值"""
+        return local is not None and local['confidence'] >= self.local_router.threshold
+
+    def _should_shadow(self) -> bool:
+        """是否对本次本地决策发起远程对照调用"""
+        return random.random() < self.local_router.shadow_rate
+
+    async def _ashadow(self, session_id: int, user_input: str, prompt: str, local: Dict[str, Any]):
+        """后台调用远程模型，记录与本地决策的一致性"""
+        remote_label = self._remote_label(session_id, prompt, await api.acall_intent(prompt, priority='background'))
+        self._log_local_decision(session_id, user_input, local, remote_label)
+        if remote_label:
+            self.local_router.learn(user_input, remote_label)
+
+    def _remote_label(self, session_id: int, prompt: str, output: Tuple[str, int, int, int, Optional[str]]) -> Optional[str]:
+        """记录对照调用的日志并解析远程模型的决策
+        Returns:
+            Optional[str]: 远程模型的路由结果，调用失败时返回None
+        """
+        try:
+            result = self._log_api_call(session_id, prompt, output)
+        except Exception:
+            return None
+        return parse_decision(result)
+
+    def _log_local_decision(self, session_id: int, user_input: str, local: Dict[str, Any],
+                            remote_label: Optional[str]):
+        """记录本地路由的决策"""
+        dispatch_decisions.inc(local['label'], 'local')
+        db.add_routing_log(
+            session_id=session_id,
+            user_input=user_input,
+            source='local',
+            final_label=local['label'],
+            local_label=local['label'],
+            local_tier=local['tier'],
+            confidence=local['confidence'],
+            remote_label=remote_label
+        )
+
+    def _remote_decision(self, session_id: int, user_input: str, local: Optional[Dict[str, Any]],
+                         result: str, cache_key: Optional[str]) -> str:
+        """解析远程模型的决策，写入缓存并更新本地路由
+        Args:
+            session_id: 会话ID
+            user_input: 用户的输入文本
+            local: 本地路由的判断结果
+            result: 远程模型返回的原始文本
+            cache_key: 决策缓存的键
+        Returns:
+            str: 'sys1'或'sys2'；无法解析时按原有逻辑交给sys2
+        """
+        decision = parse_decision(result)
+        if decision:
+            # 只缓存和学习格式规范的决策
+            if cache_key is not None:
+                self.decision_cache.set(cache_key, decision)
+            if self.local_router is not None:
+                self.local_router.learn(user_input, decision)
+        final_label = decision or 'sys2'
+        dispatch_decisions.inc(final_label, 'remote')
+        
+        if self.local_router is not None or self.decision_cache is not None:
+            db.add_routing_log(
+                session_id=session_id,
+                user_input=user_input,
+                source='remote',
+                final_label=final_label,
+                local_label=local['label'] if local else None,
+                local_tier=local['tier'] if local else None,
+                confidence=local['confidence'] if local else None,
+                remote_label=decision
+            )
+        return final_label
 
 class Sys1Agent(BaseAgent):
     """短链思考Agent：处理简单对话"""
+    def __init__(self, config: Dict[str, Any]):
+        """初始化短链思考Agent，按配置启用回复缓存
+        Args:
+            config: Agent的配置信息字典
+        """
+        super().__init__(config)
+        cache_config = config.get('response_cache') or {}
+        self.response_cache = None
+        if cache_config.get('enabled', False):
+            self.response_cache = get_response_cache(cache_config)
+        # 对话历史不超过该条数时才启用近似匹配（包含本轮用户输入）
+        self.near_duplicate_max_history = cache_config.get('near_duplicate_max_history', 1)
+
     def process(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> str:
         """处理用户输入，生成简短回复
         Args:
@@ -103,22 +506,102 @@ class Sys1Agent(BaseAgent):
             str: Agent的回复
         """
         # 构建prompt，填充对话历史和用户输入
-        prompt = self.prompt_template.format(
-            dialogue_history=self._format_history(dialogue_history),
-            user_input=user_input
-        )
+        prompt = self._build_prompt(user_input, dialogue_history)
+        # 命中回复缓存时不再调用模型
+        cached = self._cached_response(session_id, user_input, dialogue_history, prompt)
+        if cached is not None:
+            return cached
         # 调用通义千问模型并记录日志
         output = api.call_qwen(prompt)
-        return self._log_api_call(session_id, prompt, output)
+        response = self._log_api_call(session_id, prompt, output)
+        self._cache_response(user_input, dialogue_history, prompt, response)
+        return response
+
+    async def aprocess(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> str:
+        """异步生成简短回复，返回值与process一致"""
+        prompt = self._build_prompt(user_input, dialogue_history)
+        cached = self._cached_response(session_id, user_input, dialogue_history, prompt)
+        if cached is not None:
+            return cached
+        with self._cancellable_call(session_id, prompt):
+            output = await api.acall_qwen(prompt)
+        response = self._log_api_call(session_id, prompt, output)
+        self._cache_response(user_input, dialogue_history, prompt, response)
+        return response
 
-    def _format_history(self, history: List[Dict[str, str]]) -> str:
-        """格式化对话历史
+    async def astream(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> AsyncIterator[Dict[str, str]]:
+        """流式生成简短回复
         Args:
-            history: 对话历史记录列表
+            user_input: 用户的输入文本
+            dialogue_history: 对话历史记录列表
+            session_id: 当前会话ID
+        Yields:
+            Dict[str, str]: {"type": "delta", "content": 回复片段}，
+                最后一个事件为{"type": "done", "content": 完整回复}
+        """
+        prompt = self._build_prompt(user_input, dialogue_history)
+        cached = self._cached_response(session_id, user_input, dialogue_history, prompt)
+        if cached is not None:
+            yield {"type": "delta", "content": cached}
+            yield {"type": "done", "content": cached}
+            return
+        events = api.astream_qwen(prompt)
+        try:
+            with self._cancellable_call(session_id, prompt) as progress:
+                async for event in events:
+                    if event['type'] == 'content':
+                        progress.received(event['content'])
+                        yield {"type": "delta", "content": event['content']}
+                    elif event['type'] == 'done':
+                        break
+        finally:
+            # 被取消或提前关闭时关闭模型的事件流，中断HTTP请求
+            await events.aclose()
+        # 流结束后记录日志，出错时抛出异常
+        response = self._log_stream_call(session_id, prompt, event)
+        self._cache_response(user_input, dialogue_history, prompt, response)
+        yield {"type": "done", "content": response}
+
+    def _near_duplicate_input(self, user_input: str, dialogue_history: List[Dict[str, str]]) -> Optional[str]:
+        """对话历史足够短时返回用于近似匹配的用户输入，否则返回None"""
+        if len(dialogue_history) <= self.near_duplicate_max_history:
+            return user_input
+        return None
+
+    def _cached_response(self, session_id: int, user_input: str, dialogue_history: List[Dict[str, str]],
+                         prompt: str) -> Optional[str]:
+        """查询回复缓存，命中时以cache_hit状态和0 token写入系统日志
         Returns:
-            str: 格式化后的对话历史文本
+            Optional[str]: 缓存的回复，未启用或未命中时返回None
         """
-        return "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
+        if self.response_cache is None:
+            return None
+        start_time = time.time()
+        hit = self.response_cache.get(prompt, self._near_duplicate_input(user_input, dialogue_history))
+        if hit is None:
+            return None
+        response, _ = hit
+        self.last_usage = (0, 0)
+        db.add_system_log(
+            session_id=session_id,
+            agent_name=self.name,
+            input_text=prompt,
+            output_text=response,
+            response_time_ms=int((time.time() - start_time) * 1000),
+            input_tokens=0,
+            output_tokens=0,
+            model_name=self.model,
+            status='cache_hit',
+            input_segments=getattr(prompt, 'segments', None),
+            user_input=user_input,
+            context_trimmed_tokens=getattr(prompt, 'context_trimmed_tokens', None)
+        )
+        return response
+
+    def _cache_response(self, user_input: str, dialogue_history: List[Dict[str, str]], prompt: str, response: str):
+        """把模型回复写入缓存"""
+        if self.response_cache is not None and response:
+            self.response_cache.set(prompt, response, self._near_duplicate_input(user_input, dialogue_history))
 
 class Sys2Agent(BaseAgent):
     """长链思考Agent：处理需要深度思考的问题"""
@@ -132,10 +615,7 @@ class Sys2Agent(BaseAgent):
             Dict[str, str]: 包含思考过程和回复的字典，格式为{"thinking": "思考过程", "response": "最终回复"}
         """
         # 构建prompt，填充对话历史和用户输入
-        prompt = self.prompt_template.format(
-            dialogue_history=self._format_history(dialogue_history),
-            user_input=user_input
-        )
+        prompt = self._build_prompt(user_input, dialogue_history)
         # 调用DeepSeek R1模型并记录日志
         output = api.call_deepseek(prompt)
         # 获取完整的文本响应
@@ -147,14 +627,53 @@ class Sys2Agent(BaseAgent):
         # 分离思考过程和最终回复
         return self._split_response(response_text)
 
-    def _format_history(self, history: List[Dict[str, str]]) -> str:
-        """格式化对话历史
+    async def aprocess(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> Dict[str, str]:
+        """异步生成包含思考过程的回复，返回值与process一致"""
+        prompt = self._build_prompt(user_input, dialogue_history)
+        with self._cancellable_call(session_id, prompt):
+            output = await api.acall_deepseek(prompt)
+        self._log_api_call(session_id, prompt, output)
+        return self._split_response(output[0])
+
+    async def astream(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> AsyncIterator[Dict[str, str]]:
+        """流式生成包含思考过程的回复
+        推理内容和"[回复]"之前的文本作为思考过程片段，之后的文本作为回复片段
         Args:
-            history: 对话历史记录列表
-        Returns:
-            str: 格式化后的对话历史文本
+            user_input: 用户的输入文本
+            dialogue_history: 对话历史记录列表
+            session_id: 当前会话ID
+        Yields:
+            Dict[str, str]: {"type": "thinking-delta"|"response-delta", "content": 片段}，
+                最后一个事件为{"type": "done", "thinking": 思考过程, "response": 最终回复}
         """
-        return "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
+        prompt = self._build_prompt(user_input, dialogue_history)
+        parser = Sys2ResponseParser()
+        events = api.astream_deepseek(prompt)
+        try:
+            with self._cancellable_call(session_id, prompt) as progress:
+                async for event in events:
+                    if event['type'] == 'reasoning':
+                        progress.received(event['content'], reasoning=True)
+                        yield {"type": "thinking-delta", "content": event['content']}
+                    elif event['type'] == 'content':
+                        progress.received(event['content'])
+                        for kind, text in parser.feed(event['content']):
+                            yield {"type": f"{kind}-delta", "content": text}
+                    elif event['type'] == 'done':
+                        break
+        finally:
+            # 被取消或提前关闭时关闭模型的事件流，中断HTTP请求
+            await events.aclose()
+        self._log_stream_call(session_id, prompt, event)
+        for kind, text in parser.flush():
+            yield {"type": f"{kind}-delta", "content": text}
+        result = parser.result()
+        # 模型原生的推理内容也属于思考过程
+        if event['reasoning']:
+            result['thinking'] = "\n\n".join(
+                part for part in (event['reasoning'].strip(), result['thinking']) if part
+            )
+        yield {"type": "done", **result}
     
     def _split_response(self, response: str) -> Dict[str, str]:
         """分离思考过程和最终回复
@@ -163,9 +682,90 @@ class Sys2Agent(BaseAgent):
         Returns:
             Dict[str, str]: 包含思考过程和回复的字典
         """
+        parser = Sys2ResponseParser()
+        parser.feed(response)
+        return parser.result()
+
+class Sys2ResponseParser:
+    """sys2回复的增量解析器：在文本到达过程中识别"[回复]"分隔符"""
+    
+    # 思考过程与最终回复之间的分隔符
+    MARKER = "[回复]"
+    
+    def __init__(self):
+        """初始化解析器状态"""
+        self._chunks = []  # 已接收的文本片段，在result中拼接（逐段拼接字符串是平方复杂度）
+        self._pending = ""  # 尚未输出、可能是分隔符前缀的文本
+        self._in_response = False  # 是否已越过分隔符
+        self._response_started = False  # 回复片段是否已输出过非空白内容
+        
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        """接收一段新文本
+        Args:
+            chunk: 新到达的文本片段
+        Returns:
+            List[Tuple[str, str]]: 可以立即输出的片段列表，元素为("thinking"|"response", 文本)
+        """
+        self._chunks.append(chunk)
+        if self._in_response:
+            return self._response_piece(chunk)
+        
+        self._pending += chunk
+        index = self._pending.find(self.MARKER)
+        if index >= 0:
+            # 找到分隔符：之前的文本属于思考过程，之后的文本属于回复
+            before = self._pending[:index]
+            after = self._pending[index + len(self.MARKER):]
+            self._pending = ""
+            self._in_response = True
+            pieces = [("thinking", before)] if before else []
+            return pieces + self._response_piece(after)
+        
+        # 末尾可能是被拆开的分隔符，暂时保留：只需检查末尾几个字中最后一个分隔符首字符之后的部分
+        pending = self._pending
+        start = pending.rfind(self.MARKER[0], max(0, len(pending) - len(self.MARKER) + 1))
+        if start < 0 or not self.MARKER.startswith(pending[start:]):
+            start = len(pending)
+        self._pending = pending[start:]
+        ready = pending[:start]
+        return [("thinking", ready)] if ready else []
+        
+    def flush(self) -> List[Tuple[str, str]]:
+        """输出剩余的暂存文本
+        Returns:
+            List[Tuple[str, str]]: 剩余的片段列表
+        """
+        pending, self._pending = self._pending, ""
+        return [("thinking", pending)] if pending else []
+        
+    def _response_piece(self, text: str) -> List[Tuple[str, str]]:
+        """生成回复片段，去除分隔符后的前导空白
+        Args:
+            text: 分隔符之后的文本
+        Returns:
+            List[Tuple[str, str]]: 回复片段列表
+        """
+        if not self._response_started:
+            text = text.lstrip()
+            if not text:
+                return []
+            self._response_started = True
+        return [("response", text)]
+        
+    @property
+    def text(self) -> str:
+        """已接收的完整文本"""
+        return "".join(self._chunks)
+        
+    def result(self) -> Dict[str, str]:
+        """根据已接收的完整文本得到最终的思考过程和回复
+        Returns:
+            Dict[str, str]: 包含思考过程和回复的字典
+        """
+        response = "".join(self._chunks)
         # 查找"[回复]"分隔的内容，前面是思考过程，后面是回复
-        if "[回复]" in response:
-            parts = response.split("[回复]")
+        if self.MARKER in response:
+            parts = response.split(self.MARKER)
             thinking_part = parts[0].strip()
             response_part = parts[1].strip() if len(parts) > 1 else ""
         else:
@@ -185,3 +785,51 @@ class Sys2Agent(BaseAgent):
             "thinking": thinking_part,
             "response": response_part
         }
+
+class SummarizerAgent(BaseAgent):
+    """摘要Agent：把移出对话窗口的早期消息并入会话的滚动摘要"""
+    def __init__(self, config: Dict[str, Any]):
+        """初始化摘要Agent
+        Args:
+            config: Agent的配置信息字典
+        """
+        super().__init__(config)
+        # 移出窗口的消息累计到该条数时才更新一次摘要
+        self.batch_size = config.get('batch_size', 6)
+
+    def process(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> str:
+        """把一批早期消息并入摘要
+        Args:
+            user_input: 已有的会话摘要，没有时为空字符串
+            dialogue_history: 移出对话窗口的消息
+            session_id: 当前会话ID
+        Returns:
+            str: 更新后的会话摘要
+        """
+        prompt = self._build_summary_prompt(user_input, dialogue_history)
+        output = api.call_qwen(prompt)
+        return self._log_api_call(session_id, prompt, output).strip()
+
+    async def aprocess(self, user_input: str, dialogue_history: List[Dict[str, str]], session_id: int) -> str:
+        """异步把一批早期消息并入摘要，返回值与process一致"""
+        prompt = self._build_summary_prompt(user_input, dialogue_history)
+        # 摘要在后台更新，排队时让出资源给当前轮次的调用
+        output = await api.acall_qwen(prompt, priority='background')
+        return self._log_api_call(session_id, prompt, output).strip()
+
+    def _build_summary_prompt(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        """构建摘要prompt，填充已有摘要和新移出窗口的消息（不带思考过程）
+        Args:
+            summary: 已有的会话摘要
+            messages: 移出对话窗口的消息
+        Returns:
+            str: 完整的prompt文本
+        """
+        with tracer.span('prompt.format', agent=self.name):
+            lines, _ = self.context_builder.build(messages)
+            history = [line + "\n" for line in lines[:-1]] + lines[-1:]
+            segments = render_template(self._parsed_template, {
+                'summary': summary or '（暂无）',
+                'dialogue_history': history
+            })
+            return RenderedPrompt(segments)
@@ -0,0 +1,324 @@
+"""
+缓存模块
+提供带过期时间的LRU缓存，以及支持近似匹配和持久化的回复缓存
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from src.router import normalize_text
+
+
+class TTLCache:
+    """带过期时间的LRU缓存，记录命中和未命中次数"""
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: Optional[float] = None):
+        """初始化缓存
+        Args:
+            max_size: 最大条目数，超出时淘汰最久未使用的条目
+            ttl_seconds: 条目有效期（秒），为None时不过期
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """读取缓存
+        Args:
+            key: 缓存键
+        Returns:
+            Optional[Any]: 缓存的值，不存在或已过期时返回None
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """写入缓存
+        Args:
+            key: 缓存键
+            value: 缓存的值
+        """
+        expires_at = None
+        if self.ttl_seconds is not None:
+            expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> int:
+        """清空缓存
+        Returns:
+            int: 被清除的条目数
+        """
+        with self._lock:
+            count = len(self._data)
+            self._data.clear()
+            return count
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息
+        Returns:
+            Dict[str, Any]: 条目数、容量、命中次数、未命中次数和命中率
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def simhash(text: str, ngram: int = 2) -> Optional[int]:
+    """计算文本的64位SimHash，相似文本的汉明距离较小
+    Args:
+        text: 原始文本
+        ngram: 字符n-gram长度
+    Returns:
+        Optional[int]: 64位SimHash值；归一化后（去除标点、空白和表情）短于ngram时返回None，
+            这类输入（如"？"、"!!!"、表情）彼此无法区分，只能精确匹配
+    """
+    text = normalize_text(text)
+    if len(text) < ngram:
+        return None
+    grams = [text[i:i + ngram] for i in range(len(text) - ngram + 1)]
+    weights = [0] * 64
+    for gram in grams:
+        value = int.from_bytes(hashlib.md5(gram.encode('utf-8')).digest()[:8], 'big')
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    result = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            result |= 1 << bit
+    return result
+
+
+class ResponseCache:
+    """回复缓存：精确匹配prompt摘要，或按用户输入的SimHash近似匹配
+    同时按条目数和内存占用限制大小，超出时按LRU淘汰，可选持久化到SQLite
+    """
+
+    # SimHash分成4段，汉明距离不超过3的两个值至少有一段完全相同
+    BANDS = 4
+    # 每个条目除回复文本外的估算内存开销（字节）
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 16 * 1024 * 1024,
+                 max_distance: int = 3, persist_path: Optional[str] = None):
+        """初始化缓存
+        Args:
+            max_entries: 最大条目数
+            max_bytes: 最大内存占用（字节）
+            max_distance: 近似匹配允许的最大汉明距离
+            persist_path: SQLite持久化文件路径，为None时只缓存在内存中
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_distance = min(max_distance, self.BANDS - 1)
+        self._entries = OrderedDict()  # prompt摘要 -> (回复, SimHash或None, 占用字节)
+        self._bands = [dict() for _ in range(self.BANDS)]  # 每段的值 -> 条目摘要集合
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = {'exact': 0, 'near': 0}
+        self.misses = 0
+        
+        self._conn = None
+        if persist_path:
+            os.makedirs(os.path.dirname(os.path.abspath(persist_path)), exist_ok=True)
+            self._conn = sqlite3.connect(persist_path, check_same_thread=False)
+            self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS response_cache (
+                prompt_hash TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                simhash INTEGER,
+                last_used REAL NOT NULL
+            )
+            ''')
+            self._conn.commit()
+            self._load()
+
+    @staticmethod
+    def prompt_key(prompt: str) -> str:
+        """计算prompt的摘要，作为精确匹配的键"""
+        return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+    def _band_values(self, value: int) -> List[int]:
+        """把64位SimHash拆成若干段"""
+        width = 64 // self.BANDS
+        mask = (1 << width) - 1
+        return [(value >> (i * width)) & mask for i in range(self.BANDS)]
+
+    def get(self, prompt: str, user_input: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """查询缓存
+        Args:
+            prompt: 渲染后的完整prompt
+            user_input: 用户输入；提供时在精确匹配失败后尝试近似匹配（输入过短时只做精确匹配）
+        Returns:
+            Optional[Tuple[str, str]]: (回复, 命中层级exact/near)，未命中时返回None
+        """
+        key = self.prompt_key(prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._touch(key)
+                self.hits['exact'] += 1
+                return entry[0], 'exact'
+            
+            value = simhash(user_input) if user_input is not None else None
+            if value is not None:
+                candidates = set()
+                for band, band_value in zip(self._bands, self._band_values(value)):
+                    candidates.update(band.get(band_value, ()))
+                best = None
+                for candidate in candidates:
+                    distance = bin(self._entries[candidate][1] ^ value).count('1')
+                    if distance <= self.max_distance and (best is None or distance < best[0]):
+                        best = (distance, candidate)
+                if best is not None:
+                    self._touch(best[1])
+                    self.hits['near'] += 1
+                    return self._entries[best[1]][0], 'near'
+            
+            self.misses += 1
+            return None
+
+    def set(self, prompt: str, response: str, user_input: Optional[str] = None):
+        """写入缓存
+        Args:
+            prompt: 渲染后的完整prompt
+            response: 模型回复
+            user_input: 用户输入；提供时同时加入近似匹配索引
+        """
+        key = self.prompt_key(prompt)
+        value = simhash(user_input) if user_input is not None else None
+        with self._lock:
+            self._store(key, response, value)
+            if self._conn is not None:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)',
+                    (key, response, self._to_signed(value), time.time())
+                )
+                self._conn.commit()
+
+    def _store(self, key: str, response: str, value: Optional[int]):
+        """写入内存并按容量淘汰，调用方需持有锁"""
+        if key in self._entries:
+            self._remove(key)
+        size = len(response.encode('utf-8')) + self.ENTRY_OVERHEAD
+        self._entries[key] = (response, value, size)
+        self._bytes += size
+        if value is not None:
+            for band, band_value in zip(self._bands, self._band_values(value)):
+                band.setdefault(band_value, set()).add(key)
+        
+        evicted = []
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            evicted.append((oldest,))
+        if evicted and self._conn is not None:
+            self._conn.executemany('DELETE FROM response_cache WHERE prompt_hash = ?', evicted)
+
+    def _remove(self, key: str):
+        """从内存和近似匹配索引中删除条目，调用方需持有锁"""
+        response, value, size = self._entries.pop(key)
+        self._bytes -= size
+        if value is not None:
+            for band, band_value in zip(self._bands, self._band_values(value)):
+                keys = band.get(band_value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del band[band_value]
+
+    def _touch(self, key: str):
+        """标记条目最近被使用，调用方需持有锁
+        命中时只调整内存中的顺序，不写SQLite，避免每次命中都提交事务
+        """
+        self._entries.move_to_end(key)
+
+    def _load(self):
+        """从SQLite加载最近使用的条目"""
+        rows = self._conn.execute(
+            'SELECT prompt_hash, response, simhash FROM response_cache ORDER BY last_used DESC LIMIT ?',
+            (self.max_entries,)
+        ).fetchall()
+        with self._lock:
+            # 按从旧到新的顺序写入，使LRU顺序与持久化的使用时间一致
+            for key, response, value in reversed(rows):
+                self._store(key, response, self._to_unsigned(value))
+            self._conn.commit()
+
+    @staticmethod
+    def _to_signed(value: Optional[int]) -> Optional[int]:
+        """SQLite只支持有符号64位整数"""
+        if value is None:
+            return None
+        return value - (1 << 64) if value >= 1 << 63 else value
+
+    @staticmethod
+    def _to_unsigned(value: Optional[int]) -> Optional[int]:
+        if value is None:
+            return None
+        return value + (1 << 64) if value < 0 else value
+
+    def clear(self) -> int:
+        """清空缓存（包括持久化的条目）
+        Returns:
+            int: 被清除的条目数
+        """
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._bands = [dict() for _ in range(self.BANDS)]
+            self._bytes = 0
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM response_cache')
+                self._conn.commit()
+            return count
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息
+        Returns:
+            Dict[str, Any]: 条目数、内存占用、各层命中次数和命中率
+        """
+        with self._lock:
+            hits = self.hits['exact'] + self.hits['near']
+            total = hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'exact_hits': self.hits['exact'],
+                'near_hits': self.hits['near'],
+                'misses': self.misses,
+                'hit_rate': hits / total if total else 0.0
+            }
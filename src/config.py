@@ -1,11 +1,42 @@
 """
 配置管理模块
 负责加载和解析配置文件
+
+解析结果按文件路径在进程内共享，每次创建Config时只检查文件的修改时间和大小，
+文件修改后才重新解析（热加载）；重新解析时整体替换为新的字典，已取得的旧配置不受影响。
+共享的配置字典应视为只读，不要原地修改。
 """
 import os
-from typing import Dict, Any, Optional
+import threading
+from typing import Dict, Any, Optional, Tuple
 import yaml
 
+# 进程内共享的解析结果：配置文件路径 -> ((修改时间, 文件大小), 配置字典)
+_loaded: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+_loaded_lock = threading.Lock()
+
+def load_config(config_path: str) -> Dict[str, Any]:
+    """读取配置文件，文件未修改时直接返回共享的解析结果
+    Args:
+        config_path: 配置文件路径
+    Returns:
+        Dict[str, Any]: 配置字典（只读）
+    """
+    path = os.path.abspath(config_path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _loaded_lock:
+        cached = _loaded.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+    # 首次读取或文件已修改，重新解析
+    with open(path, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f) or {}
+    with _loaded_lock:
+        _loaded[path] = (version, config)
+    return config
+
 class Config:
     """配置管理类：负责加载和解析配置文件"""
     
@@ -21,9 +52,8 @@ class Config:
             # 构建默认配置文件路径
             config_path = os.path.join(os.path.dirname(current_dir), 'config', 'prompt_config.yaml')
             
-        # 加载配置文件
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = yaml.safe_load(f)
+        # 加载配置文件（进程内共享，文件修改后自动重新解析）
+        self.config = load_config(config_path)
             
     def get_agents_config(self) -> Dict[str, Any]:
         """获取所有Agent的配置
@@ -31,3 +61,10 @@ class Config:
             Dict[str, Any]: 包含所有Agent配置的字典
         """
         return self.config.get('agents', {})
+
+    def get_runtime_config(self) -> Dict[str, Any]:
+        """获取运行时配置（流式输出等开关）
+        Returns:
+            Dict[str, Any]: 运行时配置字典
+        """
+        return self.config.get('runtime', {}) or {}
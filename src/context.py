@@ -0,0 +1,132 @@
+"""
+对话上下文模块
+按各Agent的token预算从对话历史中选取消息：最早的消息先被丢弃，非sys2的Agent不带sys2的思考过程
+
+对话管理器每轮把对话历史包装为FormattedHistory传给各Agent，每条消息的"角色: 内容"文本和估算token数
+只计算一次，由调度Agent、sys1和sys2共用
+"""
+import functools
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# 中日韩文字和全角标点的连续片段，通义千问/DeepSeek的分词器中大多一字一个token
+_CJK_RUN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]+')
+
+# 其余文本按英文单词/数字串和单个符号切分
+_PIECE = re.compile(r'[A-Za-z0-9]+|\S')
+
+
+@functools.lru_cache(maxsize=8192)
+def estimate_tokens(text: str) -> int:
+    """在本地估算文本的token数，不依赖模型的分词器
+    中文按一字一个token，英文单词和数字串约每4个字符一个token，其他符号各一个token；
+    对话历史中的消息每轮都会重复计算，因此按文本缓存结果
+    Args:
+        text: 文本
+    Returns:
+        int: 估算的token数
+    """
+    # 按连续片段替换为空格，中文字数 = 减少的字符数 + 片段数；比逐字匹配快得多
+    rest, runs = _CJK_RUN.subn(' ', text)
+    tokens = len(text) - len(rest) + runs
+    for piece in _PIECE.findall(rest):
+        tokens += (len(piece) + 3) // 4 if piece[0].isascii() and piece[0].isalnum() else 1
+    return tokens
+
+
+def message_content(msg: Dict[str, Any], include_thinking: bool) -> str:
+    """获取放入prompt的消息内容
+    Args:
+        msg: 对话历史中的消息，sys2的回复带有thinking字段
+        include_thinking: 是否带上思考过程
+    Returns:
+        str: 消息内容；带思考过程时格式为"思考过程\n\n回复"
+    """
+    content = msg.get('content', '')
+    thinking = msg.get('thinking')
+    if include_thinking and thinking:
+        return f"{thinking}\n\n{content}"
+    return content
+
+
+def format_message(msg: Dict[str, Any], include_thinking: bool = False) -> str:
+    """把一条消息格式化为prompt中对话历史的一行
+    Args:
+        msg: 对话历史中的消息
+        include_thinking: 是否带上思考过程
+    Returns:
+        str: "角色: 内容"
+    """
+    return f"{msg.get('role', '')}: {message_content(msg, include_thinking)}"
+
+
+class FormattedHistory(list):
+    """一轮对话中各Agent共用的对话历史
+    本身是消息列表，另外按是否带思考过程缓存每条消息的格式化文本和估算token数；构建后不应再修改
+    """
+
+    def __init__(self, messages: Iterable[Dict[str, Any]] = ()):
+        super().__init__(messages)
+        self._formatted = {}  # 是否带思考过程 -> (格式化文本列表, token数列表)
+
+    @classmethod
+    def of(cls, history: List[Dict[str, Any]]) -> 'FormattedHistory':
+        """包装对话历史，已经包装过时直接返回"""
+        return history if isinstance(history, cls) else cls(history)
+
+    def formatted(self, include_thinking: bool) -> Tuple[List[str], List[int]]:
+        """获取每条消息的格式化文本和估算token数
+        Args:
+            include_thinking: 是否带上思考过程
+        Returns:
+            Tuple[List[str], List[int]]: (每条消息的"角色: 内容", 每条消息的估算token数)
+        """
+        cached = self._formatted.get(include_thinking)
+        if cached is None:
+            lines = [format_message(msg, include_thinking) for msg in self]
+            cached = (lines, [estimate_tokens(line) for line in lines])
+            self._formatted[include_thinking] = cached
+        return cached
+
+
+class ContextBuilder:
+    """按token预算选取对话历史"""
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        """初始化
+        Args:
+            config: Agent的context配置
+                - max_tokens: 对话历史的token预算，为空时不限制
+                - include_thinking: 是否保留sys2回复的思考过程
+        """
+        config = config or {}
+        self.max_tokens = config.get('max_tokens')
+        self.include_thinking = config.get('include_thinking', False)
+
+    def build(self, history: List[Dict[str, Any]]) -> Tuple[List[str], int]:
+        """从最新的消息开始向前选取，直到用完token预算
+        标记了pinned的消息（如会话摘要）总是保留并先占用预算，其余消息中最新的一条总是保留
+        Args:
+            history: 对话历史（按时间顺序），可以是FormattedHistory，以复用其他Agent已格式化的结果
+        Returns:
+            Tuple[List[str], int]: (选取的消息格式化后的"角色: 内容"，按时间顺序, 与完整历史相比省去的估算token数)
+        """
+        history = FormattedHistory.of(history)
+        lines, tokens = history.formatted(self.include_thinking)
+        keep = [bool(msg.get('pinned')) for msg in history]
+        used = sum(count for count, pinned in zip(tokens, keep) if pinned)
+        
+        selected_any = False
+        for index in reversed(range(len(history))):
+            if keep[index]:
+                continue
+            if selected_any and self.max_tokens is not None and used + tokens[index] > self.max_tokens:
+                # 预算已用完，更早的消息全部丢弃
+                break
+            keep[index] = True
+            used += tokens[index]
+            selected_any = True
+        
+        full = sum(history.formatted(True)[1])
+        selected = [line for line, kept in zip(lines, keep) if kept]
+        return selected, full - used
@@ -2,19 +2,125 @@
 数据库管理模块
 负责对话历史和系统日志的存储与检索
 """
+import asyncio
+import atexit
+import base64
+import json
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
 from typing import Dict, List, Any, Optional
-from datetime import datetime
+from datetime import datetime, timedelta
+from src.config import Config
+from src.prompt_store import PromptStore, decompress, join_ref, parse_ref, split_rendered
+from src.metrics import db_write_batch_size, db_write_seconds, db_writes_dropped, queue_depth
+from src.tracing import Span, tracer
+
+# 当前任务中尚未完成的写入：batched写入等待提交，队列已满时的写入等待进入队列（事件循环中的写入不阻塞，由wait_for_writes统一等待）
+_pending_writes: ContextVar[Optional[List[asyncio.Future]]] = ContextVar('pending_writes', default=None)
+
+# 从写入语句中提取表名，作为db.write span的属性
+_WRITE_TABLE = re.compile(r'\b(?:INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+
+# 日志汇总的时间粒度：(时间桶起点的SQL表达式，{column}为时间列, 桶的秒数)
+ROLLUP_GRANULARITIES = {
+    'minute': ("substr({column}, 1, 16) || ':00'", 60),
+    'hour': ("substr({column}, 1, 13) || ':00:00'", 3600),
+    'day': ("substr({column}, 1, 10)", 86400),
+}
+
+# 未指定开始时间时，各粒度默认返回的时间桶数
+DEFAULT_ROLLUP_BUCKETS = {'minute': 60, 'hour': 48, 'day': 30}
+
+# 响应时间直方图各桶的上界（毫秒），超过最后一个上界的计入溢出桶
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000,
+                      5000, 7500, 10000, 15000, 20000, 30000, 60000, 120000]
+
+def histogram_quantile(quantile: float, counts: List[int]) -> Optional[float]:
+    """根据响应时间直方图估算分位数，桶内按线性插值
+    Args:
+        quantile: 分位数（0~1）
+        counts: 各桶的计数，长度为len(LATENCY_BUCKETS_MS) + 1，最后一个为溢出桶
+    Returns:
+        Optional[float]: 估算的分位数（毫秒），没有样本时返回None
+    """
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = quantile * total
+    cumulative = 0
+    for index, count in enumerate(counts):
+        if count and cumulative + count >= rank:
+            lower = LATENCY_BUCKETS_MS[index - 1] if index > 0 else 0
+            if index >= len(LATENCY_BUCKETS_MS):
+                # 溢出桶没有上界，返回其下界
+                return float(lower)
+            upper = LATENCY_BUCKETS_MS[index]
+            return lower + (upper - lower) * (rank - cumulative) / count
+        cumulative += count
+    return float(LATENCY_BUCKETS_MS[-1])
 
 class Database:
     """数据库管理类"""
     
-    def __init__(self, db_path: Optional[str] = None):
+    # 支持的写入持久性设置
+    DURABILITY_MODES = ('sync', 'batched', 'async')
+    
+    # 日志列表可返回的字段及对应的SQL表达式
+    LOG_FIELDS = {
+        'log_id': 'l.log_id',
+        'session_id': 'l.session_id',
+        'timestamp': 'l.timestamp',
+        'agent_name': 'l.agent_name',
+        'input_text': 'l.input_text',
+        'user_input': 'l.user_input',
+        'output_text': 'l.output_text',
+        'output_preview': 'substr(l.output_text, 1, 200)',
+        'response_time_ms': 'l.response_time_ms',
+        'input_tokens': 'l.input_tokens',
+        'output_tokens': 'l.output_tokens',
+        'model_name': 'l.model_name',
+        'status': 'l.status',
+        'error_message': 'l.error_message',
+        'session_start_time': 's.start_time',
+        'first_token_ms': 'l.first_token_ms',
+        'trace_id': 'l.trace_id',
+        'context_trimmed_tokens': 'l.context_trimmed_tokens',
+        'queue_wait_ms': 'l.queue_wait_ms',
+        'hedge_status': 'l.hedge_status',
+    }
+    
+    # 不指定字段时返回的字段（兼容原有的get_logs）
+    DEFAULT_LOG_FIELDS = [name for name in LOG_FIELDS if name != 'output_preview']
+    
+    def __init__(self, db_path: Optional[str] = None, durability: str = 'sync',
+                 batch_size: int = 100, flush_interval_ms: int = 50, max_queue: int = 10000,
+                 busy_timeout_ms: int = 5000, mmap_size: int = 256 * 1024 * 1024,
+                 dedupe_prompts: bool = True, prompt_codec: str = 'auto'):
         """初始化数据库连接
         Args:
             db_path: 数据库文件路径，如果为None则使用默认路径
+            durability: 写入持久性设置
+                - sync: 每次写入立即提交
+                - batched: 写入交给后台线程批量提交，调用方等待所在批次提交完成；
+                  在事件循环中写入时不阻塞，由wait_for_writes等待本任务的写入提交完成
+                - async: 写入交给后台线程批量提交，调用方不等待（进程崩溃时可能丢失最近的写入）
+            batch_size: 后台线程每批最多提交的条数
+            flush_interval_ms: 后台线程凑批的最长等待时间（毫秒）
+            max_queue: 写入队列的最大长度。队列满时其他线程的写入方阻塞；事件循环中的写入进入同样长度的溢出队列，
+                调用方在wait_for_writes中等待写入进入队列，溢出队列也满时丢弃写入并计入db_writes_dropped
+            busy_timeout_ms: 数据库被锁定时的最长等待时间（毫秒）
+            mmap_size: 内存映射I/O的大小（字节），为0时不使用
+            dedupe_prompts: 是否把prompt按片段去重压缩存储，system_logs中只保存片段引用
+            prompt_codec: prompt片段的压缩算法（auto/zstd/zlib/raw）
         """
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"不支持的持久性设置: {durability}")
         if db_path is None:
             # 获取当前文件所在目录
             current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -25,12 +131,67 @@ class Database:
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
             
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path)
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.prompt_store = PromptStore(prompt_codec) if dedupe_prompts else None
+        
+        # 写连接：在调用方线程和后台写入线程之间共享，由锁保护
+        self.conn = self._connect()
+        self.conn.execute('PRAGMA journal_mode=WAL')  # WAL模式下读操作不会阻塞写操作
         self.cursor = self.conn.cursor()
+        self._lock = threading.RLock()
+        
+        # 读连接：每个线程一个只读连接，查询不需要等待写锁
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
         
         # 初始化数据库表
         self._init_tables()
         
+        # 写入队列和后台写入线程
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval_ms = flush_interval_ms
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._writer = None
+        # 溢出队列：写入队列已满时事件循环中的写入在此等待，由后台写入线程在提交一批之后移入写入队列
+        self._overflow = deque()  # (写入, 进入队列时完成的asyncio.Future)
+        self._overflow_lock = threading.Lock()
+        self._dropping = False  # 正在丢弃写入，溢出队列清空前只打印一次
+        if durability != 'sync':
+            self._writer = threading.Thread(target=self._writer_loop, name='db-writer', daemon=True)
+            self._writer.start()
+        
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """创建并配置一个数据库连接
+        Args:
+            read_only: 是否为只读连接
+        Returns:
+            sqlite3.Connection: 数据库连接
+        """
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               timeout=self.busy_timeout_ms / 1000)
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA synchronous=NORMAL')  # WAL模式下只在检查点时fsync
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        if read_only:
+            conn.execute('PRAGMA query_only=1')
+        return conn
+        
+    def _reader(self) -> sqlite3.Connection:
+        """获取当前线程的只读连接，不存在时创建
+        Returns:
+            sqlite3.Connection: 只读连接
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+        
     def _init_tables(self):
         """初始化数据库表"""
         # 对话会话表
@@ -39,7 +200,9 @@ class Database:
             session_id INTEGER PRIMARY KEY AUTOINCREMENT,
             start_time DATETIME NOT NULL,
             end_time DATETIME,
-            status TEXT DEFAULT 'active'
+            status TEXT DEFAULT 'active',
+            summary TEXT,
+            summary_updated_at DATETIME
         )
         ''')
         
@@ -51,6 +214,7 @@ class Database:
             timestamp DATETIME NOT NULL,
             role TEXT NOT NULL,
             content TEXT NOT NULL,
+            thinking TEXT,
             FOREIGN KEY (session_id) REFERENCES sessions(session_id)
         )
         ''')
@@ -70,96 +234,782 @@ class Database:
             model_name TEXT NOT NULL,
             status TEXT NOT NULL,
             error_message TEXT,
+            first_token_ms INTEGER,
+            user_input TEXT,
+            input_ref BLOB,
+            trace_id TEXT,
+            context_trimmed_tokens INTEGER,
+            queue_wait_ms INTEGER,
+            hedge_status TEXT,
             FOREIGN KEY (session_id) REFERENCES sessions(session_id)
         )
         ''')
         
+        # 推测调度日志表
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS speculation_logs (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            timestamp DATETIME NOT NULL,
+            dispatcher_decision TEXT NOT NULL,
+            hit INTEGER NOT NULL,
+            sys1_status TEXT NOT NULL,
+            wasted_input_tokens INTEGER NOT NULL,
+            wasted_output_tokens INTEGER NOT NULL,
+            FOREIGN KEY (session_id) REFERENCES sessions(session_id)
+        )
+        ''')
+        
+        # 路由日志表：记录本地/远程路由的决策来源、置信度和一致性
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS routing_logs (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            timestamp DATETIME NOT NULL,
+            user_input TEXT NOT NULL,
+            source TEXT NOT NULL,
+            local_label TEXT,
+            local_tier TEXT,
+            confidence REAL,
+            remote_label TEXT,
+            final_label TEXT NOT NULL,
+            agree INTEGER,
+            FOREIGN KEY (session_id) REFERENCES sessions(session_id)
+        )
+        ''')
+        
+        # 为旧版本数据库补充新增的列
+        self._ensure_column('system_logs', 'first_token_ms', 'INTEGER')
+        
         self.conn.commit()
         
+        # 执行尚未执行的数据库迁移
+        self._migrate()
+        
+    def _migrate(self):
+        """按PRAGMA user_version依次执行尚未执行的迁移
+        多个worker同时启动时，每个迁移在BEGIN IMMEDIATE事务中重新读取user_version，
+        已被其他进程执行的迁移直接跳过；某个迁移失败时回滚并抛出异常
+        """
+        migrations = [
+            self._add_log_indexes,
+            self._add_log_fts,
+            self._add_prompt_refs,
+            self._add_log_rollups,
+            self._add_trace_spans,
+            self._add_context_columns,
+            self._add_session_summary,
+            self._add_message_id_index,
+            self._add_queue_wait_column,
+            self._add_hedge_status_column,
+        ]
+        for target, migration in enumerate(migrations, start=1):
+            if self.conn.execute('PRAGMA user_version').fetchone()[0] >= target:
+                continue
+            self._begin_immediate()
+            try:
+                # 持有写锁后重新读取版本，其他进程可能已经执行了该迁移
+                if self.conn.execute('PRAGMA user_version').fetchone()[0] < target:
+                    migration()
+                    self.conn.execute(f'PRAGMA user_version={target}')
+                self.conn.commit()
+            except sqlite3.OperationalError as e:
+                self.conn.rollback()
+                raise RuntimeError(f"数据库迁移{target}失败: {str(e)}") from e
+        
+        # FTS5或trigram分词器不可用时，搜索退回到LIKE
+        self.fts_enabled = bool(self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'system_logs_fts'"
+        ).fetchone())
+        
+    def _begin_immediate(self, max_wait_seconds: float = 600):
+        """开始一个立即获取写锁的事务
+        其他进程执行耗时的迁移（如为大量日志建立全文索引）时可能超过busy_timeout，此时继续等待
+        Args:
+            max_wait_seconds: 最长等待时间（秒）
+        """
+        deadline = time.monotonic() + max_wait_seconds
+        while True:
+            try:
+                self.conn.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or time.monotonic() >= deadline:
+                    raise
+        
+    def _add_log_indexes(self):
+        """迁移1：为按时间和会话查询的字段建立索引"""
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_system_logs_timestamp ON system_logs(timestamp)')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_system_logs_session_timestamp ON system_logs(session_id, timestamp)'
+        )
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_messages_session_timestamp ON messages(session_id, timestamp)'
+        )
+        
+    def _add_log_fts(self):
+        """迁移2：为日志的输入输出建立全文索引
+        使用trigram分词器，中文无需分词即可检索任意3个字符以上的片段；触发器保持索引与system_logs同步
+        """
+        if self._fts_available():
+            self._create_log_fts(['input_text', 'output_text'])
+        
+    def _add_prompt_refs(self):
+        """迁移3：prompt改为按片段去重压缩存储
+        system_logs增加用户输入和片段引用列，全文索引改为同时检索用户输入
+        """
+        self._ensure_column('system_logs', 'user_input', 'TEXT')
+        self._ensure_column('system_logs', 'input_ref', 'BLOB')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS prompt_blobs (
+            hash BLOB PRIMARY KEY,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            raw_size INTEGER NOT NULL
+        )
+        ''')
+        if self._fts_available():
+            for trigger in ('insert', 'delete', 'update'):
+                self.conn.execute(f'DROP TRIGGER IF EXISTS system_logs_fts_{trigger}')
+            self.conn.execute('DROP TABLE IF EXISTS system_logs_fts')
+            self._create_log_fts(['input_text', 'user_input', 'output_text'])
+        
+    def _add_log_rollups(self):
+        """迁移4：按分钟/小时/天汇总调用次数、错误数、token数和响应时间直方图
+        汇总表由插入触发器增量维护，统计查询只需读取时间桶，不需要扫描system_logs
+        """
+        self.conn.execute('''
+        CREATE TABLE log_rollups (
+            granularity TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            agent_name TEXT NOT NULL,
+            model_name TEXT NOT NULL,
+            calls INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            input_tokens INTEGER NOT NULL,
+            output_tokens INTEGER NOT NULL,
+            response_time_sum INTEGER NOT NULL,
+            PRIMARY KEY (granularity, bucket_start, agent_name, model_name)
+        ) WITHOUT ROWID
+        ''')
+        self.conn.execute('''
+        CREATE TABLE log_rollup_latency (
+            granularity TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            agent_name TEXT NOT NULL,
+            model_name TEXT NOT NULL,
+            bin INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (granularity, bucket_start, agent_name, model_name, bin)
+        ) WITHOUT ROWID
+        ''')
+        # 直方图各桶的上界，供触发器计算响应时间所在的桶
+        self.conn.execute('CREATE TABLE latency_bins (bin INTEGER PRIMARY KEY, upper_ms INTEGER NOT NULL)')
+        self.conn.executemany('INSERT INTO latency_bins VALUES (?, ?)', list(enumerate(LATENCY_BUCKETS_MS)))
+        
+        overflow = len(LATENCY_BUCKETS_MS)
+        bin_sql = (f"COALESCE((SELECT MIN(bin) FROM latency_bins WHERE upper_ms >= {{column}}), {overflow})")
+        
+        # 用已有的日志初始化汇总表
+        for granularity, (bucket_sql, _) in ROLLUP_GRANULARITIES.items():
+            bucket = bucket_sql.format(column='timestamp')
+            self.conn.execute(f'''
+            INSERT INTO log_rollups
+            SELECT ?, {bucket}, agent_name, model_name, COUNT(*), SUM(status = 'error'),
+                   SUM(input_tokens), SUM(output_tokens), SUM(response_time_ms)
+            FROM system_logs
+            GROUP BY 2, 3, 4
+            ''', (granularity,))
+            self.conn.execute(f'''
+            INSERT INTO log_rollup_latency
+            SELECT ?, {bucket}, agent_name, model_name, {bin_sql.format(column='response_time_ms')}, COUNT(*)
+            FROM system_logs
+            GROUP BY 2, 3, 4, 5
+            ''', (granularity,))
+        
+        # 插入日志时同时更新三个粒度的汇总
+        buckets = ' UNION ALL '.join(
+            f"SELECT '{granularity}' AS granularity, {bucket_sql.format(column='new.timestamp')} AS bucket_start"
+            for granularity, (bucket_sql, _) in ROLLUP_GRANULARITIES.items()
+        )
+        self.conn.execute(f'''
+        CREATE TRIGGER system_logs_rollup AFTER INSERT ON system_logs BEGIN
+            INSERT INTO log_rollups
+            SELECT g.granularity, g.bucket_start, new.agent_name, new.model_name, 1, new.status = 'error',
+                   new.input_tokens, new.output_tokens, new.response_time_ms
+            FROM ({buckets}) g
+            WHERE true
+            ON CONFLICT DO UPDATE SET
+                calls = calls + 1,
+                errors = errors + excluded.errors,
+                input_tokens = input_tokens + excluded.input_tokens,
+                output_tokens = output_tokens + excluded.output_tokens,
+                response_time_sum = response_time_sum + excluded.response_time_sum;
+            INSERT INTO log_rollup_latency
+            SELECT g.granularity, g.bucket_start, new.agent_name, new.model_name,
+                   {bin_sql.format(column='new.response_time_ms')}, 1
+            FROM ({buckets}) g
+            WHERE true
+            ON CONFLICT DO UPDATE SET count = count + 1;
+        END
+        ''')
+        
+    def _add_trace_spans(self):
+        """迁移5：记录每轮对话的链路追踪span，system_logs记录所属的trace"""
+        self._ensure_column('system_logs', 'trace_id', 'TEXT')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS trace_spans (
+            trace_id TEXT NOT NULL,
+            span_id TEXT NOT NULL,
+            parent_id TEXT,
+            session_id INTEGER,
+            name TEXT NOT NULL,
+            start_time REAL NOT NULL,
+            duration_ms REAL NOT NULL,
+            status TEXT NOT NULL,
+            message TEXT,
+            attributes TEXT,
+            PRIMARY KEY (trace_id, span_id)
+        ) WITHOUT ROWID
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_trace_spans_start_time ON trace_spans(start_time)')
+        
+    def _add_context_columns(self):
+        """迁移6：sys2回复的思考过程单独存储，日志记录对话历史按token预算省去的token数"""
+        self._ensure_column('messages', 'thinking', 'TEXT')
+        self._ensure_column('system_logs', 'context_trimmed_tokens', 'INTEGER')
+        
+    def _add_session_summary(self):
+        """迁移7：会话增加滚动摘要，保存移出对话窗口的早期消息的要点"""
+        self._ensure_column('sessions', 'summary', 'TEXT')
+        self._ensure_column('sessions', 'summary_updated_at', 'DATETIME')
+        
+    def _add_message_id_index(self):
+        """迁移8：按会话和message_id增量读取新消息，用于更新检索索引"""
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_messages_session_message_id ON messages(session_id, message_id)'
+        )
+        
+    def _add_queue_wait_column(self):
+        """迁移9：日志记录模型调用在调度器中排队的时间，与响应时间分开"""
+        self._ensure_column('system_logs', 'queue_wait_ms', 'INTEGER')
+        
+    def _add_hedge_status_column(self):
+        """迁移10：日志记录是否发出了对冲请求，以及哪个请求先成功"""
+        self._ensure_column('system_logs', 'hedge_status', 'TEXT')
+        
+    def _fts_available(self) -> bool:
+        """检查SQLite是否支持FTS5和trigram分词器"""
+        try:
+            self.conn.execute("CREATE VIRTUAL TABLE temp.fts_probe USING fts5(x, tokenize='trigram')")
+            self.conn.execute('DROP TABLE temp.fts_probe')
+            return True
+        except sqlite3.OperationalError:
+            return False
+        
+    def _create_log_fts(self, columns: List[str]):
+        """创建system_logs的外部内容全文索引及同步触发器，并为已有日志建立索引
+        Args:
+            columns: 建立索引的列
+        """
+        names = ', '.join(columns)
+        new_values = ', '.join(f'new.{column}' for column in columns)
+        old_values = ', '.join(f'old.{column}' for column in columns)
+        self.conn.execute(f'''
+        CREATE VIRTUAL TABLE system_logs_fts USING fts5(
+            {names},
+            content='system_logs', content_rowid='log_id',
+            tokenize='trigram'
+        )
+        ''')
+        self.conn.execute(f'''
+        CREATE TRIGGER system_logs_fts_insert AFTER INSERT ON system_logs BEGIN
+            INSERT INTO system_logs_fts(rowid, {names})
+            VALUES (new.log_id, {new_values});
+        END
+        ''')
+        self.conn.execute(f'''
+        CREATE TRIGGER system_logs_fts_delete AFTER DELETE ON system_logs BEGIN
+            INSERT INTO system_logs_fts(system_logs_fts, rowid, {names})
+            VALUES ('delete', old.log_id, {old_values});
+        END
+        ''')
+        self.conn.execute(f'''
+        CREATE TRIGGER system_logs_fts_update AFTER UPDATE ON system_logs BEGIN
+            INSERT INTO system_logs_fts(system_logs_fts, rowid, {names})
+            VALUES ('delete', old.log_id, {old_values});
+            INSERT INTO system_logs_fts(rowid, {names})
+            VALUES (new.log_id, {new_values});
+        END
+        ''')
+        # 为已有的日志建立索引
+        self.conn.execute("INSERT INTO system_logs_fts(system_logs_fts) VALUES ('rebuild')")
+        
+    def _ensure_column(self, table: str, column: str, definition: str):
+        """如果表中缺少指定列则添加该列
+        Args:
+            table: 表名
+            column: 列名
+            definition: 列的类型定义
+        """
+        self.cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in self.cursor.fetchall()]:
+            try:
+                self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            except sqlite3.OperationalError as e:
+                # 另一个进程在检查之后刚好添加了该列
+                if 'duplicate column' not in str(e):
+                    raise
+        
     def create_session(self) -> int:
         """创建新的对话会话
         Returns:
             int: 会话ID
         """
-        self.cursor.execute(
-            'INSERT INTO sessions (start_time) VALUES (?)',
-            (datetime.now(),)
-        )
-        self.conn.commit()
-        return self.cursor.lastrowid
+        # 需要立即拿到会话ID，因此总是同步写入
+        with self._lock:
+            cursor = self.conn.execute(
+                'INSERT INTO sessions (start_time) VALUES (?)',
+                (datetime.now(),)
+            )
+            self.conn.commit()
+            return cursor.lastrowid
+        
+    def resume_session(self, session_id: int) -> bool:
+        """恢复已有的对话会话（如WebSocket重连），已结束的会话重新标记为活跃
+        Args:
+            session_id: 会话ID
+        Returns:
+            bool: 会话是否存在
+        """
+        rows = self._query('SELECT end_time FROM sessions WHERE session_id = ?', (session_id,))
+        if not rows:
+            return False
+        if rows[0][0] is not None:
+            self._write(
+                'UPDATE sessions SET end_time = NULL, status = ? WHERE session_id = ?',
+                ('active', session_id)
+            )
+        return True
         
     def end_session(self, session_id: int):
         """结束对话会话
         Args:
             session_id: 会话ID
         """
-        self.cursor.execute(
+        self._write(
             'UPDATE sessions SET end_time = ?, status = ? WHERE session_id = ?',
             (datetime.now(), 'completed', session_id)
         )
-        self.conn.commit()
         
-    def add_message(self, session_id: int, role: str, content: str):
+    def update_session_summary(self, session_id: int, summary: str):
+        """更新会话的滚动摘要
+        Args:
+            session_id: 会话ID
+            summary: 新的摘要
+        """
+        self._write(
+            'UPDATE sessions SET summary = ?, summary_updated_at = ? WHERE session_id = ?',
+            (summary, datetime.now(), session_id)
+        )
+        
+    def get_session_summary(self, session_id: int) -> Optional[str]:
+        """获取会话的滚动摘要
+        Args:
+            session_id: 会话ID
+        Returns:
+            Optional[str]: 摘要，尚未生成时返回None
+        """
+        rows = self._query('SELECT summary FROM sessions WHERE session_id = ?', (session_id,))
+        return rows[0][0] if rows else None
+        
+    def add_message(self, session_id: int, role: str, content: str, thinking: Optional[str] = None):
         """添加对话消息
         Args:
             session_id: 会话ID
             role: 发言角色
             content: 消息内容
+            thinking: sys2回复的思考过程
         """
-        self.cursor.execute(
-            'INSERT INTO messages (session_id, timestamp, role, content) VALUES (?, ?, ?, ?)',
-            (session_id, datetime.now(), role, content)
+        self._write(
+            'INSERT INTO messages (session_id, timestamp, role, content, thinking) VALUES (?, ?, ?, ?, ?)',
+            (session_id, datetime.now(), role, content, thinking)
         )
-        self.conn.commit()
         
     def get_session_messages(self, session_id: int) -> List[Dict[str, Any]]:
         """获取会话的所有消息
         Args:
             session_id: 会话ID
         Returns:
-            List[Dict[str, Any]]: 消息列表
+            List[Dict[str, Any]]: 消息列表，sys2的回复带有thinking字段
         """
-        self.cursor.execute(
-            'SELECT timestamp, role, content FROM messages WHERE session_id = ? ORDER BY timestamp',
+        rows = self._query(
+            'SELECT timestamp, role, content, thinking FROM messages WHERE session_id = ? ORDER BY timestamp',
             (session_id,)
         )
         messages = []
-        for row in self.cursor.fetchall():
-            messages.append({
+        for row in rows:
+            message = {
                 'timestamp': row[0],
                 'role': row[1],
                 'content': row[2]
-            })
+            }
+            if row[3]:
+                message['thinking'] = row[3]
+            messages.append(message)
         return messages
         
+    def get_messages_after(self, session_id: int, after_id: int) -> List[tuple]:
+        """按message_id顺序读取会话中某条消息之后的新消息，用于增量更新检索索引
+        Args:
+            session_id: 会话ID
+            after_id: 已读取的最大message_id
+        Returns:
+            List[tuple]: (message_id, session_id, role, content)列表
+        """
+        return self._query(
+            """SELECT message_id, session_id, role, content FROM messages
+               WHERE session_id = ? AND message_id > ? ORDER BY message_id""",
+            (session_id, after_id)
+        )
+        
     def add_system_log(self, session_id: int, agent_name: str, input_text: str,
                       output_text: str, response_time_ms: int, input_tokens: int,
                       output_tokens: int, model_name: str, status: str,
-                      error_message: Optional[str] = None):
+                      error_message: Optional[str] = None,
+                      first_token_ms: Optional[int] = None,
+                      input_segments: Optional[List[str]] = None,
+                      user_input: Optional[str] = None,
+                      context_trimmed_tokens: Optional[int] = None,
+                      queue_wait_ms: Optional[int] = None,
+                      hedge_status: Optional[str] = None):
         """添加系统日志
         Args:
             session_id: 会话ID
             agent_name: Agent名称
-            input_text: 输入文本
+            input_text: 输入文本（完整prompt）
             output_text: 输出文本
             response_time_ms: 响应时间（毫秒）
             input_tokens: 输入token数量
             output_tokens: 输出token数量
             model_name: 使用的模型名称
-            status: 状态（success/error）
+            status: 状态（success/error/cache_hit/cancelled）
             error_message: 错误信息（如果有）
+            first_token_ms: 首个token的到达时间（毫秒，仅流式调用）
+            input_segments: 组成prompt的片段；提供且启用了去重存储时只保存片段引用，不保存input_text
+            user_input: 本次调用的用户输入，用于检索和训练本地路由
+            context_trimmed_tokens: 对话历史按token预算省去的估算token数（丢弃的早期消息和思考过程）
+            queue_wait_ms: 在调度器中排队的时间（毫秒，不计入response_time_ms；同步调用为None）
+            hedge_status: 对冲结果：None为未对冲，primary/hedge为先成功的请求，failed为都失败
+        
+        在trace中调用时同时记录trace_id，查看日志时可展开该轮对话的调用链路
         """
-        self.cursor.execute(
+        input_ref = None
+        if input_segments is not None and self.prompt_store is not None:
+            input_ref, blobs = self.prompt_store.encode(input_segments)
+            if blobs:
+                # 片段先于日志写入，查看日志时总能还原完整prompt
+                self._write(
+                    'INSERT OR IGNORE INTO prompt_blobs (hash, codec, data, raw_size) VALUES (?, ?, ?, ?)',
+                    blobs, many=True
+                )
+            input_text = ''
+        self._write(
             '''INSERT INTO system_logs 
                (session_id, timestamp, agent_name, input_text, output_text,
                 response_time_ms, input_tokens, output_tokens, model_name,
-                status, error_message)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                status, error_message, first_token_ms, user_input, input_ref, trace_id,
+                context_trimmed_tokens, queue_wait_ms, hedge_status)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
             (session_id, datetime.now(), agent_name, input_text, output_text,
              response_time_ms, input_tokens, output_tokens, model_name,
-             status, error_message)
+             status, error_message, first_token_ms, user_input, input_ref,
+             tracer.current_trace_id(), context_trimmed_tokens, queue_wait_ms, hedge_status)
+        )
+        
+    def add_trace_spans(self, spans: List[Span]):
+        """写入一轮对话的链路追踪span（作为tracer的导出器）
+        Args:
+            spans: 已结束的span
+        """
+        self._write(
+            '''INSERT OR REPLACE INTO trace_spans
+               (trace_id, span_id, parent_id, session_id, name, start_time,
+                duration_ms, status, message, attributes)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [(span.trace_id, span.span_id, span.parent_id, span.session_id, span.name,
+              span.start_time, span.duration_ms, span.status, span.message,
+              json.dumps(span.attributes, ensure_ascii=False, default=str))
+             for span in spans],
+            many=True
+        )
+        
+    def get_trace(self, trace_id: str) -> List[Dict[str, Any]]:
+        """获取一个trace的所有span
+        Args:
+            trace_id: trace ID
+        Returns:
+            List[Dict[str, Any]]: 按开始时间排序的span列表，start_offset_ms为相对trace开始的偏移（毫秒）
+        """
+        rows = self._query(
+            '''SELECT span_id, parent_id, session_id, name, start_time, duration_ms,
+                      status, message, attributes
+               FROM trace_spans WHERE trace_id = ?
+               ORDER BY start_time, duration_ms DESC''',
+            (trace_id,)
+        )
+        if not rows:
+            return []
+        trace_start = rows[0][4]
+        return [{
+            'span_id': row[0],
+            'parent_id': row[1],
+            'session_id': row[2],
+            'name': row[3],
+            'start_time': datetime.fromtimestamp(row[4]).isoformat(),
+            'start_offset_ms': (row[4] - trace_start) * 1000,
+            'duration_ms': row[5],
+            'status': row[6],
+            'message': row[7],
+            'attributes': json.loads(row[8]) if row[8] else {}
+        } for row in rows]
+        
+    def add_speculation_log(self, session_id: int, dispatcher_decision: str, hit: bool,
+                            sys1_status: str, wasted_input_tokens: int, wasted_output_tokens: int):
+        """添加推测调度日志
+        Args:
+            session_id: 会话ID
+            dispatcher_decision: 调度Agent的实际决策
+            hit: 推测执行的sys1是否被采用
+            sys1_status: 推测的sys1调用状态（completed/error/cancelled）
+            wasted_input_tokens: 未被采用的sys1调用消耗的输入token数量
+            wasted_output_tokens: 未被采用的sys1调用消耗的输出token数量
+        """
+        self._write(
+            '''INSERT INTO speculation_logs
+               (session_id, timestamp, dispatcher_decision, hit, sys1_status,
+                wasted_input_tokens, wasted_output_tokens)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (session_id, datetime.now(), dispatcher_decision, int(hit), sys1_status,
+             wasted_input_tokens, wasted_output_tokens)
+        )
+        
+    def get_speculation_stats(self) -> Dict[str, Any]:
+        """统计推测调度的命中率和浪费的token
+        Returns:
+            Dict[str, Any]: 统计结果
+        """
+        rows = self._query(
+            '''SELECT COUNT(*), COALESCE(SUM(hit), 0),
+                      COALESCE(SUM(wasted_input_tokens), 0),
+                      COALESCE(SUM(wasted_output_tokens), 0)
+               FROM speculation_logs'''
+        )
+        turns, hits, wasted_input_tokens, wasted_output_tokens = rows[0]
+        return {
+            'turns': turns,
+            'hits': hits,
+            'hit_rate': hits / turns if turns else 0.0,
+            'wasted_input_tokens': wasted_input_tokens,
+            'wasted_output_tokens': wasted_output_tokens
+        }
+        
+    def add_routing_log(self, session_id: int, user_input: str, source: str, final_label: str,
+                        local_label: Optional[str] = None, local_tier: Optional[str] = None,
+                        confidence: Optional[float] = None, remote_label: Optional[str] = None):
+        """添加路由日志
+        Args:
+            session_id: 会话ID
+            user_input: 用户输入
+            source: 决策来源（local/remote）
+            final_label: 最终采用的路由结果
+            local_label: 本地路由的判断结果
+            local_tier: 给出本地判断的阶段（keyword/ngram）
+            confidence: 本地判断的置信度
+            remote_label: 远程模型的判断结果
+        """
+        agree = None
+        if local_label is not None and remote_label is not None:
+            agree = int(local_label == remote_label)
+        self._write(
+            '''INSERT INTO routing_logs
+               (session_id, timestamp, user_input, source, local_label, local_tier,
+                confidence, remote_label, final_label, agree)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (session_id, datetime.now(), user_input, source, local_label, local_tier,
+             confidence, remote_label, final_label, agree)
         )
-        self.conn.commit()
+        
+    def get_routing_stats(self) -> Dict[str, Any]:
+        """统计路由来源分布，以及按置信度分段的本地/远程一致率
+        Returns:
+            Dict[str, Any]: 统计结果
+        """
+        rows = self._query(
+            'SELECT source, COUNT(*) FROM routing_logs GROUP BY source'
+        )
+        sources = {row[0]: row[1] for row in rows}
+        
+        # 置信度按0.1分段，便于选择阈值
+        rows = self._query(
+            '''SELECT local_tier, CAST(confidence * 10 AS INTEGER) / 10.0 AS bucket,
+                      COUNT(*), SUM(agree)
+               FROM routing_logs
+               WHERE agree IS NOT NULL
+               GROUP BY local_tier, bucket
+               ORDER BY local_tier, bucket'''
+        )
+        buckets = []
+        for tier, bucket, total, agreed in rows:
+            buckets.append({
+                'tier': tier,
+                'confidence': bucket,
+                'samples': total,
+                'agreement': agreed / total if total else 0.0
+            })
+        return {'sources': sources, 'agreement': buckets}
+        
+    def get_metrics(self, granularity: str = 'minute', start_time: Optional[str] = None,
+                    end_time: Optional[str] = None, agent_name: Optional[str] = None,
+                    model_name: Optional[str] = None) -> Dict[str, Any]:
+        """从汇总表读取按Agent和模型分组的性能指标，查询代价与时间桶数成正比
+        Args:
+            granularity: 时间粒度（minute/hour/day）
+            start_time: 开始时间（ISO格式），为None时返回最近DEFAULT_ROLLUP_BUCKETS个时间桶
+            end_time: 结束时间（ISO格式），为None时为当前时间
+            agent_name: 只统计该Agent
+            model_name: 只统计该模型
+        Returns:
+            Dict[str, Any]: 每个(Agent, 模型)的时间序列和整个时间范围的汇总，
+                包括调用次数、每分钟调用数、错误率、token吞吐量和p50/p95/p99响应时间
+        Raises:
+            ValueError: 时间粒度或时间格式无效
+        """
+        if granularity not in ROLLUP_GRANULARITIES:
+            raise ValueError(f"不支持的时间粒度: {granularity}")
+        bucket_sql, bucket_seconds = ROLLUP_GRANULARITIES[granularity]
+        end = self._local_time(end_time) if end_time else datetime.now()
+        if start_time:
+            start = self._local_time(start_time)
+        else:
+            start = end - timedelta(seconds=bucket_seconds * DEFAULT_ROLLUP_BUCKETS[granularity])
+        
+        # 起止时间按与日志相同的方式对齐到时间桶
+        bucket_param = bucket_sql.format(column='?')
+        conditions = ["granularity = ?", f"bucket_start >= {bucket_param}", f"bucket_start <= {bucket_param}"]
+        params = [granularity, start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')]
+        if agent_name:
+            conditions.append("agent_name = ?")
+            params.append(agent_name)
+        if model_name:
+            conditions.append("model_name = ?")
+            params.append(model_name)
+        where = " AND ".join(conditions)
+        
+        rows = self._query(
+            f'''SELECT agent_name, model_name, bucket_start, calls, errors,
+                       input_tokens, output_tokens, response_time_sum
+                FROM log_rollups WHERE {where}
+                ORDER BY agent_name, model_name, bucket_start''',
+            params
+        )
+        histograms = {}
+        for agent, model, bucket, index, count in self._query(
+            f'''SELECT agent_name, model_name, bucket_start, bin, count
+                FROM log_rollup_latency WHERE {where}''',
+            params
+        ):
+            counts = histograms.setdefault((agent, model, bucket), [0] * (len(LATENCY_BUCKETS_MS) + 1))
+            counts[index] += count
+        
+        series = {}
+        totals = {}
+        for agent, model, bucket, calls, errors, input_tokens, output_tokens, response_time_sum in rows:
+            counts = histograms.get((agent, model, bucket), [0] * (len(LATENCY_BUCKETS_MS) + 1))
+            series.setdefault((agent, model), []).append({
+                'bucket_start': bucket,
+                **self._metric_values(calls, errors, input_tokens, output_tokens,
+                                      response_time_sum, counts, bucket_seconds)
+            })
+            total = totals.setdefault((agent, model), [0, 0, 0, 0, 0, [0] * len(counts)])
+            for index, value in enumerate((calls, errors, input_tokens, output_tokens, response_time_sum)):
+                total[index] += value
+            total[5] = [a + b for a, b in zip(total[5], counts)]
+        
+        # 汇总按整个时间范围计算速率
+        window_seconds = max((end - start).total_seconds(), bucket_seconds)
+        summary = []
+        for (agent, model), total in totals.items():
+            summary.append({
+                'agent_name': agent,
+                'model_name': model,
+                **self._metric_values(*total, window_seconds)
+            })
+        return {
+            'granularity': granularity,
+            'bucket_seconds': bucket_seconds,
+            'start_time': start.isoformat(),
+            'end_time': end.isoformat(),
+            'summary': summary,
+            'series': [
+                {'agent_name': agent, 'model_name': model, 'buckets': buckets}
+                for (agent, model), buckets in series.items()
+            ]
+        }
+        
+    @staticmethod
+    def _local_time(value: str) -> datetime:
+        """把ISO格式的时间转换为与日志时间戳一致的本地时间"""
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone().replace(tzinfo=None)
+        return parsed
+        
+    @staticmethod
+    def _metric_values(calls: int, errors: int, input_tokens: int, output_tokens: int,
+                       response_time_sum: int, counts: List[int], seconds: float) -> Dict[str, Any]:
+        """根据汇总计数计算指标
+        Args:
+            calls: 调用次数
+            errors: 错误次数
+            input_tokens: 输入token总数
+            output_tokens: 输出token总数
+            response_time_sum: 响应时间总和（毫秒）
+            counts: 响应时间直方图
+            seconds: 统计时长（秒）
+        Returns:
+            Dict[str, Any]: 指标
+        """
+        return {
+            'calls': calls,
+            'errors': errors,
+            'error_rate': errors / calls if calls else 0.0,
+            'calls_per_minute': calls * 60 / seconds,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'output_tokens_per_second': output_tokens / seconds,
+            'avg_ms': response_time_sum / calls if calls else None,
+            'p50_ms': histogram_quantile(0.5, counts),
+            'p95_ms': histogram_quantile(0.95, counts),
+            'p99_ms': histogram_quantile(0.99, counts)
+        }
+        
+    def get_agent_decisions(self, agent_name: str, limit: int = 5000) -> List[Dict[str, str]]:
+        """获取某个Agent最近成功调用的输入和输出，用于训练本地路由
+        Args:
+            agent_name: Agent名称
+            limit: 最多返回的记录数
+        Returns:
+            List[Dict[str, str]]: 包含input_text、user_input和output_text的列表；
+                按片段存储的日志input_text为空，user_input为本次调用的用户输入
+        """
+        rows = self._query(
+            '''SELECT input_text, output_text, user_input FROM system_logs
+               WHERE agent_name = ? AND status = 'success'
+               ORDER BY log_id DESC LIMIT ?''',
+            (agent_name, limit)
+        )
+        return [{'input_text': row[0], 'output_text': row[1], 'user_input': row[2]} for row in rows]
         
     def get_session_logs(self, session_id: int) -> List[Dict[str, Any]]:
         """获取会话的所有系统日志
@@ -168,17 +1018,18 @@ class Database:
         Returns:
             List[Dict[str, Any]]: 日志列表
         """
-        self.cursor.execute(
+        rows = self._query(
             '''SELECT timestamp, agent_name, input_text, output_text,
                       response_time_ms, input_tokens, output_tokens,
-                      model_name, status, error_message
+                      model_name, status, error_message, first_token_ms, input_ref,
+                      queue_wait_ms, hedge_status
                FROM system_logs 
                WHERE session_id = ? 
                ORDER BY timestamp''',
             (session_id,)
         )
         logs = []
-        for row in self.cursor.fetchall():
+        for row in rows:
             logs.append({
                 'timestamp': row[0],
                 'agent_name': row[1],
@@ -189,21 +1040,52 @@ class Database:
                 'output_tokens': row[6],
                 'model_name': row[7],
                 'status': row[8],
-                'error_message': row[9]
+                'error_message': row[9],
+                'first_token_ms': row[10],
+                'queue_wait_ms': row[12],
+                'hedge_status': row[13]
             })
+        self._restore_prompts(logs, [row[11] for row in rows])
         return logs
         
     def get_logs(self, start_time: Optional[str] = None,
                 end_time: Optional[str] = None,
                 search_text: Optional[str] = None) -> List[Dict[str, Any]]:
-        """获取系统日志
+        """获取系统日志（最多1000条）
         Args:
             start_time: 开始时间（ISO格式）
             end_time: 结束时间（ISO格式）
-            search_text: 搜索文本
+            search_text: 搜索文本，有全文索引时按相关度排序
         Returns:
             List[Dict[str, Any]]: 日志列表
         """
+        return self.get_logs_page(start_time, end_time, search_text, page_size=1000)['logs']
+        
+    def get_logs_page(self, start_time: Optional[str] = None,
+                      end_time: Optional[str] = None,
+                      search_text: Optional[str] = None,
+                      cursor: Optional[str] = None,
+                      page_size: int = 50,
+                      fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """分页获取系统日志
+        按(timestamp, log_id)倒序做键集分页，全文检索时按(相关度, log_id)分页，翻页代价与页码无关
+        Args:
+            start_time: 开始时间（ISO格式）
+            end_time: 结束时间（ISO格式）
+            search_text: 搜索文本，有全文索引时按相关度排序
+            cursor: 上一页返回的next_cursor，为None时从第一页开始
+            page_size: 每页条数
+            fields: 返回的字段，为None时返回除output_preview外的全部字段
+        Returns:
+            Dict[str, Any]: {"logs": 日志列表, "next_cursor": 下一页游标，没有更多时为None}
+        Raises:
+            ValueError: 字段名或游标无效
+        """
+        fields = list(fields or self.DEFAULT_LOG_FIELDS)
+        unknown = [name for name in fields if name not in self.LOG_FIELDS]
+        if unknown:
+            raise ValueError(f"未知的日志字段: {', '.join(unknown)}")
+        
         # 构建查询条件
         conditions = []
         params = []
@@ -216,46 +1098,488 @@ class Database:
             conditions.append("l.timestamp <= ?")
             params.append(end_time)
             
-        if search_text:
-            conditions.append("(l.input_text LIKE ? OR l.output_text LIKE ?)")
+        # trigram全文索引只能检索3个字符以上的片段，更短的搜索词退回到LIKE
+        use_fts = bool(search_text) and self.fts_enabled and len(search_text) >= 3
+        if search_text and not use_fts:
+            conditions.append("(l.input_text LIKE ? OR l.user_input LIKE ? OR l.output_text LIKE ?)")
             search_pattern = f"%{search_text}%"
-            params.extend([search_pattern, search_pattern])
+            params.extend([search_pattern, search_pattern, search_pattern])
             
-        # 构建SQL查询
-        query = """
-            SELECT l.*, s.start_time as session_start_time
+        # 排序键：全文检索时为相关度（越小越相关），否则为时间（越大越新）
+        sort_key = "f.rank" if use_fts else "l.timestamp"
+        if cursor:
+            key, last_id = self._decode_cursor(cursor)
+            if use_fts:
+                conditions.append("(f.rank > ? OR (f.rank = ? AND l.log_id < ?))")
+            else:
+                conditions.append("(l.timestamp < ? OR (l.timestamp = ? AND l.log_id < ?))")
+            params.extend([key, key, last_id])
+            
+        # 构建SQL查询；最后三列用于还原prompt和生成下一页游标
+        columns = ", ".join(self.LOG_FIELDS[name] for name in fields)
+        query = f"SELECT {columns}, l.input_ref, {sort_key}, l.log_id"
+        if use_fts:
+            query += """
+                FROM system_logs_fts f
+                JOIN system_logs l ON l.log_id = f.rowid
+                JOIN sessions s ON l.session_id = s.session_id
+                WHERE system_logs_fts MATCH ?
+            """
+            # 作为短语整体匹配，转义其中的双引号
+            params.insert(0, '"' + search_text.replace('"', '""') + '"')
+            if conditions:
+                query += " AND " + " AND ".join(conditions)
+            query += " ORDER BY f.rank, l.log_id DESC"
+        else:
+            query += """
+                FROM system_logs l
+                JOIN sessions s ON l.session_id = s.session_id
+            """
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            query += " ORDER BY l.timestamp DESC, l.log_id DESC"
+        # 多取一条用于判断是否还有下一页
+        query += " LIMIT ?"
+        params.append(page_size + 1)
+        
+        # 执行查询
+        rows = self._query(query, params)
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = self._encode_cursor(rows[-1][-2], rows[-1][-1])
+        logs = [dict(zip(fields, row)) for row in rows]
+        if 'input_text' in fields:
+            self._restore_prompts(logs, [row[-3] for row in rows])
+        return {'logs': logs, 'next_cursor': next_cursor}
+        
+    @staticmethod
+    def _encode_cursor(key: Any, log_id: int) -> str:
+        """把排序键和log_id编码为不透明的游标字符串"""
+        raw = json.dumps([key, log_id]).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+        
+    @staticmethod
+    def _decode_cursor(cursor: str) -> tuple:
+        """解析游标字符串
+        Raises:
+            ValueError: 游标格式无效
+        """
+        try:
+            key, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except (ValueError, TypeError, UnicodeError) as e:
+            raise ValueError(f"无效的游标: {cursor}") from e
+        if not isinstance(log_id, int):
+            raise ValueError(f"无效的游标: {cursor}")
+        return key, log_id
+        
+    def get_log(self, log_id: int) -> Optional[Dict[str, Any]]:
+        """获取单条日志的完整内容
+        Args:
+            log_id: 日志ID
+        Returns:
+            Optional[Dict[str, Any]]: 日志详情，不存在时返回None
+        """
+        fields = self.DEFAULT_LOG_FIELDS
+        columns = ", ".join(self.LOG_FIELDS[name] for name in fields)
+        rows = self._query(f"""
+            SELECT {columns}, l.input_ref
             FROM system_logs l
             JOIN sessions s ON l.session_id = s.session_id
+            WHERE l.log_id = ?
+        """, (log_id,))
+        if not rows:
+            return None
+        log = dict(zip(fields, rows[0]))
+        self._restore_prompts([log], [rows[0][-1]])
+        return log
+        
+    def _restore_prompts(self, logs: List[Dict[str, Any]], refs: List[Optional[bytes]]):
+        """按片段引用还原日志的完整prompt（input_text）
+        Args:
+            logs: 日志列表，原地修改
+            refs: 与logs一一对应的片段引用，为None表示未按片段存储
         """
+        keys = set()
+        for ref in refs:
+            if ref:
+                keys.update(parse_ref(ref))
+        blobs = self._load_blobs(keys)
+        for log, ref in zip(logs, refs):
+            if ref:
+                log['input_text'] = join_ref(ref, blobs)
         
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
+    def _load_blobs(self, keys: Any) -> Dict[bytes, str]:
+        """批量读取并解压prompt片段
+        Args:
+            keys: 片段摘要
+        Returns:
+            Dict[bytes, str]: 摘要 -> 片段文本
+        """
+        keys = list(keys)
+        blobs = {}
+        # 分批查询，避免超过SQLite的参数个数限制
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = self._query(
+                f'SELECT hash, codec, data FROM prompt_blobs WHERE hash IN ({placeholders})', chunk
+            )
+            for key, codec, data in rows:
+                blobs[key] = decompress(codec, data)
+        return blobs
+        
+    def _write(self, sql: str, params: Any, many: bool = False):
+        """执行一次写入，按持久性设置决定同步提交还是交给后台线程
+        Args:
+            sql: SQL语句
+            params: SQL参数；many为True时为多组参数
+            many: 是否用多组参数执行同一语句
+        """
+        # 在trace中记录写入耗时；async模式和事件循环中的batched写入只包含入队的时间
+        with tracer.span('db.write', mode=self.durability) as span:
+            if span is not None:
+                match = _WRITE_TABLE.search(sql)
+                span.set_attribute('table', match.group(1) if match else '')
+            
+            if self.durability == 'sync':
+                with self._lock:
+                    start_time = time.perf_counter()
+                    self._execute(self.conn, sql, params, many)
+                    self.conn.commit()
+                    db_write_seconds.observe(time.perf_counter() - start_time, 'sync')
+                return
             
-        query += " ORDER BY l.timestamp DESC LIMIT 1000"
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is None:
+                # 队列已满时阻塞调用方，形成背压
+                done = threading.Event() if self.durability == 'batched' else None
+                self._queue.put((sql, params, many, done))
+                if done is not None:
+                    # batched模式：等待所在批次提交完成
+                    done.wait()
+                return
+            
+            # 在事件循环中写入：不阻塞，batched模式的提交和队列已满时的入队由wait_for_writes等待
+            done = loop.create_future() if self.durability == 'batched' else None
+            admitted = self._enqueue((sql, params, many, done), loop)
+            if done is not None:
+                self._track(done)
+            elif admitted is not None:
+                self._track(admitted)
+            
+    @staticmethod
+    def _track(future: asyncio.Future):
+        """登记当前任务中尚未完成的写入"""
+        pending = _pending_writes.get()
+        if pending is None:
+            pending = []
+            _pending_writes.set(pending)
+        else:
+            # 丢弃已经完成的写入，避免长时间运行的任务中列表持续增长
+            pending[:] = [item for item in pending if not item.done()]
+        pending.append(future)
         
-        # 执行查询
-        self.cursor.execute(query, params)
-        logs = []
-        for row in self.cursor.fetchall():
-            logs.append({
-                'session_id': row[1],
-                'timestamp': row[2],
-                'agent_name': row[3],
-                'input_text': row[4],
-                'output_text': row[5],
-                'response_time_ms': row[6],
-                'input_tokens': row[7],
-                'output_tokens': row[8],
-                'model_name': row[9],
-                'status': row[10],
-                'error_message': row[11],
-                'session_start_time': row[12]
-            })
-        return logs
+    def _enqueue(self, item: tuple, loop: asyncio.AbstractEventLoop) -> Optional[asyncio.Future]:
+        """在事件循环中把写入放入队列，不阻塞事件循环
+        队列已满（或溢出队列中还有更早的写入，保证顺序）时放入溢出队列，溢出队列也满时丢弃
+        Args:
+            item: (SQL语句, 参数, 是否多组参数, 完成信号)
+            loop: 当前的事件循环
+        Returns:
+            Optional[asyncio.Future]: 放入溢出队列时返回写入进入队列时完成的future，否则返回None
+        """
+        with self._overflow_lock:
+            if not self._overflow:
+                try:
+                    self._queue.put_nowait(item)
+                    return None
+                except queue.Full:
+                    pass
+            if len(self._overflow) < self._queue.maxsize:
+                admitted = loop.create_future()
+                self._overflow.append((item, admitted))
+                return admitted
+            # 写入积压超过两倍的队列长度：丢弃，避免内存无限增长
+            dropping, self._dropping = self._dropping, True
+        db_writes_dropped.inc()
+        if not dropping:
+            print("数据库写入积压过多，开始丢弃事件循环中的写入（见db_writes_dropped_total）")
+        _notify_write(item[3])
+        return None
         
-    def close(self):
-        """关闭数据库连接"""
-        self.conn.close()
+    def _drain_overflow(self):
+        """后台写入线程：把溢出队列中的写入按顺序移入写入队列，直到队列再次写满"""
+        with self._overflow_lock:
+            while self._overflow:
+                item, admitted = self._overflow[0]
+                try:
+                    self._queue.put_nowait(item)
+                except queue.Full:
+                    break
+                self._overflow.popleft()
+                _notify_write(admitted)
+            if not self._overflow:
+                self._dropping = False
+                
+    def queue_size(self) -> int:
+        """等待写入的条数（写入队列和溢出队列）"""
+        return self._queue.qsize() + len(self._overflow)
+        
+    async def wait_for_writes(self):
+        """等待当前任务在事件循环中发起的写入完成：batched模式下等待提交，
+        其他模式下只在队列已满时等待写入进入队列（背压）。对话回复发送之前调用
+        """
+        pending = _pending_writes.get()
+        if not pending:
+            return
+        waiting = list(pending)
+        await asyncio.gather(*waiting)
+        pending[:] = [future for future in pending if future not in waiting]
+            
+    @staticmethod
+    def _execute(conn: sqlite3.Connection, sql: str, params: Any, many: bool):
+        """在指定连接上执行一条写入语句"""
+        if many:
+            conn.executemany(sql, params)
+        else:
+            conn.execute(sql, params)
+            
+    def _query(self, sql: str, params: Any = ()) -> List[tuple]:
+        """使用当前线程的只读连接执行一次查询
+        Args:
+            sql: SQL语句
+            params: SQL参数
+        Returns:
+            List[tuple]: 查询结果
+        """
+        return self._reader().execute(sql, params).fetchall()
+            
+    def _writer_loop(self):
+        """后台写入线程：每batch_size条或每flush_interval_ms毫秒在一个事务中提交一次"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.flush_interval_ms / 1000
+            while len(batch) < self.batch_size:
+                # 有调用方在等待时不再凑批，队列一空就提交
+                if any(entry[3] is not None for entry in batch) and self._queue.empty():
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    next_item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if next_item is None:
+                    stop = True
+                    break
+                batch.append(next_item)
+            
+            self._commit_batch(batch)
+            # 先移入溢出队列中的写入再标记完成，flush等待队列时也会等待这些写入
+            self._drain_overflow()
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                self._queue.task_done()
+                break
+                
+    def _commit_batch(self, batch: List[tuple]):
+        """在一个事务中写入一批数据，失败时逐条重试
+        Args:
+            batch: (SQL语句, 参数, 是否多组参数, 完成信号)列表；
+                完成信号为threading.Event（同步调用方）、asyncio.Future（事件循环中的调用方）或None
+        """
+        with self._lock:
+            start_time = time.perf_counter()
+            try:
+                for sql, params, many, _ in batch:
+                    self._execute(self.conn, sql, params, many)
+                self.conn.commit()
+                db_write_seconds.observe(time.perf_counter() - start_time, self.durability)
+                db_write_batch_size.observe(len(batch))
+            except sqlite3.Error:
+                self.conn.rollback()
+                # 逐条写入，避免一条坏数据拖累整个批次
+                for sql, params, many, _ in batch:
+                    try:
+                        self._execute(self.conn, sql, params, many)
+                        self.conn.commit()
+                    except sqlite3.Error as e:
+                        self.conn.rollback()
+                        print(f"数据库写入失败: {str(e)}")
+        for _, _, _, done in batch:
+            _notify_write(done)
+                
+    def migrate_prompts(self, templates: Dict[str, str], batch_size: int = 500) -> int:
+        """把旧日志中的完整prompt转换为片段引用
+        能按Agent模板拆分的prompt拆成模板片段、历史消息和用户输入，并补充user_input；否则按行拆分
+        Args:
+            templates: Agent名称 -> prompt模板
+            batch_size: 每个事务转换的日志条数
+        Returns:
+            int: 转换的日志条数
+        """
+        if self.prompt_store is None:
+            return 0
+        self.flush()
+        converted = 0
+        last_id = 0
+        while True:
+            rows = self._query(
+                '''SELECT log_id, agent_name, input_text, user_input FROM system_logs
+                   WHERE log_id > ? AND input_ref IS NULL AND input_text != ''
+                   ORDER BY log_id LIMIT ?''',
+                (last_id, batch_size)
+            )
+            if not rows:
+                break
+            blobs = []
+            updates = []
+            for log_id, agent_name, input_text, user_input in rows:
+                split = split_rendered(input_text, templates.get(agent_name, ''))
+                if split is not None:
+                    segments, values = split
+                    user_input = user_input or values.get('user_input')
+                else:
+                    segments = input_text.splitlines(keepends=True)
+                ref, new_blobs = self.prompt_store.encode(segments)
+                blobs.extend(new_blobs)
+                updates.append((ref, user_input, log_id))
+            with self._lock:
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO prompt_blobs (hash, codec, data, raw_size) VALUES (?, ?, ?, ?)',
+                    blobs
+                )
+                self.conn.executemany(
+                    "UPDATE system_logs SET input_text = '', input_ref = ?, user_input = ? WHERE log_id = ?",
+                    updates
+                )
+                self.conn.commit()
+            converted += len(rows)
+            last_id = rows[-1][0]
+        return converted
         
+    def get_prompt_storage_report(self) -> Dict[str, int]:
+        """统计prompt占用的空间
+        Returns:
+            Dict[str, int]: 日志条数、未转换的prompt大小、已转换的prompt原始大小、片段和引用的存储大小、数据库文件大小
+        """
+        self.flush()
+        log_rows, legacy_rows, legacy_bytes, ref_bytes = self._query(
+            '''SELECT COUNT(*),
+                      COALESCE(SUM(input_ref IS NULL), 0),
+                      COALESCE(SUM(CASE WHEN input_ref IS NULL THEN length(CAST(input_text AS BLOB)) END), 0),
+                      COALESCE(SUM(length(input_ref)), 0)
+               FROM system_logs'''
+        )[0]
+        blob_count, blob_raw_bytes, blob_stored_bytes = self._query(
+            'SELECT COUNT(*), COALESCE(SUM(raw_size), 0), COALESCE(SUM(length(data)), 0) FROM prompt_blobs'
+        )[0]
+        
+        # 已转换日志的prompt原始大小：按引用累加片段的原始大小
+        sizes = {key: size for key, size in self._query('SELECT hash, raw_size FROM prompt_blobs')}
+        referenced_bytes = 0
+        for (ref,) in self._query('SELECT input_ref FROM system_logs WHERE input_ref IS NOT NULL'):
+            referenced_bytes += sum(sizes.get(key, 0) for key in parse_ref(ref))
+        
+        page_size = self._query('PRAGMA page_size')[0][0]
+        page_count = self._query('PRAGMA page_count')[0][0]
+        freelist_count = self._query('PRAGMA freelist_count')[0][0]
+        return {
+            'log_rows': log_rows,
+            'converted_rows': log_rows - legacy_rows,
+            'legacy_rows': legacy_rows,
+            'legacy_prompt_bytes': legacy_bytes,
+            'referenced_prompt_bytes': referenced_bytes,
+            'blob_count': blob_count,
+            'blob_raw_bytes': blob_raw_bytes,
+            'blob_stored_bytes': blob_stored_bytes,
+            'ref_bytes': ref_bytes,
+            'file_bytes': page_size * page_count,
+            'free_bytes': page_size * freelist_count
+        }
+        
+    def vacuum(self):
+        """回收已删除数据占用的空间"""
+        self.flush()
+        with self._lock:
+            self.conn.execute('VACUUM')
+        
+    def flush(self):
+        """等待队列中的所有写入提交完成"""
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.join()
+            while self._overflow:
+                # 溢出队列中的写入在后台线程提交当前批次后移入写入队列
+                time.sleep(self.flush_interval_ms / 1000)
+                self._queue.join()
+            
+    def close(self):
+        """写入队列中剩余的数据并关闭数据库连接"""
+        if self._writer is not None and self._writer.is_alive():
+            # 先写入溢出队列中的数据，再通知后台线程退出
+            self.flush()
+            self._queue.put(None)
+            self._writer.join()
+        self._writer = None
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+        self._local = threading.local()
+        with self._lock:
+            self.conn.close()
+
+
+def _resolve_write(future: asyncio.Future):
+    """在事件循环中标记一次写入已完成"""
+    if not future.done():
+        future.set_result(None)
+
+
+def _notify_write(done: Any):
+    """通知等待写入的调用方
+    Args:
+        done: threading.Event（同步调用方）、asyncio.Future（事件循环中的调用方）或None
+    """
+    if isinstance(done, threading.Event):
+        done.set()
+    elif done is not None:
+        try:
+            done.get_loop().call_soon_threadsafe(_resolve_write, done)
+        except RuntimeError:
+            # 事件循环已经关闭，没有调用方在等待
+            pass
+
+
 # 创建全局实例
-db = Database()
+_db_config = Config().get_runtime_config().get('database', {}) or {}
+db = Database(
+    # 数据库文件路径：可用环境变量DIALOGUE_DB_PATH指定（例如基准测试使用临时数据库），默认为data/dialogue.db
+    db_path=os.getenv('DIALOGUE_DB_PATH') or None,
+    durability=_db_config.get('durability', 'batched'),
+    batch_size=_db_config.get('batch_size', 100),
+    flush_interval_ms=_db_config.get('flush_interval_ms', 50),
+    max_queue=_db_config.get('max_queue', 10000),
+    busy_timeout_ms=_db_config.get('busy_timeout_ms', 5000),
+    mmap_size=_db_config.get('mmap_size', 256 * 1024 * 1024),
+    dedupe_prompts=_db_config.get('dedupe_prompts', True),
+    prompt_codec=_db_config.get('prompt_codec', 'auto')
+)
+# 导出指标时读取写入队列的长度
+queue_depth.set_function(db.queue_size, 'db_write')
+# 每轮对话结束时把trace写入trace_spans表
+if (Config().get_runtime_config().get('tracing', {}) or {}).get('database', True):
+    tracer.add_exporter(db.add_trace_spans)
+# 进程退出时写入队列中剩余的数据
+atexit.register(db.close)
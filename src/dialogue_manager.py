@@ -2,19 +2,50 @@
 对话管理模块
 负责协调多个Agent的对话流程
 """
-from typing import Dict, List, Optional  # 导入类型提示模块，用于类型标注
+import asyncio  # 导入异步支持，用于推测执行sys1
+import threading  # 命令行模式下在后台线程中更新会话摘要
+from typing import Any, AsyncIterator, Dict, List, Optional  # 导入类型提示模块，用于类型标注
 from src.config import Config  # 导入配置模块，用于加载系统配置
-from src.agents import DispatcherAgent, Sys1Agent, Sys2Agent  # 导入三种不同的Agent类
+from src.agents import DispatcherAgent, Sys1Agent, Sys2Agent, SummarizerAgent  # 导入各Agent类
 from src.database import db  # 导入数据库模块，用于存储对话历史
+from src.tracing import tracer  # 导入链路追踪，每轮对话生成一个trace
+from src.retrieval import MessageRetriever  # 导入早期消息检索
+from src.context import FormattedHistory  # 导入各Agent共用的格式化对话历史
+from src.session_store import session_store  # 导入会话状态存储，多个worker共享对话窗口和摘要
+
+# 进程内共享的早期消息检索器，各会话的索引缓存在其中
+_retriever: Optional[MessageRetriever] = None
+
+def get_retriever(config: Dict[str, Any]) -> MessageRetriever:
+    """获取进程内共享的早期消息检索器
+    Args:
+        config: retrieval配置
+    Returns:
+        MessageRetriever: 检索器实例
+    """
+    global _retriever
+    if _retriever is None:
+        _retriever = MessageRetriever(
+            db,
+            max_sessions=config.get('max_sessions', 64),
+            scope=config.get('scope', 'session'),
+            top_k=config.get('top_k', 3),
+            min_score=config.get('min_score', 1.0),
+            max_chars=config.get('max_chars', 200)
+        )
+    return _retriever
 
 class DialogueManager:
     """对话管理器：协调多个Agent的对话流程"""
     
-    # 最大对话历史长度
+    # 最大对话历史长度；传给各Agent后再按各自的token预算（context.max_tokens）选取
     MAX_HISTORY_LENGTH = 20
     
-    def __init__(self):
-        """初始化对话管理器，加载配置并创建各个Agent实例"""
+    def __init__(self, session_id: Optional[int] = None):
+        """初始化对话管理器，加载配置并创建各个Agent实例
+        Args:
+            session_id: 要恢复的会话ID（如WebSocket重连），为None或会话不存在时新建会话
+        """
         # 加载配置文件
         config = Config()
         # 获取所有Agent的配置信息
@@ -28,11 +59,40 @@ class DialogueManager:
         # 系统2 Agent：处理复杂的对话请求，会生成思考过程
         self.sys2 = Sys2Agent(agents_config['sys2'])
         
-        # 创建新的对话会话，并获取会话ID
-        self.session_id = db.create_session()
+        # 推测调度：调度Agent与sys1同时启动，命中sys1时省去一次串行往返
+        self.speculative_dispatch = bool(config.get_runtime_config().get('speculative_dispatch', False))
+        
+        # 滚动摘要：移出对话窗口的消息由摘要Agent在后台并入会话摘要
+        summarizer_config = agents_config.get('summarizer') or {}
+        self.summarizer = None
+        if summarizer_config.get('enabled', False):
+            self.summarizer = SummarizerAgent(summarizer_config)
+        self._evicted = []  # 已移出窗口、尚未并入摘要的消息
+        self._summarizing = False  # 是否有正在进行的摘要更新
+        self._summary_lock = threading.Lock()
+        self._summary_tasks = set()  # 正在进行的异步摘要任务，保留引用避免任务被回收
+        self._state_saves = set()  # 事件循环中尚未完成的会话状态保存（在线程池中执行）
+        
+        # 早期消息检索：按本轮输入从数据库中找回对话窗口之外的相关消息
+        retrieval_config = config.get_runtime_config().get('retrieval') or {}
+        self.retriever = None
+        if retrieval_config.get('enabled', False):
+            self.retriever = get_retriever(retrieval_config)
         
-        # 从数据库加载当前会话的对话历史
-        self.dialogue_history = self._load_history()
+        # 恢复原有会话，或创建新的对话会话并获取会话ID
+        resumed = session_id is not None and db.resume_session(session_id)
+        self.session_id = session_id if resumed else db.create_session()
+        
+        # 会话的滚动摘要和对话窗口：优先从会话状态存储恢复（可能由其他worker写入）
+        self.summary = None
+        self.dialogue_history = []
+        self._state_version = 0  # 本地会话状态的版本，每次保存递增
+        if resumed:
+            self._sync_state()
+        if self._state_version == 0:
+            # 新会话，或状态存储中已没有该会话：从数据库加载
+            self.summary = db.get_session_summary(self.session_id)
+            self.dialogue_history = self._load_history()
         
     def process_input(self, user_input: str) -> dict:
         """处理用户输入，返回系统回复
@@ -42,68 +102,476 @@ class DialogueManager:
             dict: 系统的回复信息，包含type和content字段
                  type可能是'message'(普通回复)或'sys2'(sys2回复，包含思考过程和回复)
         """
-        # 将用户输入添加到对话历史中
-        self._add_message('用户', user_input)
+        # 每轮对话生成一个trace，记录调度、Agent、模型请求和数据库写入的耗时
+        with tracer.start_trace('turn', session_id=self.session_id, stream=False):
+            # 读取其他worker可能已更新的会话状态
+            self._sync_state()
+            # 将用户输入添加到对话历史中
+            self._add_message('用户', user_input)
         
-        try:
-            # 使用调度器Agent决定应该使用哪个子系统来处理用户输入
-            system = self.dispatcher.process(user_input, self.dialogue_history[-10:], self.session_id)
-            
-            # 根据调度结果选择相应的Agent处理用户输入
-            if system.strip().lower() == 'sys1':
-                # 如果调度结果是sys1，使用系统1处理
-                response = self.sys1.process(user_input, self.dialogue_history[-10:], self.session_id)
-                # 将系统1的回复添加到对话历史
-                self._add_message('赵敏敏', response)
-                # 返回普通消息类型的回复
-                return {"type": "message", "content": response}
-            else:
-                # 如果调度结果不是sys1，则使用系统2处理
-                sys2_response = self.sys2.process(user_input, self.dialogue_history[-10:], self.session_id)
-                
-                # 检查sys2的响应是否有效
-                if not isinstance(sys2_response, dict) or not sys2_response.get('response'):
-                    error_msg = "系统2返回了无效的响应"
-                    self._add_message('系统', error_msg)
-                    return {"type": "error", "content": error_msg}
+            try:
+                # 本轮传给各Agent的对话历史
+                history = self._context_history(user_input)
                 
-                # 将系统2的完整回复（思考过程+回复内容）添加到对话历史
-                complete_response = f"{sys2_response.get('thinking', '')}\n\n{sys2_response['response']}"
-                self._add_message('赵敏敏', complete_response)
+                # 使用调度器Agent决定应该使用哪个子系统来处理用户输入
+                with tracer.span('dispatcher') as span:
+                    system = self.dispatcher.process(user_input, history, self.session_id)
+                    if span is not None:
+                        span.set_attribute('decision', system)
+            
+                # 根据调度结果选择相应的Agent处理用户输入
+                if system == 'sys1':
+                    # 如果调度结果是sys1，使用系统1处理
+                    with tracer.span('sys1'):
+                        response = self.sys1.process(user_input, history, self.session_id)
+                    # 将系统1的回复添加到对话历史
+                    self._add_message('赵敏敏', response)
+                    # 返回普通消息类型的回复
+                    return {"type": "message", "content": response}
+                else:
+                    # 如果调度结果不是sys1，则使用系统2处理
+                    with tracer.span('sys2'):
+                        sys2_response = self.sys2.process(user_input, history, self.session_id)
+                    # 校验并记录系统2的回复
+                    return self._finish_sys2(sys2_response)
                 
-                # 返回结构化的系统2响应，包含思考过程和回复内容
-                return {
-                    "type": "sys2", 
-                    "thinking": sys2_response.get("thinking", ""),  # 思考过程部分（可选）
-                    "response": sys2_response["response"]   # 最终回复部分
-                }
+            except Exception as e:
+                # 捕获处理过程中的任何异常
+                error_msg = f"处理失败: {str(e)}"
+                tracer.set_status('error', error_msg)
+                # 将错误消息记录到对话历史
+                self._add_message('系统', error_msg)
+                # 返回错误类型的消息
+                return {"type": "error", "content": error_msg}
+        
+    async def aprocess_input(self, user_input: str) -> dict:
+        """异步处理用户输入，返回值与process_input一致
+        模型调用不会阻塞事件循环，供Web应用使用
+        Args:
+            user_input: 用户输入的文本内容
+        Returns:
+            dict: 系统的回复信息，格式同process_input
+        """
+        result = None
+        async for event in self._arun_turn(user_input, stream=False):
+            result = event
+        return result
+        
+    def astream_input(self, user_input: str) -> AsyncIterator[dict]:
+        """流式处理用户输入
+        Args:
+            user_input: 用户输入的文本内容
+        Returns:
+            AsyncIterator[dict]: 事件流，依次为若干增量事件
+                (type为'message-delta'、'sys2-thinking-delta'或'sys2-response-delta')，
+                最后一个事件与process_input的返回值相同
+        """
+        return self._arun_turn(user_input, stream=True)
+        
+    async def _arun_turn(self, user_input: str, stream: bool) -> AsyncIterator[dict]:
+        """执行一轮异步对话
+        Args:
+            user_input: 用户输入的文本内容
+            stream: 是否输出增量事件
+        Yields:
+            dict: 增量事件（仅stream为True时）和最终回复
+        """
+        with tracer.start_trace('turn', session_id=self.session_id, stream=stream):
+            # 在线程池中读取会话状态存储，不阻塞事件循环
+            self._merge_state(await asyncio.to_thread(self._load_state))
+            self._add_message('用户', user_input)
+            history = await self._acontext_history(user_input)
+            speculation = None
+        
+            try:
+                if self.speculative_dispatch:
+                    # 在调度Agent决策之前先启动sys1
+                    speculation = self._start_speculation(user_input, history, stream)
+            
+                with tracer.span('dispatcher') as span:
+                    system = await self.dispatcher.aprocess(user_input, history, self.session_id)
+                    if span is not None:
+                        span.set_attribute('decision', system)
+            
+                if system == 'sys1':
+                    async for event in self._arun_sys1(user_input, history, stream, speculation):
+                        if event['type'] == 'message':
+                            # 发送回复前等待本轮的写入提交完成
+                            await self._await_writes()
+                        yield event
+                else:
+                    if speculation:
+                        # 推测失败：取消sys1并记录浪费的token
+                        await self._abort_speculation(speculation, system)
+                    with tracer.span('sys2'):
+                        if stream:
+                            sys2_response = None
+                            async for event in self.sys2.astream(user_input, history, self.session_id):
+                                if event['type'] == 'done':
+                                    sys2_response = {"thinking": event['thinking'], "response": event['response']}
+                                else:
+                                    yield {"type": f"sys2-{event['type']}", "content": event['content']}
+                        else:
+                            sys2_response = await self.sys2.aprocess(user_input, history, self.session_id)
+                    result = self._finish_sys2(sys2_response)
+                    await self._await_writes()
+                    yield result
                 
-        except Exception as e:
-            # 捕获处理过程中的任何异常
-            error_msg = f"处理失败: {str(e)}"
-            # 将错误消息记录到对话历史
+            except Exception as e:
+                error_msg = f"处理失败: {str(e)}"
+                tracer.set_status('error', error_msg)
+                self._add_message('系统', error_msg)
+                await self._await_writes()
+                yield {"type": "error", "content": error_msg}
+            finally:
+                # 调度失败或生成器被提前关闭时，不再保留推测任务
+                if speculation and not speculation['task'].done():
+                    speculation['task'].cancel()
+        
+    async def _arun_sys1(self, user_input: str, history: List[Dict[str, str]], stream: bool,
+                         speculation: Optional[Dict[str, Any]]) -> AsyncIterator[dict]:
+        """使用系统1生成回复
+        Args:
+            user_input: 用户输入的文本内容
+            history: 传给Agent的对话历史
+            stream: 是否输出增量事件
+            speculation: 已启动的推测任务，为None时直接调用sys1
+        Yields:
+            dict: 增量事件（仅stream为True时）和最终回复
+        """
+        if speculation is None:
+            with tracer.span('sys1'):
+                if stream:
+                    async for event in self.sys1.astream(user_input, history, self.session_id):
+                        if event['type'] == 'delta':
+                            yield {"type": "message-delta", "content": event['content']}
+                        else:
+                            response = event['content']
+                else:
+                    response = await self.sys1.aprocess(user_input, history, self.session_id)
+        else:
+            # 推测命中：直接使用已经在运行的sys1结果
+            if stream:
+                while True:
+                    event = await speculation['queue'].get()
+                    if event['type'] == 'delta':
+                        yield {"type": "message-delta", "content": event['content']}
+                    elif event['type'] == 'done':
+                        response = event['content']
+                        break
+                    else:
+                        raise event['error']
+            else:
+                await speculation['task']
+                if speculation['status'] == 'error':
+                    raise speculation['error']
+                response = speculation['response']
+            db.add_speculation_log(
+                session_id=self.session_id,
+                dispatcher_decision='sys1',
+                hit=True,
+                sys1_status=speculation['status'],
+                wasted_input_tokens=0,
+                wasted_output_tokens=0
+            )
+        self._add_message('赵敏敏', response)
+        yield {"type": "message", "content": response}
+        
+    def _start_speculation(self, user_input: str, history: List[Dict[str, str]], stream: bool) -> Dict[str, Any]:
+        """启动推测执行的sys1任务
+        Args:
+            user_input: 用户输入的文本内容
+            history: 传给Agent的对话历史
+            stream: 是否以流式方式调用sys1
+        Returns:
+            Dict[str, Any]: 推测任务状态，包含task、queue、status等字段
+        """
+        speculation = {"queue": asyncio.Queue(), "status": "running", "response": None, "error": None}
+        
+        async def run():
+            try:
+                with tracer.span('sys1', speculative=True):
+                    if stream:
+                        # 流式输出先缓存在队列中，等调度结果确定后再转发
+                        async for event in self.sys1.astream(user_input, history, self.session_id):
+                            speculation['queue'].put_nowait(event)
+                    else:
+                        speculation['response'] = await self.sys1.aprocess(user_input, history, self.session_id)
+                speculation['status'] = 'completed'
+            except Exception as e:
+                speculation['status'] = 'error'
+                speculation['error'] = e
+                speculation['queue'].put_nowait({"type": "error", "error": e})
+        
+        speculation['task'] = asyncio.create_task(run())
+        return speculation
+        
+    async def _abort_speculation(self, speculation: Dict[str, Any], decision: str):
+        """取消推测失败的sys1任务，并记录浪费的token
+        Args:
+            speculation: 推测任务状态
+            decision: 调度Agent的实际决策
+        """
+        task = speculation['task']
+        if task.done():
+            # sys1已经完成（或失败），其token消耗已经写入系统日志
+            wasted_input_tokens, wasted_output_tokens = self.sys1.last_usage
+        else:
+            # 请求尚未返回：取消sys1并等待其以cancelled状态写入日志，浪费的token按已收到的部分输出估算；
+            # 尚未开始调用模型时没有消耗
+            self.sys1.last_usage = (0, 0)
+            task.cancel()
+            await asyncio.wait([task])
+            speculation['status'] = 'cancelled'
+            wasted_input_tokens, wasted_output_tokens = self.sys1.last_usage
+        db.add_speculation_log(
+            session_id=self.session_id,
+            dispatcher_decision=decision,
+            hit=False,
+            sys1_status=speculation['status'],
+            wasted_input_tokens=wasted_input_tokens,
+            wasted_output_tokens=wasted_output_tokens
+        )
+        
+    def _finish_sys2(self, sys2_response: Any) -> dict:
+        """校验系统2的回复并写入对话历史
+        Args:
+            sys2_response: Sys2Agent返回的回复字典
+        Returns:
+            dict: 结构化的系统2响应，或错误信息
+        """
+        # 检查sys2的响应是否有效
+        if not isinstance(sys2_response, dict) or not sys2_response.get('response'):
+            error_msg = "系统2返回了无效的响应"
             self._add_message('系统', error_msg)
-            # 返回错误类型的消息
             return {"type": "error", "content": error_msg}
         
-    def _add_message(self, role: str, content: str):
+        # 将系统2的回复添加到对话历史，思考过程单独保存，只有按配置保留思考过程的Agent才会看到
+        self._add_message('赵敏敏', sys2_response['response'], sys2_response.get('thinking') or None)
+        
+        # 返回结构化的系统2响应，包含思考过程和回复内容
+        return {
+            "type": "sys2", 
+            "thinking": sys2_response.get("thinking", ""),  # 思考过程部分（可选）
+            "response": sys2_response["response"]   # 最终回复部分
+        }
+        
+    def _add_message(self, role: str, content: str, thinking: Optional[str] = None):
         """添加消息到对话历史
         Args:
             role: 发言角色（如'用户'、'赵敏敏'、'系统'等）
             content: 消息内容文本
+            thinking: sys2回复的思考过程
         """
         # 将新消息添加到内存中的对话历史列表
-        self.dialogue_history.append({
+        message = {
             'role': role,    # 消息发送者角色
             'content': content  # 消息内容
-        })
+        }
+        if thinking:
+            message['thinking'] = thinking  # sys2的思考过程
+        self.dialogue_history.append(message)
         
         # 如果对话历史超过最大长度，移除最早的消息
         if len(self.dialogue_history) > self.MAX_HISTORY_LENGTH:
-            self.dialogue_history.pop(0)
+            evicted = self.dialogue_history.pop(0)
+            if self.summarizer is not None:
+                # 移出的消息等待并入会话摘要
+                with self._summary_lock:
+                    self._evicted.append(evicted)
+                self._schedule_summary()
         
         # 同时将消息保存到数据库中，确保持久化存储
-        db.add_message(self.session_id, role, content)
+        db.add_message(self.session_id, role, content, thinking)
+        
+        # 更新会话状态，其他worker可以继续处理该会话
+        self._save_state()
+        
+    def _sync_state(self):
+        """从会话状态存储读取最新状态；存储中的版本更新时（其他worker处理过该会话）以存储中的为准"""
+        self._merge_state(self._load_state())
+        
+    def _load_state(self) -> Optional[Dict[str, Any]]:
+        """读取会话状态存储中的状态，读取失败时返回None"""
+        try:
+            return session_store.load(self.session_id)
+        except Exception as e:
+            print(f"读取会话状态失败: {str(e)}")
+            return None
+        
+    def _merge_state(self, state: Optional[Dict[str, Any]]):
+        """存储中的版本比本地新时，以存储中的状态为准
+        Args:
+            state: 从会话状态存储读取的状态
+        """
+        if state is None or state['version'] <= self._state_version:
+            return
+        with self._summary_lock:
+            self._state_version = state['version']
+            self.dialogue_history = state['history']
+            self._evicted = state['evicted']
+            self.summary = state['summary']
+        
+    def _save_state(self):
+        """把对话窗口、待并入摘要的消息和会话摘要写入会话状态存储"""
+        with self._summary_lock:
+            self._state_version += 1
+            state = {
+                'version': self._state_version,
+                'history': list(self.dialogue_history),
+                'evicted': list(self._evicted),
+                'summary': self.summary
+            }
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None:
+            self._store_state(state)
+            return
+        # 在事件循环中：存储可能因锁等待或网络往返而阻塞，放到线程池中执行，发送回复前由_await_writes等待
+        # 存储只接受更高的版本，多次保存的完成顺序不影响结果
+        future = loop.run_in_executor(None, self._store_state, state)
+        self._state_saves.add(future)
+        future.add_done_callback(self._state_saves.discard)
+        
+    def _store_state(self, state: Dict[str, Any]):
+        """把会话状态写入会话状态存储
+        Args:
+            state: _save_state生成的状态快照
+        """
+        try:
+            session_store.save(self.session_id, state)
+        except Exception as e:
+            # 状态存储不可用时不影响本轮对话，其他worker恢复该会话时从数据库加载
+            print(f"保存会话状态失败: {str(e)}")
+        
+    async def _await_writes(self):
+        """等待本轮的数据库写入提交和会话状态保存完成"""
+        await db.wait_for_writes()
+        if self._state_saves:
+            await asyncio.gather(*list(self._state_saves))
+        
+    def _context_history(self, user_input: Optional[str] = None) -> FormattedHistory:
+        """获取传给Agent的对话历史：会话摘要、与本轮输入相关的早期消息、尚未并入摘要的早期消息和对话窗口
+        会话摘要和检索到的早期消息标记为pinned，各Agent按token预算选取历史时总是保留；
+        本轮各Agent共用同一个FormattedHistory，每条消息只格式化一次
+        Args:
+            user_input: 本轮用户输入，用于检索早期消息；为None时不检索
+        Returns:
+            FormattedHistory: 对话历史列表
+        """
+        history = FormattedHistory()
+        with self._summary_lock:
+            if self.summary:
+                history.append({'role': '早前对话摘要', 'content': self.summary, 'pinned': True})
+            evicted = list(self._evicted)
+        recalled = self._retrieve(user_input, evicted) if user_input else []
+        if recalled:
+            history.append({'role': '相关的早前对话', 'content': recalled, 'pinned': True})
+        history.extend(evicted)
+        history.extend(self.dialogue_history)
+        return history
+        
+    async def _acontext_history(self, user_input: str) -> FormattedHistory:
+        """异步获取对话历史，结果与_context_history相同
+        检索早期消息需要查询数据库，会话的索引不在内存中时还要读取该会话的全部消息建立索引，
+        因此启用检索时放到线程池中执行，不阻塞事件循环
+        Args:
+            user_input: 本轮用户输入
+        Returns:
+            FormattedHistory: 对话历史列表
+        """
+        if self.retriever is None:
+            return self._context_history(user_input)
+        return await asyncio.to_thread(self._context_history, user_input)
+        
+    def _retrieve(self, user_input: str, evicted: List[Dict[str, Any]]) -> str:
+        """从数据库中找回与本轮输入相关、且不在对话历史中的早期消息
+        Args:
+            user_input: 本轮用户输入
+            evicted: 尚未并入摘要的早期消息（已在对话历史中）
+        Returns:
+            str: 每行一条"角色: 内容"，没有找回消息时为空字符串
+        """
+        if self.retriever is None:
+            return ''
+        with tracer.span('retrieval') as span:
+            try:
+                exclude = {msg['content'] for msg in evicted}
+                exclude.update(msg['content'] for msg in self.dialogue_history)
+                results = self.retriever.retrieve(self.session_id, user_input, exclude)
+            except Exception as e:
+                # 检索失败不影响本轮对话
+                print(f"检索早期消息失败: {str(e)}")
+                tracer.set_status('error', str(e))
+                return ''
+            if span is not None:
+                span.set_attribute('hits', len(results))
+        return '\n'.join(f"{item['role']}: {item['content']}" for item in results)
+        
+    def _schedule_summary(self):
+        """移出窗口的消息累计到batch_size条时，在后台更新会话摘要，不占用本轮的响应时间
+        在事件循环中（Web应用）以异步任务执行，否则（命令行）在后台线程中执行；同一时间只有一个更新
+        """
+        with self._summary_lock:
+            if self._summarizing or len(self._evicted) < self.summarizer.batch_size:
+                return
+            self._summarizing = True
+            batch = list(self._evicted)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            task = loop.create_task(self._arefresh_summary(batch))
+            self._summary_tasks.add(task)
+            task.add_done_callback(self._summary_tasks.discard)
+        else:
+            threading.Thread(target=self._refresh_summary, args=(batch,), name='summarizer', daemon=True).start()
+        
+    def _refresh_summary(self, batch: List[Dict[str, Any]]):
+        """把一批早期消息并入会话摘要
+        Args:
+            batch: 移出窗口的消息
+        """
+        summary = None
+        with tracer.start_trace('summary', session_id=self.session_id, messages=len(batch)):
+            try:
+                summary = self.summarizer.process(self.summary or '', batch, self.session_id)
+            except Exception as e:
+                tracer.set_status('error', str(e))
+                print(f"更新会话摘要失败: {str(e)}")
+        self._apply_summary(batch, summary)
+        
+    async def _arefresh_summary(self, batch: List[Dict[str, Any]]):
+        """异步把一批早期消息并入会话摘要
+        Args:
+            batch: 移出窗口的消息
+        """
+        summary = None
+        with tracer.start_trace('summary', session_id=self.session_id, messages=len(batch)):
+            try:
+                summary = await self.summarizer.aprocess(self.summary or '', batch, self.session_id)
+            except Exception as e:
+                tracer.set_status('error', str(e))
+                print(f"更新会话摘要失败: {str(e)}")
+        self._apply_summary(batch, summary)
+        
+    def _apply_summary(self, batch: List[Dict[str, Any]], summary: Optional[str]):
+        """保存新的会话摘要；失败时保留这批消息，下次移出消息时重试
+        Args:
+            batch: 已并入摘要的消息
+            summary: 新的摘要，失败时为None
+        """
+        with self._summary_lock:
+            if summary:
+                self.summary = summary
+                del self._evicted[:len(batch)]
+            self._summarizing = False
+        if summary:
+            db.update_session_summary(self.session_id, summary)
+            self._save_state()
         
     def _load_history(self) -> List[Dict[str, str]]:
         """从数据库加载当前会话的对话历史
@@ -117,11 +585,27 @@ class DialogueManager:
     
     def end_session(self):
         """结束当前会话，在数据库中标记会话已结束"""
-        # 在数据库中标记会话结束
-        db.end_session(self.session_id)
+        try:
+            state = session_store.load(self.session_id)
+        except Exception:
+            state = None
+        if state is None or state['version'] <= self._state_version:
+            # 在数据库中标记会话结束，并删除会话状态
+            db.end_session(self.session_id)
+            try:
+                session_store.delete(self.session_id)
+            except Exception as e:
+                print(f"删除会话状态失败: {str(e)}")
+        # 否则该会话之后已由其他worker继续处理，由那边结束会话
+        
         # 清理内存中的对话历史
-        self.clear_history()
+        self.dialogue_history = []
+        with self._summary_lock:
+            self._evicted = []
         
     def clear_history(self):
-        """清空内存中的对话历史，但不影响数据库中的记录"""
+        """清空对话历史，但不影响数据库中的记录"""
         self.dialogue_history = []
+        with self._summary_lock:
+            self._evicted = []
+        self._save_state()
@@ -0,0 +1,112 @@
+"""
+对冲请求模块
+记录各模型最近的响应时间，一次调用超过该模型以往的分位数（默认p90）仍未完成时再发出一个相同的请求，
+取先成功的结果并取消另一个；对冲请求的数量受预算限制（默认最多为请求数的5%）
+
+非流式调用按完整响应时间判断，流式调用按首个token的到达时间判断。
+"""
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.config import Config
+
+
+class LatencyWindow:
+    """最近若干次调用的耗时，用于估算分位数"""
+
+    def __init__(self, size: int = 200):
+        """初始化
+        Args:
+            size: 保留的样本数，超出时丢弃最早的样本
+        """
+        self.samples = deque(maxlen=size)
+        self._sorted: Optional[List[float]] = None  # 排序后的样本，新增样本时失效
+
+    def add(self, seconds: float):
+        """记录一次调用的耗时（秒）"""
+        self.samples.append(seconds)
+        self._sorted = None
+
+    def percentile(self, q: float) -> float:
+        """耗时的q分位数（秒），q取0~100"""
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+        index = min(len(self._sorted) - 1, int(len(self._sorted) * q / 100))
+        return self._sorted[index]
+
+
+class HedgePolicy:
+    """对冲策略：决定何时发出对冲请求，并限制对冲请求的比例"""
+
+    def __init__(self, enabled: bool = False, models: Iterable[str] = (), percentile: float = 90,
+                 min_samples: int = 20, window: int = 200, budget: float = 0.05, max_credits: float = 10,
+                 min_delay_ms: int = 50):
+        """初始化
+        Args:
+            enabled: 是否启用对冲请求
+            models: 启用对冲的模型
+            percentile: 超过以往耗时的该分位数时发出对冲请求
+            min_samples: 样本数达到该值之后才开始对冲
+            window: 每个模型保留的样本数
+            budget: 对冲请求最多占请求数的比例
+            max_credits: 预算最多累积的对冲次数，避免长时间空闲后集中对冲
+            min_delay_ms: 发出对冲请求前的最短等待时间（毫秒）
+        """
+        self.enabled = enabled
+        self.models = set(models)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.budget = budget
+        self.max_credits = max_credits
+        self.min_delay = min_delay_ms / 1000
+        self.credits = 0.0  # 每个请求累积budget次对冲，每次对冲消耗1次
+        self._latencies: Dict[Tuple[str, str], LatencyWindow] = {}
+
+    def applies(self, model: str) -> bool:
+        """该模型是否启用对冲"""
+        return self.enabled and model in self.models
+
+    def record(self, model: str, kind: str, seconds: float):
+        """记录一次成功调用的耗时
+        Args:
+            model: 模型名称
+            kind: request（非流式调用的响应时间）或first_token（流式调用的首个token时间）
+            seconds: 耗时（秒）
+        """
+        window = self._latencies.get((model, kind))
+        if window is None:
+            window = self._latencies[(model, kind)] = LatencyWindow(self.window)
+        window.add(seconds)
+
+    def delay(self, model: str, kind: str) -> Optional[float]:
+        """发出对冲请求前等待的时间（秒），样本不足时返回None（不对冲）"""
+        window = self._latencies.get((model, kind))
+        if window is None or len(window.samples) < self.min_samples:
+            return None
+        return max(self.min_delay, window.percentile(self.percentile))
+
+    def on_request(self):
+        """每发出一个请求累积一次预算"""
+        self.credits = min(self.max_credits, self.credits + self.budget)
+
+    def try_spend(self) -> bool:
+        """预算足够时消耗一次对冲，返回是否可以对冲"""
+        if self.credits < 1:
+            return False
+        self.credits -= 1
+        return True
+
+
+# 创建全局实例
+_hedging_config = Config().get_runtime_config().get('hedging', {}) or {}
+hedge_policy = HedgePolicy(
+    enabled=_hedging_config.get('enabled', False),
+    models=_hedging_config.get('models') or (),
+    percentile=_hedging_config.get('percentile', 90),
+    min_samples=_hedging_config.get('min_samples', 20),
+    window=_hedging_config.get('window', 200),
+    budget=_hedging_config.get('budget', 0.05),
+    max_credits=_hedging_config.get('max_credits', 10),
+    min_delay_ms=_hedging_config.get('min_delay_ms', 50)
+)
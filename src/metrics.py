@@ -0,0 +1,399 @@
+"""
+监控指标模块
+提供进程内的计数器、仪表和直方图，并以Prometheus文本格式导出
+
+热路径上的记录操作不加锁：每个线程写自己的分片，导出时再把各分片相加；直方图的桶在创建时预先分配。
+多个uvicorn worker时，设置环境变量METRICS_MULTIPROC_DIR（或runtime.metrics.multiprocess_dir），
+每个进程定期把自己的指标写入该目录下的JSON文件，/metrics合并所有进程的文件后输出；
+已退出进程留下的文件在进程启动和合并时删除，不再计入。
+"""
+import atexit
+import bisect
+import glob
+import json
+import math
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from src.config import Config
+
+
+def _format_value(value: float) -> str:
+    """按Prometheus文本格式输出数值"""
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """输出{name="value",...}形式的标签"""
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{escaped}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    """指标基类：每个线程一个分片，分片在线程首次记录时创建"""
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """初始化指标
+        Args:
+            name: 指标名称
+            documentation: 指标说明
+            labelnames: 标签名称
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> Dict[Tuple[str, ...], Any]:
+        """获取当前线程的分片，不存在时创建（每个线程只在第一次记录时加锁）"""
+        try:
+            return self._local.values
+        except AttributeError:
+            values = {}
+            self._local.values = values
+            with self._shards_lock:
+                self._shards.append(values)
+            return values
+
+    def _snapshots(self) -> List[Dict[Tuple[str, ...], Any]]:
+        """复制所有分片；dict.copy在持有GIL时完成，不会读到写了一半的分片"""
+        with self._shards_lock:
+            shards = list(self._shards)
+        return [shard.copy() for shard in shards]
+
+    def _sum_shards(self) -> Dict[Tuple[str, ...], float]:
+        """按标签值把所有分片中的数值相加"""
+        totals = {}
+        for shard in self._snapshots():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0.0) + value
+        return totals
+
+    def collect(self) -> Dict[Tuple[str, ...], Any]:
+        """合并所有分片
+        Returns:
+            Dict[Tuple[str, ...], Any]: 标签值 -> 指标值
+        """
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    type = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        """增加计数
+        Args:
+            labels: 标签值，顺序与labelnames一致
+            amount: 增加量
+        """
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0.0) + amount
+
+    def collect(self) -> Dict[Tuple[str, ...], float]:
+        return self._sum_shards()
+
+
+class Gauge(Metric):
+    """可增可减的仪表；也可以指定在导出时调用的取值函数"""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        """增加数值"""
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0.0) + amount
+
+    def dec(self, *labels: str, amount: float = 1.0):
+        """减少数值"""
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, function: Callable[[], float], *labels: str):
+        """导出时调用function获取当前值，适合队列长度等由其他对象维护的数值
+        Args:
+            function: 取值函数
+            labels: 标签值
+        """
+        self._functions[labels] = function
+
+    def collect(self) -> Dict[Tuple[str, ...], float]:
+        totals = self._sum_shards()
+        for labels, function in list(self._functions.items()):
+            try:
+                totals[labels] = totals.get(labels, 0.0) + float(function())
+            except Exception:
+                continue
+        return totals
+
+
+class Histogram(Metric):
+    """直方图：桶在创建时固定，记录时只做一次二分查找和两次加法"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        """初始化直方图
+        Args:
+            name: 指标名称
+            documentation: 指标说明
+            labelnames: 标签名称
+            buckets: 各桶的上界（升序），最后自动追加+Inf
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str):
+        """记录一个观测值
+        Args:
+            value: 观测值
+            labels: 标签值
+        """
+        shard = self._shard()
+        state = shard.get(labels)
+        if state is None:
+            # [各桶计数（非累计，最后一个为+Inf）, 总和]
+            state = [[0] * (len(self.buckets) + 1), 0.0]
+            shard[labels] = state
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def collect(self) -> Dict[Tuple[str, ...], Tuple[List[int], float]]:
+        totals = {}
+        for shard in self._snapshots():
+            for labels, (counts, total) in shard.items():
+                merged = totals.setdefault(labels, [[0] * len(counts), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+        return {labels: (counts, total) for labels, (counts, total) in totals.items()}
+
+
+class MetricsRegistry:
+    """指标注册表：创建指标、导出Prometheus文本，以及多进程模式下的合并"""
+
+    def __init__(self, multiprocess_dir: Optional[str] = None, dump_interval_seconds: float = 5.0):
+        """初始化注册表
+        Args:
+            multiprocess_dir: 多进程模式下存放各进程指标文件的目录，为None时只导出本进程的指标
+            dump_interval_seconds: 多进程模式下写入指标文件的间隔（秒）
+        """
+        self._metrics = {}
+        self.multiprocess_dir = multiprocess_dir
+        self.dump_interval_seconds = dump_interval_seconds
+        self._dumper = None
+        self._stop = threading.Event()
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        """创建并注册计数器"""
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        """创建并注册仪表"""
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Optional[Sequence[float]] = None) -> Histogram:
+        """创建并注册直方图"""
+        if buckets is None:
+            return self._register(Histogram(name, documentation, labelnames))
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric: Metric) -> Any:
+        if metric.name in self._metrics:
+            raise ValueError(f"指标已存在: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """导出本进程所有指标的当前值
+        Returns:
+            Dict[str, Dict[str, Any]]: 指标名称 -> {"type", "values": [[标签值列表, 值], ...]}
+        """
+        result = {}
+        for name, metric in self._metrics.items():
+            values = [[list(labels), value] for labels, value in metric.collect().items()]
+            result[name] = {'type': metric.type, 'values': values}
+        return result
+
+    def start(self):
+        """多进程模式下启动后台线程，定期写入本进程的指标文件"""
+        if not self.multiprocess_dir or self._dumper is not None:
+            return
+        os.makedirs(self.multiprocess_dir, exist_ok=True)
+        # 清理之前已退出的进程留下的文件
+        self._live_files()
+        self._dumper = threading.Thread(target=self._dump_loop, name='metrics-dump', daemon=True)
+        self._dumper.start()
+        atexit.register(self.dump)
+
+    def _dump_loop(self):
+        """后台线程：每dump_interval_seconds秒写入一次指标文件"""
+        while not self._stop.wait(self.dump_interval_seconds):
+            self.dump()
+
+    def dump(self):
+        """把本进程的指标写入多进程目录，先写临时文件再替换，读取方不会读到写了一半的文件"""
+        if not self.multiprocess_dir:
+            return
+        path = os.path.join(self.multiprocess_dir, f'metrics_{os.getpid()}.json')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'pid': os.getpid(), 'metrics': self.snapshot()}, f)
+        os.replace(tmp_path, path)
+
+    def _live_files(self) -> List[str]:
+        """多进程目录中仍在运行的进程的指标文件；已退出进程的文件直接删除
+        Returns:
+            List[str]: 文件路径
+        """
+        paths = []
+        for path in glob.glob(os.path.join(self.multiprocess_dir, 'metrics_*.json')):
+            try:
+                pid = int(os.path.basename(path)[len('metrics_'):-len('.json')])
+            except ValueError:
+                continue
+            if _pid_alive(pid):
+                paths.append(path)
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return paths
+
+    def _merged_snapshot(self) -> Dict[str, Dict[Tuple[str, ...], Any]]:
+        """合并多进程目录中所有运行中进程的指标，需要读取文件，在事件循环中应放到线程池中执行"""
+        self.dump()
+        merged = {name: {} for name in self._metrics}
+        for path in self._live_files():
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, entry in data.get('metrics', {}).items():
+                if name not in merged:
+                    continue
+                values = merged[name]
+                for labels, value in entry['values']:
+                    labels = tuple(labels)
+                    if entry['type'] == 'histogram':
+                        counts, total = value
+                        current = values.get(labels)
+                        if current is None:
+                            values[labels] = (list(counts), total)
+                        else:
+                            values[labels] = ([a + b for a, b in zip(current[0], counts)], current[1] + total)
+                    else:
+                        values[labels] = values.get(labels, 0.0) + value
+        return merged
+
+    def render(self) -> str:
+        """输出Prometheus文本格式（0.0.4）
+        Returns:
+            str: 所有指标的文本
+        """
+        if self.multiprocess_dir:
+            collected = self._merged_snapshot()
+        else:
+            collected = {name: metric.collect() for name, metric in self._metrics.items()}
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for labels, value in sorted(collected.get(name, {}).items()):
+                if metric.type == 'histogram':
+                    counts, total = value
+                    cumulative = 0
+                    for bound, count in zip(list(metric.buckets) + [math.inf], counts):
+                        cumulative += count
+                        bucket_labels = _format_labels(metric.labelnames + ('le',),
+                                                       labels + (_format_value(bound),))
+                        lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+                    label_text = _format_labels(metric.labelnames, labels)
+                    lines.append(f'{name}_sum{label_text} {_format_value(total)}')
+                    lines.append(f'{name}_count{label_text} {cumulative}')
+                else:
+                    suffix = '_total' if metric.type == 'counter' and not name.endswith('_total') else ''
+                    lines.append(f'{name}{suffix}{_format_labels(metric.labelnames, labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid: int) -> bool:
+    """检查进程是否仍在运行"""
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+# 创建全局注册表
+_metrics_config = Config().get_runtime_config().get('metrics', {}) or {}
+registry = MetricsRegistry(
+    multiprocess_dir=os.getenv('METRICS_MULTIPROC_DIR') or _metrics_config.get('multiprocess_dir'),
+    dump_interval_seconds=_metrics_config.get('dump_interval_seconds', 5)
+)
+
+# 模型调用
+model_call_seconds = registry.histogram(
+    'model_call_seconds', '模型调用耗时（秒，包含重试）', ('model', 'outcome'),
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60, 120)
+)
+model_retries = registry.counter('model_retries_total', '模型调用的重试次数', ('model',))
+model_hedges = registry.counter(
+    'model_hedges_total', '发出的对冲请求数，按先成功的请求（primary/hedge，都失败为failed）', ('model', 'winner')
+)
+model_queue_wait_seconds = registry.histogram(
+    'model_queue_wait_seconds', '模型调用在调度器中排队等待的时间（秒）', ('model', 'priority'),
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+)
+
+# 调度
+dispatch_decisions = registry.counter(
+    'dispatch_decisions_total', '调度结果（sys1/sys2）及决策来源', ('decision', 'source')
+)
+
+# WebSocket
+websocket_connections = registry.gauge('websocket_connections', '当前的WebSocket连接数')
+
+# 数据库
+db_write_seconds = registry.histogram(
+    'db_write_seconds', '数据库写入提交耗时（秒）', ('mode',),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+)
+db_write_batch_size = registry.histogram(
+    'db_write_batch_size', '后台线程每批提交的写入条数', (),
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500)
+)
+db_writes_dropped = registry.counter('db_writes_dropped_total', '写入积压过多时事件循环中被丢弃的数据库写入数')
+queue_depth = registry.gauge('queue_depth', '队列中等待处理的条目数', ('queue',))
+
+# 事件循环
+event_loop_lag_seconds = registry.histogram(
+    'event_loop_lag_seconds', '事件循环延迟（秒）：定时唤醒的实际时间比预定时间晚了多久', (),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
@@ -2,17 +2,80 @@
 模型API调用模块
 处理与百炼平台API的交互
 """
+import asyncio
 import os
 import time
-from typing import Dict, Any, Tuple
-from openai import OpenAI
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Optional, Tuple, AsyncIterator, Awaitable, Callable, List
+from openai import OpenAI, AsyncOpenAI
 from openai import APITimeoutError, APIError
 from dotenv import load_dotenv
 import backoff  # 用于实现重试机制
+from src.context import estimate_tokens
+from src.hedging import hedge_policy
+from src.metrics import model_call_seconds, model_hedges, model_queue_wait_seconds, model_retries
+from src.scheduler import Ticket, scheduler
+from src.tracing import traced, tracer
 
 # 加载环境变量
 load_dotenv()
 
+# 百炼平台OpenAI兼容模式的默认地址；可用环境变量DASHSCOPE_BASE_URL指向本地的模拟服务
+DEFAULT_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+
+# 当前上下文中最近一次模型调用的排队时间（毫秒），Agent记录日志时读取
+_queue_wait_ms: ContextVar[Optional[int]] = ContextVar('queue_wait_ms', default=None)
+# 当前上下文中最近一次模型调用的对冲结果：None（未对冲）、primary、hedge（先成功的请求）或failed（都失败）
+_hedge_status: ContextVar[Optional[str]] = ContextVar('hedge_status', default=None)
+
+def _record_retry(details: Dict[str, Any]):
+    """backoff重试回调：更新重试计数器并记录重试指标
+    Args:
+        details: backoff提供的调用信息，args为(self, prompt, model)
+    """
+    setattr(details['args'][0], '_retry_count', details['tries'])
+    model_retries.inc(details['args'][2])
+    # 回调在等待之前执行，按即将等待的时长记录重试等待的span
+    now = time.time()
+    tracer.record_span('model.backoff', now, now + details['wait'],
+                       model=details['args'][2], tries=details['tries'])
+
+def _estimate_prompt_tokens(prompt: str) -> int:
+    """预估prompt的token数用于TPM限流：渲染的prompt按片段估算（对话历史的片段已有缓存），其他文本按字符数计"""
+    segments = getattr(prompt, 'segments', None)
+    if segments is None:
+        return len(prompt)
+    return sum(estimate_tokens(segment) for segment in segments)
+
+class _BufferedStream:
+    """已读出开头若干chunk的流式响应：先返回已读出的chunk，再继续读取原来的流"""
+
+    def __init__(self, stream, chunks: List[Any]):
+        self.stream = stream
+        self.chunks = deque(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.chunks:
+            return self.chunks.popleft()
+        return await self.stream.__anext__()
+
+    async def close(self):
+        """关闭HTTP流"""
+        await self.stream.close()
+
+def _call_outcome(error: Optional[str]) -> str:
+    """根据错误信息得到调用结果的指标标签（success/timeout/error）"""
+    if not error:
+        return 'success'
+    if error == "请求超时，请稍后重试":
+        return 'timeout'
+    return 'error'
+
 class ModelAPI:
     """百炼平台模型API封装"""
     
@@ -22,11 +85,18 @@ class ModelAPI:
         self.api_key = os.getenv('DASHSCOPE_API_KEY')
         if not self.api_key:
             raise ValueError("未找到DASHSCOPE_API_KEY环境变量")
+        # API地址：默认为百炼平台，压测时指向本地的模拟服务（benchmarks/mock_model_server.py）
+        self.base_url = os.getenv('DASHSCOPE_BASE_URL') or DEFAULT_BASE_URL
             
         # 初始化OpenAI客户端
         self.client = OpenAI(
             api_key=self.api_key,
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
+            base_url=self.base_url
+        )
+        # 异步客户端：供Web应用在事件循环中使用，避免阻塞其他连接
+        self.async_client = AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url
         )
         
         # 模型配置
@@ -34,6 +104,16 @@ class ModelAPI:
         self.qwen_model = "qwen2.5-14b-instruct-1m"
         self.deepseek_model = "deepseek-r1"
         
+        # 异步调用经过调度器排队；未指定优先级时按模型的用途决定
+        self.scheduler = scheduler
+        self.default_priorities = {
+            self.intent_model: 'dispatcher',
+            self.qwen_model: 'sys1',
+            self.deepseek_model: 'sys2',
+        }
+        # 对冲请求策略（runtime.hedging，默认不启用）
+        self.hedging = hedge_policy
+        
         # 重试配置
         self.max_retries = 3
         self.max_time = 30  # 最大重试时间（秒）
@@ -89,8 +169,9 @@ class ModelAPI:
         (APITimeoutError, APIError),
         max_tries=3,
         max_time=30,
-        on_backoff=lambda details: setattr(details['args'][0], '_retry_count', details['tries'])
+        on_backoff=_record_retry
     )
+    @traced('model.request', record_args=('model',))
     def _make_request(self, prompt: str, model: str) -> Tuple[str, int, int, int, str]:
         """发送API请求
         Args:
@@ -104,6 +185,9 @@ class ModelAPI:
             - 输出token数量
             - 错误信息（如果有）
         """
+        # 同步调用不经过调度器，也不对冲
+        _queue_wait_ms.set(None)
+        _hedge_status.set(None)
         start_time = time.time()  # 开始计时
         try:
             # 创建聊天完成请求
@@ -132,6 +216,7 @@ class ModelAPI:
             
             # 重置重试计数器
             self._retry_count = 0
+            model_call_seconds.observe(time.time() - start_time, model, 'success')
             
             return (
                 output_text,
@@ -144,6 +229,8 @@ class ModelAPI:
             error_msg = "请求超时，正在重试..."
             print(f"API调用超时: {error_msg}")
             if self._retry_count >= self.max_retries - 1:
+                model_call_seconds.observe(time.time() - start_time, model, 'timeout')
+                tracer.set_status('error', "请求超时，请稍后重试")
                 return "", int((time.time() - start_time) * 1000), 0, 0, "请求超时，请稍后重试"
             raise
         except Exception as e:
@@ -151,9 +238,384 @@ class ModelAPI:
             print(f"API调用错误: {error_msg}")
             # 如果是最后一次重试，返回错误信息
             if self._retry_count >= self.max_retries - 1:
+                model_call_seconds.observe(time.time() - start_time, model, 'error')
+                tracer.set_status('error', error_msg)
                 return "", int((time.time() - start_time) * 1000), 0, 0, error_msg
             # 否则继续重试
             raise
 
+    async def acall_intent(self, prompt: str, priority: Optional[str] = None) -> Tuple[str, int, int, int, str]:
+        """异步调用通义千问模型进行意图识别
+        Args:
+            prompt: 输入的prompt文本
+            priority: 排队的优先级（见src.scheduler.PRIORITIES）
+        Returns:
+            Tuple[str, int, int, int, str]: 与call_intent相同
+        """
+        return await self._amake_request(prompt, self.intent_model, priority)
+
+    async def acall_qwen(self, prompt: str, priority: Optional[str] = None) -> Tuple[str, int, int, int, str]:
+        """异步调用通义千问模型
+        Args:
+            prompt: 输入的prompt文本
+            priority: 排队的优先级（见src.scheduler.PRIORITIES）
+        Returns:
+            Tuple[str, int, int, int, str]: 与call_qwen相同
+        """
+        return await self._amake_request(prompt, self.qwen_model, priority)
+
+    async def acall_deepseek(self, prompt: str, priority: Optional[str] = None) -> Tuple[str, int, int, int, str]:
+        """异步调用DeepSeek R1模型
+        Args:
+            prompt: 输入的prompt文本
+            priority: 排队的优先级（见src.scheduler.PRIORITIES）
+        Returns:
+            Tuple[str, int, int, int, str]: 与call_deepseek相同
+        """
+        return await self._amake_request(prompt, self.deepseek_model, priority)
+
+    def last_queue_wait_ms(self) -> Optional[int]:
+        """当前上下文中最近一次模型调用在调度器中排队的时间（毫秒），同步调用返回None"""
+        return _queue_wait_ms.get()
+
+    def last_hedge_status(self) -> Optional[str]:
+        """当前上下文中最近一次模型调用的对冲结果，未对冲时返回None"""
+        return _hedge_status.get()
+
+    @asynccontextmanager
+    async def _scheduled(self, prompt: str, model: str, priority: Optional[str]) -> AsyncIterator[Ticket]:
+        """在调度器分配的资源内执行一次调用（含重试），结束时归还资源
+        排队时间单独记录，不计入响应时间；调用方可设置ticket.tokens_used按实际用量修正TPM限额
+        Args:
+            prompt: 输入的prompt文本
+            model: 模型名称
+            priority: 优先级名称，为None时按模型的用途决定
+        Yields:
+            Ticket: 分配到的资源
+        """
+        priority = priority or self.default_priorities.get(model, 'sys1')
+        _hedge_status.set(None)
+        start_time = time.time()
+        try:
+            ticket = await self.scheduler.acquire(model, priority, _estimate_prompt_tokens(prompt))
+        finally:
+            # 排队时被取消也记录已等待的时间
+            wait = time.time() - start_time
+            _queue_wait_ms.set(int(wait * 1000))
+            model_queue_wait_seconds.observe(wait, model, priority)
+            if wait >= 0.001:
+                tracer.record_span('model.queue', start_time, start_time + wait, model=model, priority=priority)
+        try:
+            yield ticket
+        finally:
+            self.scheduler.release(ticket)
+
+    async def _ahedged(self, prompt: str, model: str, priority: str, kind: str,
+                       attempt: Callable[[], Awaitable[Any]],
+                       discard: Optional[Callable[[Any], Awaitable[None]]] = None) -> Any:
+        """发出一次请求；模型启用了对冲且超过以往耗时的分位数仍未完成时，再发出一个相同的请求，
+        取先成功的结果并取消另一个。对冲请求须在预算之内，并且调度器有空闲资源（不排队）
+        Args:
+            prompt: 输入的prompt文本
+            model: 模型名称
+            priority: 优先级名称，后台调用不对冲
+            kind: request（按完整响应时间判断）或first_token（按首个token时间判断）
+            attempt: 发出一次请求的协程函数
+            discard: 释放落后的请求已得到的结果（如关闭流式连接）
+        Returns:
+            Any: 先成功的请求的结果；都失败时抛出主请求的异常
+        """
+        if not self.hedging.applies(model) or priority == 'background':
+            return await attempt()
+        
+        self.hedging.on_request()
+        start_time = time.time()
+        primary_seconds = []  # 主请求自身的耗时，成功完成时才有
+        
+        async def run_primary():
+            result = await attempt()
+            primary_seconds.append(time.time() - start_time)
+            return result
+        
+        primary = asyncio.ensure_future(run_primary())
+        tasks = [primary]
+        winner = None
+        hedge_ticket = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedging.delay(model, kind))
+            if not done:
+                hedge_ticket = self.scheduler.try_acquire(model, priority, _estimate_prompt_tokens(prompt))
+                if hedge_ticket is not None and not self.hedging.try_spend():
+                    self.scheduler.release(hedge_ticket)
+                    hedge_ticket = None
+            if hedge_ticket is None:
+                await asyncio.wait(tasks)
+                winner = primary
+            else:
+                hedge_start = time.time()
+                tasks.append(asyncio.ensure_future(attempt()))
+                pending = set(tasks)
+                while pending and winner is None:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    # 同时完成时优先采用主请求
+                    winner = next((task for task in tasks if task in done and task.exception() is None), None)
+                status = 'failed' if winner is None else ('primary' if winner is primary else 'hedge')
+                winner = winner or primary
+                _hedge_status.set(status)
+                model_hedges.inc(model, status)
+                tracer.record_span('model.hedge', hedge_start, time.time(), model=model, kind=kind, winner=status)
+            return winner.result()
+        finally:
+            # 取消落后的请求，释放已完成的落后请求得到的结果
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # 只按主请求自身的耗时估算分位数；对冲请求先完成时主请求被取消，实际耗时未知，不记录
+            if primary_seconds:
+                self.hedging.record(model, kind, primary_seconds[0])
+            if discard is not None:
+                for task in tasks:
+                    if task is not winner and not task.cancelled() and task.exception() is None:
+                        await discard(task.result())
+            if hedge_ticket is not None:
+                self.scheduler.release(hedge_ticket)
+
+    async def _amake_request(self, prompt: str, model: str, priority: Optional[str] = None) -> Tuple[str, int, int, int, str]:
+        """异步发送API请求，重试策略与_make_request一致
+        每次调用单独计数重试次数，并发请求之间互不影响；请求前在调度器中排队
+        Args:
+            prompt: 输入的prompt文本
+            model: 模型名称
+            priority: 排队的优先级
+        Returns:
+            Tuple[str, int, int, int, str]: 与_make_request相同
+        """
+        async with self._scheduled(prompt, model, priority) as ticket:
+            start_time = time.time()  # 开始计时（不含排队时间）
+            try:
+                output = await self._ahedged(prompt, model, ticket.priority, 'request',
+                                             lambda: self._arequest_with_retry(prompt, model))
+                if _hedge_status.get() == 'hedge':
+                    # 对冲请求较晚发出，响应时间从主请求发出时算起
+                    output = (output[0], int((time.time() - start_time) * 1000)) + output[2:]
+            except asyncio.CancelledError:
+                # 调用方被取消（客户端断开、发送了新消息或cancel帧）：请求随之中断，不再重试
+                model_call_seconds.observe(time.time() - start_time, model, 'cancelled')
+                raise
+            except APITimeoutError:
+                # 重试次数用尽后仍然超时
+                output = "", int((time.time() - start_time) * 1000), 0, 0, "请求超时，请稍后重试"
+            except Exception as e:
+                # 重试次数用尽或出现不可重试的错误
+                output = "", int((time.time() - start_time) * 1000), 0, 0, str(e)
+            ticket.tokens_used = output[2] + output[3]
+        model_call_seconds.observe(time.time() - start_time, model, _call_outcome(output[4]))
+        return output
+
+    @backoff.on_exception(
+        backoff.expo,
+        (APITimeoutError, APIError),
+        max_tries=3,
+        max_time=30,
+        on_backoff=_record_retry
+    )
+    @traced('model.request', record_args=('model',))
+    async def _arequest_with_retry(self, prompt: str, model: str) -> Tuple[str, int, int, int, str]:
+        """发送单次异步API请求，失败时抛出异常交由backoff重试
+        Args:
+            prompt: 输入的prompt文本
+            model: 模型名称
+        Returns:
+            Tuple[str, int, int, int, str]: 与_make_request相同
+        """
+        start_time = time.time()  # 开始计时
+        try:
+            # 创建聊天完成请求
+            completion = await self.async_client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": prompt}
+                ],
+                timeout=self.request_timeout  # 设置请求超时时间
+            )
+        except APITimeoutError:
+            print("API调用超时: 请求超时，正在重试...")
+            raise
+        except Exception as e:
+            print(f"API调用错误: {str(e)}")
+            raise
+
+        # 计算响应时间（毫秒）
+        response_time = int((time.time() - start_time) * 1000)
+
+        # 提取响应信息
+        response = completion.model_dump()
+        usage = response['usage']
+
+        return (
+            response['choices'][0]['message']['content'],
+            response_time,
+            usage['prompt_tokens'],
+            usage['completion_tokens'],
+            None
+        )
+
+    def astream_qwen(self, prompt: str, priority: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """流式调用通义千问模型
+        Args:
+            prompt: 输入的prompt文本
+            priority: 排队的优先级（见src.scheduler.PRIORITIES）
+        Returns:
+            AsyncIterator[Dict[str, Any]]: 事件流，格式见_astream_request
+        """
+        return self._astream_request(prompt, self.qwen_model, priority)
+
+    def astream_deepseek(self, prompt: str, priority: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """流式调用DeepSeek R1模型（包含推理内容）
+        Args:
+            prompt: 输入的prompt文本
+            priority: 排队的优先级（见src.scheduler.PRIORITIES）
+        Returns:
+            AsyncIterator[Dict[str, Any]]: 事件流，格式见_astream_request
+        """
+        return self._astream_request(prompt, self.deepseek_model, priority)
+
+    @traced('model.stream', record_args=('model',))
+    async def _astream_request(self, prompt: str, model: str, priority: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """以流式方式发送API请求
+        请求前在调度器中排队，直到输出结束才归还资源；建立连接阶段的失败按_make_request的策略重试，开始输出后不再重试。
+        调用方被取消或提前关闭事件流时关闭HTTP流，服务端随之停止生成
+        Args:
+            prompt: 输入的prompt文本
+            model: 模型名称
+            priority: 排队的优先级
+        Yields:
+            Dict[str, Any]: 
+            - {"type": "reasoning", "content": 推理内容片段}
+            - {"type": "content", "content": 回复内容片段}
+            - 最后一个事件 {"type": "done", "text": 完整回复, "reasoning": 完整推理内容,
+              "response_time_ms": 响应时间（不含排队时间）, "first_token_ms": 首个token时间,
+              "input_tokens": 输入token数量, "output_tokens": 输出token数量, "error": 错误信息}
+        """
+        first_token_ms = None
+        text_parts = []
+        reasoning_parts = []
+        input_tokens = 0
+        output_tokens = 0
+        error = None
+        stream = None
+        
+        async with self._scheduled(prompt, model, priority) as ticket:
+            start_time = time.time()  # 开始计时（不含排队时间）
+            try:
+                stream = await self._ahedged(prompt, model, ticket.priority, 'first_token',
+                                             lambda: self._aopen_first_chunk(prompt, model),
+                                             discard=lambda opened: opened.close())
+                async for chunk in stream:
+                    # 最后一个chunk只携带token使用情况
+                    if chunk.usage:
+                        input_tokens = chunk.usage.prompt_tokens
+                        output_tokens = chunk.usage.completion_tokens
+                    if not chunk.choices:
+                        continue
+                    
+                    delta = chunk.choices[0].delta
+                    reasoning = getattr(delta, 'reasoning_content', None)
+                    content = delta.content
+                    if (reasoning or content) and first_token_ms is None:
+                        first_token_ms = int((time.time() - start_time) * 1000)
+                    if reasoning:
+                        reasoning_parts.append(reasoning)
+                        yield {"type": "reasoning", "content": reasoning}
+                    if content:
+                        text_parts.append(content)
+                        yield {"type": "content", "content": content}
+            except APITimeoutError:
+                error = "请求超时，请稍后重试"
+            except Exception as e:
+                # 重试次数用尽，或输出过程中连接中断
+                error = str(e)
+            except (asyncio.CancelledError, GeneratorExit):
+                # 调用方被取消或不再读取：不再重试
+                model_call_seconds.observe(time.time() - start_time, model, 'cancelled')
+                raise
+            finally:
+                # 无论正常结束、输出中断还是被取消，都关闭HTTP流，释放连接
+                if stream is not None:
+                    await stream.close()
+            ticket.tokens_used = input_tokens + output_tokens
+        
+        model_call_seconds.observe(time.time() - start_time, model, _call_outcome(error))
+        if error:
+            tracer.set_status('error', error)
+        yield {
+            "type": "done",
+            "text": "".join(text_parts),
+            "reasoning": "".join(reasoning_parts),
+            "response_time_ms": int((time.time() - start_time) * 1000),
+            "first_token_ms": first_token_ms,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "error": error
+        }
+
+    async def _aopen_first_chunk(self, prompt: str, model: str) -> _BufferedStream:
+        """建立流式请求连接并读到第一个带内容的chunk，按首个token的时间对冲时以此为一次请求
+        Args:
+            prompt: 输入的prompt文本
+            model: 模型名称
+        Returns:
+            _BufferedStream: 包含已读出chunk的流
+        """
+        stream = await self._aopen_stream(prompt, model)
+        chunks = []
+        try:
+            async for chunk in _BufferedStream(stream, []):
+                chunks.append(chunk)
+                if chunk.choices and (chunk.choices[0].delta.content
+                                      or getattr(chunk.choices[0].delta, 'reasoning_content', None)):
+                    break
+        except BaseException:
+            # 被取消（对冲中落后的请求）或读取失败时关闭连接
+            await stream.close()
+            raise
+        return _BufferedStream(stream, chunks)
+
+    @backoff.on_exception(
+        backoff.expo,
+        (APITimeoutError, APIError),
+        max_tries=3,
+        max_time=30,
+        on_backoff=_record_retry
+    )
+    @traced('model.connect', record_args=('model',))
+    async def _aopen_stream(self, prompt: str, model: str):
+        """建立流式请求连接，失败时抛出异常交由backoff重试
+        Args:
+            prompt: 输入的prompt文本
+            model: 模型名称
+        Returns:
+            AsyncStream: 模型输出的chunk流
+        """
+        try:
+            return await self.async_client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": prompt}
+                ],
+                stream=True,
+                stream_options={"include_usage": True},  # 在最后一个chunk中返回token使用情况
+                timeout=self.request_timeout
+            )
+        except APITimeoutError:
+            print("API调用超时: 请求超时，正在重试...")
+            raise
+        except Exception as e:
+            print(f"API调用错误: {str(e)}")
+            raise
+
 # 创建全局实例
 api = ModelAPI()
@@ -0,0 +1,271 @@
+"""
+Prompt存储模块
+把渲染后的prompt拆成模板片段、对话历史的各行和用户输入，按内容摘要去重并压缩存储，
+system_logs中只保存片段摘要的引用，查看日志时再还原完整prompt
+
+命令行用法（转换已有数据库并输出空间报告）：
+    python -m src.prompt_store [--db 数据库路径] [--batch-size 500] [--vacuum] [--report-only]
+"""
+import argparse
+import functools
+import hashlib
+import string
+import zlib
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+try:
+    import zstandard  # 可选依赖，安装后优先使用zstd压缩
+except ImportError:
+    zstandard = None
+
+# 片段摘要的字节数，input_ref为各片段摘要依次拼接的二进制串
+HASH_SIZE = 8
+
+# 支持的压缩算法；压缩后不小于原文时按原文(raw)存储，短片段通常如此
+CODECS = ('raw', 'zlib', 'zstd')
+
+
+class RenderedPrompt(str):
+    """渲染后的prompt：本身是完整的prompt文本，同时保留组成它的片段、用户输入和对话历史省去的token数"""
+
+    def __new__(cls, segments: List[str], user_input: Optional[str] = None,
+                context_trimmed_tokens: Optional[int] = None):
+        prompt = super().__new__(cls, ''.join(segments))
+        prompt.segments = segments
+        prompt.user_input = user_input
+        prompt.context_trimmed_tokens = context_trimmed_tokens
+        return prompt
+
+
+@functools.lru_cache(maxsize=64)
+def parse_template(template: str) -> Tuple[Tuple[str, Optional[str]], ...]:
+    """预先解析prompt模板；同一模板在进程内只解析一次，各会话的Agent共用解析结果
+    Args:
+        template: 使用{字段名}占位的prompt模板
+    Returns:
+        Tuple[Tuple[str, Optional[str]], ...]: (字面文本, 其后的字段名)序列，最后一项的字段名可能为None
+    """
+    return tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(template))
+
+
+def render_template(parsed: Sequence[Tuple[str, Optional[str]]],
+                    values: Dict[str, Union[str, List[str]]]) -> List[str]:
+    """按预解析的模板渲染prompt片段，片段拼接后与template.format(**values)一致
+    Args:
+        parsed: parse_template的结果
+        values: 字段值；值为列表时（如逐条格式化的对话历史）每个元素各为一个片段，使历史消息可以跨调用去重
+    Returns:
+        List[str]: prompt片段
+    """
+    segments = []
+    for literal, field in parsed:
+        if literal:
+            segments.append(literal)
+        if field is None:
+            continue
+        value = values[field]
+        if isinstance(value, str):
+            segments.append(value)
+        else:
+            segments.extend(value)
+    return segments
+
+
+def split_rendered(prompt: str, template: str) -> Optional[Tuple[List[str], Dict[str, str]]]:
+    """按模板把已渲染的prompt拆回片段，用于转换旧日志
+    Args:
+        prompt: 渲染后的完整prompt
+        template: 渲染时使用的模板
+    Returns:
+        Optional[Tuple[List[str], Dict[str, str]]]: (prompt片段, 各字段的值)；与模板不匹配时返回None
+    """
+    parsed = parse_template(template)
+    segments = []
+    values = {}
+    pos = 0
+    for index, (literal, field) in enumerate(parsed):
+        if not prompt.startswith(literal, pos):
+            return None
+        if literal:
+            segments.append(literal)
+        pos += len(literal)
+        if field is None:
+            continue
+        # 字段值延伸到下一段字面文本；与extract_user_input一样从后往前找，多行的值按行拆分
+        following = parsed[index + 1][0] if index + 1 < len(parsed) else ''
+        if index + 1 >= len(parsed) or following == '':
+            end = len(prompt)
+        else:
+            end = prompt.rfind(following, pos)
+            if end < 0:
+                return None
+        values[field] = prompt[pos:end]
+        segments.extend(values[field].splitlines(keepends=True))
+        pos = end
+    if ''.join(segments) != prompt:
+        return None
+    return segments, values
+
+
+def segment_hash(text: str) -> bytes:
+    """计算片段的内容摘要
+    Args:
+        text: 片段文本
+    Returns:
+        bytes: HASH_SIZE字节的摘要
+    """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=HASH_SIZE).digest()
+
+
+def compress(text: str, codec: str = 'auto') -> Tuple[str, bytes]:
+    """压缩片段
+    Args:
+        text: 片段文本
+        codec: 压缩算法，auto表示安装了zstandard时用zstd，否则用zlib
+    Returns:
+        Tuple[str, bytes]: (实际使用的压缩算法, 压缩后的数据)
+    """
+    raw = text.encode('utf-8')
+    if codec == 'auto':
+        codec = 'zstd' if zstandard is not None else 'zlib'
+    if codec == 'zstd':
+        data = zstandard.ZstdCompressor(level=3).compress(raw)
+    elif codec == 'zlib':
+        data = zlib.compress(raw, 6)
+    else:
+        return 'raw', raw
+    if len(data) >= len(raw):
+        return 'raw', raw
+    return codec, data
+
+
+def decompress(codec: str, data: bytes) -> str:
+    """解压片段
+    Args:
+        codec: 压缩算法
+        data: 压缩后的数据
+    Returns:
+        str: 片段文本
+    """
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("该片段使用zstd压缩，需要安装zstandard")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'zlib':
+        data = zlib.decompress(data)
+    return bytes(data).decode('utf-8')
+
+
+def parse_ref(ref: Optional[bytes]) -> List[bytes]:
+    """解析system_logs.input_ref中的片段摘要列表"""
+    if not ref:
+        return []
+    return [bytes(ref[i:i + HASH_SIZE]) for i in range(0, len(ref), HASH_SIZE)]
+
+
+def join_ref(ref: bytes, blobs: Dict[bytes, str]) -> str:
+    """按引用拼接完整prompt
+    Args:
+        ref: 片段摘要列表
+        blobs: 摘要 -> 片段文本
+    Returns:
+        str: 完整prompt；缺失的片段用占位文本代替
+    """
+    return ''.join(blobs.get(key, f'[缺失的片段 {key.hex()}]') for key in parse_ref(ref))
+
+
+class PromptStore:
+    """把prompt片段编码为内容摘要引用，记录已写入的片段以避免重复写入"""
+
+    def __init__(self, codec: str = 'auto', max_known: int = 100000):
+        """初始化
+        Args:
+            codec: 压缩算法（auto/zstd/zlib/raw）
+            max_known: 内存中记录的已写入片段数上限，超过后清空重新记录
+        """
+        if codec not in CODECS + ('auto',):
+            raise ValueError(f"不支持的压缩算法: {codec}")
+        self.codec = codec
+        self.max_known = max_known
+        self._known = set()
+
+    def encode(self, segments: Iterable[str]) -> Tuple[bytes, List[tuple]]:
+        """把片段编码为引用
+        Args:
+            segments: prompt片段
+        Returns:
+            Tuple[bytes, List[tuple]]: (引用, 需要写入prompt_blobs的(摘要, 压缩算法, 数据, 原始字节数)列表)
+        """
+        keys = []
+        blobs = []
+        for text in segments:
+            key = segment_hash(text)
+            keys.append(key)
+            if key in self._known:
+                continue
+            codec, data = compress(text, self.codec)
+            blobs.append((key, codec, data, len(text.encode('utf-8'))))
+            if len(self._known) >= self.max_known:
+                self._known.clear()
+            self._known.add(key)
+        return b''.join(keys), blobs
+
+
+def _format_size(size: int) -> str:
+    """格式化字节数"""
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def print_report(report: Dict[str, int]):
+    """打印prompt存储的空间报告"""
+    referenced = report['referenced_prompt_bytes']
+    stored = report['blob_stored_bytes'] + report['ref_bytes']
+    print(f"日志条数: {report['log_rows']}（已转换 {report['converted_rows']}，"
+          f"未转换 {report['legacy_rows']}）")
+    print(f"未转换的prompt原文: {_format_size(report['legacy_prompt_bytes'])}")
+    print(f"已转换的prompt原文: {_format_size(referenced)}")
+    print(f"去重压缩后: {_format_size(stored)}（片段 {report['blob_count']} 个，"
+          f"原始 {_format_size(report['blob_raw_bytes'])}，引用 {_format_size(report['ref_bytes'])}）")
+    if stored:
+        print(f"压缩比: {referenced / stored:.1f}x")
+    print(f"数据库文件: {_format_size(report['file_bytes'])}（空闲页 {_format_size(report['free_bytes'])}）")
+
+
+def main():
+    """转换已有数据库中的完整prompt，并输出转换前后的空间报告"""
+    parser = argparse.ArgumentParser(description="把system_logs中的完整prompt转换为去重压缩的片段引用")
+    parser.add_argument('--db', help="数据库文件路径，默认使用配置中的数据库")
+    parser.add_argument('--batch-size', type=int, default=500, help="每个事务转换的日志条数")
+    parser.add_argument('--vacuum', action='store_true', help="转换后执行VACUUM回收空间")
+    parser.add_argument('--report-only', action='store_true', help="只输出空间报告，不做转换")
+    args = parser.parse_args()
+
+    from src.config import Config
+    from src.database import Database
+
+    database = Database(db_path=args.db, durability='sync')
+    print("转换前:")
+    print_report(database.get_prompt_storage_report())
+    if args.report_only:
+        return
+
+    # 按Agent名称找到对应的模板，用于把prompt拆成模板片段、历史消息和用户输入
+    templates = {
+        agent.get('name', ''): agent.get('prompt_template', '')
+        for agent in Config().get_agents_config().values()
+    }
+    converted = database.migrate_prompts(templates, batch_size=args.batch_size)
+    print(f"\n已转换 {converted} 条日志")
+    if args.vacuum:
+        database.vacuum()
+    print("\n转换后:")
+    print_report(database.get_prompt_storage_report())
+    database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+对话检索模块
+在本地为messages表建立BM25倒排索引，按本轮用户输入找回对话窗口之外的相关早期消息
+
+中文按相邻两字（bigram）切分，英文单词和数字串整体作为一个词；索引按会话缓存在内存中并按LRU淘汰，
+每次检索前只从数据库读取上次之后新增的消息，增量更新索引。
+只在当前会话内检索：会话没有所属用户的信息，跨会话检索会把其他访客的对话放进回复中。
+"""
+import heapq
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# 中日韩文字的连续片段
+_CJK_RUN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+
+# 英文单词和数字串
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text: str) -> List[str]:
+    """切分检索用的词
+    Args:
+        text: 原始文本
+    Returns:
+        List[str]: 中文的相邻两字、单独的一个汉字，以及英文单词和数字串
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    tokens = []
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(_WORD.findall(_CJK_RUN.sub(' ', text)))
+    return tokens
+
+
+class BM25Index:
+    """可增量添加文档的BM25倒排索引"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, max_postings: int = 4000):
+        """初始化
+        Args:
+            k1: 词频饱和参数
+            b: 文档长度归一化参数
+            max_postings: 每次检索最多遍历的倒排表条目数；查询词按文档频率从低到高计算，
+                剩余的常见词idf很低，对排序影响很小，却要遍历很长的倒排表，超出后不再计算
+        """
+        self.k1 = k1
+        self.b = b
+        self.max_postings = max_postings
+        self.postings = {}  # 词 -> {文档ID: 词频}
+        self.doc_lengths = {}  # 文档ID -> 词数
+        self.docs = {}  # 文档ID -> 检索结果中返回的内容
+        self.total_length = 0
+        self.last_id = 0  # 已索引的最大文档ID，用于增量更新
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, doc_id: int, text: str, payload: Any = None):
+        """添加一篇文档
+        Args:
+            doc_id: 文档ID（message_id），应递增
+            text: 文档文本
+            payload: 检索命中时返回的内容
+        """
+        self.last_id = max(self.last_id, doc_id)
+        terms = tokenize(text)
+        if not terms:
+            return
+        for term, count in Counter(terms).items():
+            posting = self.postings.get(term)
+            if posting is None:
+                self.postings[term] = {doc_id: count}
+            else:
+                posting[doc_id] = count
+        self.doc_lengths[doc_id] = len(terms)
+        self.docs[doc_id] = payload
+        self.total_length += len(terms)
+
+    def search(self, query: str, top_k: int = 3, exclude: Optional[Set[int]] = None) -> List[Tuple[int, float]]:
+        """检索与查询最相关的文档
+        Args:
+            query: 查询文本
+            top_k: 返回的文档数
+            exclude: 不返回的文档ID
+        Returns:
+            List[Tuple[int, float]]: (文档ID, BM25分数)，按分数从高到低排列
+        """
+        count = len(self.doc_lengths)
+        if count == 0:
+            return []
+        k1, b = self.k1, self.b
+        average_length = self.total_length / count
+        doc_lengths = self.doc_lengths
+        # 文档长度归一化：k1 * (1 - b + b * 长度 / 平均长度)
+        base = k1 * (1 - b)
+        scale = k1 * b / average_length
+        postings = [self.postings[term] for term in set(tokenize(query)) if term in self.postings]
+        postings.sort(key=len)
+        budget = self.max_postings
+        scores = {}
+        for posting in postings:
+            df = len(posting)
+            if df > budget:
+                break
+            budget -= df
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            weight = idf * (k1 + 1)
+            for doc_id, tf in posting.items():
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf / (tf + base + scale * doc_lengths[doc_id])
+        if exclude:
+            for doc_id in exclude:
+                scores.pop(doc_id, None)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+
+class MessageRetriever:
+    """按会话缓存BM25索引，从messages表增量更新并检索早期消息
+    每个会话的索引有自己的锁，更新和检索在锁内进行；不同会话的检索互不等待
+    """
+
+    # 不参与检索的角色（处理失败时记录的错误信息）
+    SKIP_ROLES = ('系统',)
+
+    def __init__(self, database: Any, max_sessions: int = 64, scope: str = 'session',
+                 top_k: int = 3, min_score: float = 1.0, max_chars: int = 200):
+        """初始化
+        Args:
+            database: Database实例
+            max_sessions: 内存中缓存索引的会话数，超出时淘汰最久未使用的
+            scope: 检索范围，只支持session（当前会话）；会话不关联用户，无法限定为同一用户的其他会话
+            top_k: 每轮最多找回的消息数
+            min_score: 低于该BM25分数的消息不找回
+            max_chars: 找回的每条消息最多保留的字符数
+        """
+        if scope != 'session':
+            raise ValueError(f"不支持的检索范围: {scope}（会话不关联用户，只能在当前会话内检索）")
+        self.database = database
+        self.max_sessions = max_sessions
+        self.scope = scope
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_chars = max_chars
+        self._indexes = OrderedDict()  # 会话ID -> (BM25Index, 该索引的锁)
+        self._lock = threading.Lock()  # 只保护_indexes本身
+
+    def _entry(self, session_id: int) -> Tuple[BM25Index, threading.Lock]:
+        """获取会话的索引及其锁，不存在时创建"""
+        with self._lock:
+            entry = self._indexes.get(session_id)
+            if entry is None:
+                entry = (BM25Index(), threading.Lock())
+                self._indexes[session_id] = entry
+                while len(self._indexes) > self.max_sessions:
+                    self._indexes.popitem(last=False)
+            else:
+                self._indexes.move_to_end(session_id)
+        return entry
+
+    def _update(self, session_id: int, index: BM25Index):
+        """补充上次之后新增的消息，调用方须持有该索引的锁"""
+        for message_id, message_session, role, content in self.database.get_messages_after(
+                session_id, index.last_id):
+            if role in self.SKIP_ROLES:
+                index.last_id = message_id
+                continue
+            index.add(message_id, content, (message_session, role, content))
+
+    def retrieve(self, session_id: int, query: str,
+                 exclude_texts: Optional[Set[str]] = None) -> List[Dict[str, Any]]:
+        """找回与本轮输入相关的早期消息
+        Args:
+            session_id: 当前会话ID
+            query: 本轮用户输入
+            exclude_texts: 已经在对话历史中的消息内容，不重复找回
+        Returns:
+            List[Dict[str, Any]]: 按时间顺序排列的消息，包含message_id、session_id、role、content和score
+        """
+        index, lock = self._entry(session_id)
+        with lock:
+            self._update(session_id, index)
+            # 多取几条，排除已在对话历史中的消息后仍有top_k条
+            hits = index.search(query, self.top_k + len(exclude_texts or ()))
+            payloads = [(doc_id, score, index.docs[doc_id]) for doc_id, score in hits]
+        results = []
+        for doc_id, score, (message_session, role, content) in payloads:
+            if score < self.min_score:
+                break
+            if exclude_texts and content in exclude_texts:
+                continue
+            if len(content) > self.max_chars:
+                content = content[:self.max_chars] + '…'
+            results.append({'message_id': doc_id, 'session_id': message_session,
+                            'role': role, 'content': content, 'score': score})
+            if len(results) >= self.top_k:
+                break
+        results.sort(key=lambda item: item['message_id'])
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存的索引数和文档数"""
+        with self._lock:
+            return {
+                'indexes': len(self._indexes),
+                'documents': sum(len(index) for index, _ in self._indexes.values())
+            }
@@ -0,0 +1,288 @@
+"""
+本地路由模块
+在调用远程意图识别模型之前，用规则和字符n-gram模型在本地快速判断sys1/sys2
+"""
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# 合法的路由结果
+LABELS = ('sys1', 'sys2')
+
+# 归一化时去除的标点和空白
+_PUNCTUATION = re.compile(r'[\s\W_]+', re.UNICODE)
+
+
+def normalize_text(text: str) -> str:
+    """归一化用户输入：全角转半角、转小写、去除标点和空白
+    Args:
+        text: 原始文本
+    Returns:
+        str: 归一化后的文本
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    return _PUNCTUATION.sub('', text)
+
+
+def parse_decision(text: str) -> Optional[str]:
+    """解析调度模型的输出
+    Args:
+        text: 调度模型返回的原始文本，例如"sys1"、"\"sys2\""或"选择：sys2"
+    Returns:
+        Optional[str]: 'sys1'或'sys2'；无法明确识别时返回None
+    """
+    normalized = normalize_text(text or '')
+    found = [label for label in LABELS if label in normalized]
+    if len(found) != 1:
+        return None
+    return found[0]
+
+
+def extract_user_input(prompt: str, template: str) -> str:
+    """从渲染后的调度prompt中还原用户输入
+    Args:
+        prompt: 渲染后的完整prompt
+        template: 调度Agent的prompt模板
+    Returns:
+        str: 用户输入；无法识别时返回空字符串
+    """
+    if '{user_input}' not in template or '{dialogue_history}' not in template:
+        return ''
+    head, tail = template.split('{user_input}', 1)
+    # 对话历史与用户输入之间的固定文本，用于定位用户输入的起点
+    marker = head.split('{dialogue_history}', 1)[1]
+    index = prompt.rfind(marker)
+    if index < 0:
+        return ''
+    text = prompt[index + len(marker):]
+    if tail and text.endswith(tail):
+        text = text[:-len(tail)]
+    return text.strip()
+
+
+class LocalClassifier:
+    """本地分类器基类：每个分类器作为本地路由的一个阶段"""
+
+    def predict(self, text: str) -> Optional[Tuple[str, float]]:
+        """预测路由结果
+        Args:
+            text: 用户输入
+        Returns:
+            Optional[Tuple[str, float]]: (路由结果, 置信度)，无法判断时返回None
+        """
+        raise NotImplementedError
+
+    def learn(self, text: str, label: str):
+        """用一条已知结果的样本更新模型，默认不学习
+        Args:
+            text: 用户输入
+            label: 路由结果
+        """
+        pass
+
+
+class KeywordClassifier(LocalClassifier):
+    """规则分类器：精确匹配常见闲聊，关键词匹配探讨类问题"""
+
+    def __init__(self, config: Dict[str, Any]):
+        """初始化规则
+        Args:
+            config: 规则配置，包含exact、keywords及对应的置信度
+        """
+        # 归一化后精确匹配的短语，如{"你好": "sys1"}
+        self.exact = {}
+        for label, phrases in (config.get('exact') or {}).items():
+            for phrase in phrases:
+                self.exact[normalize_text(phrase)] = label
+        # 包含即命中的关键词
+        self.keywords = []
+        for label, words in (config.get('keywords') or {}).items():
+            for word in words:
+                self.keywords.append((normalize_text(word), label))
+        self.exact_confidence = config.get('exact_confidence', 1.0)
+        self.keyword_confidence = config.get('keyword_confidence', 0.9)
+
+    def predict(self, text: str) -> Optional[Tuple[str, float]]:
+        """按规则判断路由结果"""
+        normalized = normalize_text(text)
+        if normalized in self.exact:
+            return self.exact[normalized], self.exact_confidence
+        for word, label in self.keywords:
+            if word and word in normalized:
+                return label, self.keyword_confidence
+        return None
+
+
+class NgramClassifier(LocalClassifier):
+    """字符n-gram朴素贝叶斯分类器，支持增量学习
+    长期运行时词表和计数不会无限增长：样本数超过max_samples时所有计数减半（近期样本的权重更高），
+    词表超过max_vocabulary时删除出现次数最少的n-gram
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        """初始化模型
+        Args:
+            config: 模型配置，包含ngram_range、min_samples、max_vocabulary和max_samples
+        """
+        low, high = config.get('ngram_range', [1, 3])
+        self.ngram_range = (int(low), int(high))
+        # 样本数少于该值时不做判断
+        self.min_samples = config.get('min_samples', 50)
+        # 词表的最大n-gram数，0表示不限
+        self.max_vocabulary = config.get('max_vocabulary', 20000)
+        # 样本数超过该值时计数减半，0表示不衰减
+        self.max_samples = config.get('max_samples', 10000)
+        self.label_counts = Counter()  # 每个类别的样本数
+        self.feature_counts = defaultdict(Counter)  # 每个类别下各n-gram的出现次数
+        self.total_features = Counter()  # 每个类别的n-gram总数
+        self.vocabulary = set()
+
+    def _ngrams(self, text: str) -> List[str]:
+        """提取字符n-gram
+        Args:
+            text: 用户输入
+        Returns:
+            List[str]: n-gram列表
+        """
+        text = normalize_text(text)
+        grams = []
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+        return grams
+
+    def learn(self, text: str, label: str):
+        """增量学习一条样本"""
+        if label not in LABELS:
+            return
+        grams = self._ngrams(text)
+        self.label_counts[label] += 1
+        self.feature_counts[label].update(grams)
+        self.total_features[label] += len(grams)
+        self.vocabulary.update(grams)
+        if self.max_samples and self.sample_count > self.max_samples:
+            self._decay()
+        if self.max_vocabulary and len(self.vocabulary) > self.max_vocabulary:
+            # 一次删到上限的一半（主要是只出现过一次的n-gram），裁剪的开销分摊到之后的多条样本
+            self._prune(self.max_vocabulary // 2)
+
+    def _decay(self):
+        """所有计数减半，减为0的n-gram从词表中删除；每个类别至少保留1个样本"""
+        for label in list(self.label_counts):
+            self.label_counts[label] = max(1, self.label_counts[label] // 2)
+        self.vocabulary = set()
+        for label, counts in list(self.feature_counts.items()):
+            counts = Counter({gram: count // 2 for gram, count in counts.items() if count >= 2})
+            self.feature_counts[label] = counts
+            self.total_features[label] = sum(counts.values())
+            self.vocabulary.update(counts)
+
+    def _prune(self, size: int):
+        """只保留各类别合计出现次数最多的size个n-gram
+        Args:
+            size: 保留的n-gram数
+        """
+        label_counts = list(self.feature_counts.items())
+        totals = {gram: sum(counts.get(gram, 0) for _, counts in label_counts) for gram in self.vocabulary}
+        for gram in sorted(totals, key=totals.get)[:len(totals) - size]:
+            self.vocabulary.discard(gram)
+            for label, counts in label_counts:
+                self.total_features[label] -= counts.pop(gram, 0)
+
+    def fit(self, samples: Iterable[Tuple[str, str]]):
+        """批量训练
+        Args:
+            samples: (用户输入, 路由结果)样本
+        """
+        for text, label in samples:
+            self.learn(text, label)
+
+    @property
+    def sample_count(self) -> int:
+        """已学习的样本数"""
+        return sum(self.label_counts.values())
+
+    def predict(self, text: str) -> Optional[Tuple[str, float]]:
+        """计算各类别的后验概率，返回概率最大的类别"""
+        if self.sample_count < self.min_samples or len(self.label_counts) < len(LABELS):
+            return None
+        grams = self._ngrams(text)
+        if not grams:
+            return None
+
+        vocabulary_size = len(self.vocabulary) + 1
+        total = self.sample_count
+        scores = {}
+        for label in LABELS:
+            counts = self.feature_counts[label]
+            denominator = self.total_features[label] + vocabulary_size
+            score = math.log(self.label_counts[label] / total)
+            for gram in grams:
+                # 拉普拉斯平滑
+                score += math.log((counts[gram] + 1) / denominator)
+            scores[label] = score
+
+        # 对数概率转为归一化的后验概率
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        norm = sum(math.exp(score - top) for score in scores.values())
+        return best, 1.0 / norm
+
+
+# 可用的本地分类器，配置中按名称引用
+CLASSIFIERS = {
+    'keyword': KeywordClassifier,
+    'ngram': NgramClassifier,
+}
+
+
+class LocalRouter:
+    """本地路由：按顺序执行各分类阶段，返回第一个给出结果的阶段"""
+
+    def __init__(self, config: Dict[str, Any]):
+        """初始化本地路由
+        Args:
+            config: local_router配置
+        """
+        self.threshold = config.get('threshold', 0.9)  # 低于该置信度时回退到远程模型
+        self.shadow_rate = config.get('shadow_rate', 0.0)  # 本地决策时仍调用远程模型做对照的比例
+        self.stages = []
+        for name in config.get('stages', ['keyword', 'ngram']):
+            self.stages.append((name, CLASSIFIERS[name](config.get(name) or {})))
+
+    def route(self, text: str) -> Optional[Dict[str, Any]]:
+        """本地判断路由结果
+        Args:
+            text: 用户输入
+        Returns:
+            Optional[Dict[str, Any]]: {"label", "confidence", "tier"}，所有阶段都无法判断时返回None
+        """
+        best = None
+        for name, classifier in self.stages:
+            prediction = classifier.predict(text)
+            if prediction is None:
+                continue
+            label, confidence = prediction
+            if best is None or confidence > best['confidence']:
+                best = {"label": label, "confidence": confidence, "tier": name}
+            if confidence >= self.threshold:
+                break
+        return best
+
+    def learn(self, text: str, label: str):
+        """用远程模型的决策更新各阶段
+        Args:
+            text: 用户输入
+            label: 远程模型给出的路由结果
+        """
+        for _, classifier in self.stages:
+            classifier.learn(text, label)
+
+    def fit(self, samples: List[Tuple[str, str]]):
+        """用历史样本训练各阶段
+        Args:
+            samples: (用户输入, 路由结果)样本
+        """
+        for text, label in samples:
+            self.learn(text, label)
@@ -0,0 +1,263 @@
+"""
+模型调用调度模块
+限制每个模型和所有模型合计的并发请求数，按百炼平台的RPM/TPM限额做令牌桶限流，
+资源不足时调用按优先级排队：调度Agent和sys1先于sys2，后台调用（摘要、对照调用）最后
+
+排队只在事件循环中进行，同步调用（命令行模式）不经过调度器。
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.config import Config
+from src.metrics import queue_depth
+
+# 优先级名称 -> 排序值，值越小越先获得资源
+PRIORITIES = {
+    'dispatcher': 0,
+    'sys1': 1,
+    'sys2': 2,
+    'background': 3,
+}
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟的限额，按限额/60的速度持续补充"""
+
+    def __init__(self, per_minute: float):
+        """初始化令牌桶
+        Args:
+            per_minute: 每分钟的限额（请求数或token数）
+        """
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        """按经过的时间补充令牌"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """距离可以取出amount个令牌还需等待的时间（秒）
+        单次超过容量的请求按容量计算，避免永远无法放行
+        """
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float, now: float):
+        """取出令牌"""
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        """按实际用量修正：amount为正时归还多预留的令牌，为负时补扣（可暂时为负，之后的请求等待补足）"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ModelLane:
+    """单个模型的并发数和RPM/TPM限额"""
+
+    def __init__(self, max_concurrency: int = 0, rpm: float = 0, tpm: float = 0):
+        """初始化
+        Args:
+            max_concurrency: 最大并发请求数，0表示不限
+            rpm: 每分钟请求数限额，0表示不限
+            tpm: 每分钟token数限额（输入+输出），0表示不限
+        """
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.active = 0
+
+    def delay(self, tokens: int, now: float) -> float:
+        """距离RPM/TPM限额允许发出请求还需等待的时间（秒）"""
+        delay = 0.0
+        if self.requests is not None:
+            delay = self.requests.delay(1, now)
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.delay(tokens, now))
+        return delay
+
+    def take(self, tokens: int, now: float):
+        """占用一个并发名额，并扣除一个请求和预估的token数"""
+        self.active += 1
+        if self.requests is not None:
+            self.requests.take(1, now)
+        if self.tokens is not None:
+            self.tokens.take(tokens, now)
+
+
+class Ticket:
+    """一次调用获得的资源，调用结束后交给release归还"""
+
+    def __init__(self, model: str, priority: str, tokens: int, wait_ms: int = 0):
+        self.model = model
+        self.priority = priority
+        self.tokens = tokens  # 预扣的token数
+        self.wait_ms = wait_ms  # 排队等待的时间（毫秒）
+        self.tokens_used = None  # 实际的token用量（输入+输出），归还时据此修正TPM令牌桶
+
+
+class ModelScheduler:
+    """模型调用调度器：按优先级分配并发名额和限流令牌"""
+
+    def __init__(self, max_concurrency: int = 0, models: Optional[Dict[str, Dict[str, Any]]] = None):
+        """初始化调度器
+        Args:
+            max_concurrency: 所有模型合计的最大并发请求数，0表示不限
+            models: 模型名称 -> {max_concurrency, rpm, tpm}；未配置的模型只受合计并发数限制
+        """
+        self.max_concurrency = max_concurrency
+        self.lanes = {
+            name: ModelLane(limits.get('max_concurrency', 0) or 0, limits.get('rpm', 0) or 0,
+                            limits.get('tpm', 0) or 0)
+            for name, limits in (models or {}).items()
+        }
+        self.active = 0
+        # 排队的调用：(优先级排序值, 序号, 模型, 预估token数, future)，列表保持有序（同时是合法的堆）
+        self._waiters: List[Tuple[int, int, str, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _lane(self, model: str) -> ModelLane:
+        """获取模型的限额，未配置的模型不限并发和速率"""
+        lane = self.lanes.get(model)
+        if lane is None:
+            lane = self.lanes[model] = ModelLane()
+        return lane
+
+    def queue_depth(self) -> int:
+        """排队中的调用数"""
+        return sum(1 for waiter in self._waiters if not waiter[4].done())
+
+    async def acquire(self, model: str, priority: str = 'sys1', tokens: int = 0) -> Ticket:
+        """等待发出请求所需的资源
+        Args:
+            model: 模型名称
+            priority: 优先级名称（见PRIORITIES）
+            tokens: 预估的token数，用于TPM限流
+        Returns:
+            Ticket: 获得的资源，调用结束后必须release
+        """
+        start_time = time.monotonic()
+        # 没有排队的调用且资源充足时直接放行
+        ticket = self.try_acquire(model, priority, tokens)
+        if ticket is not None:
+            return ticket
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITIES.get(priority, PRIORITIES['sys1']), next(self._sequence),
+                                       model, tokens, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到资源但调用方在恢复执行前被取消，归还资源
+                self.release(Ticket(model, priority, tokens))
+            else:
+                self._dispatch()
+            raise
+        return Ticket(model, priority, tokens, int((time.monotonic() - start_time) * 1000))
+
+    def try_acquire(self, model: str, priority: str = 'sys1', tokens: int = 0) -> Optional[Ticket]:
+        """不排队地获取资源：没有排队的调用且资源充足时返回Ticket，否则返回None
+        对冲请求用它获取资源，资源紧张时不发出对冲请求
+        Args:
+            model: 模型名称
+            priority: 优先级名称
+            tokens: 预估的token数
+        Returns:
+            Optional[Ticket]: 获得的资源，调用结束后必须release
+        """
+        now = time.monotonic()
+        lane = self._lane(model)
+        if self._waiters or not self._available(lane) or lane.delay(tokens, now) > 0:
+            return None
+        self._grant(lane, tokens, now)
+        return Ticket(model, priority, tokens)
+
+    def release(self, ticket: Ticket):
+        """归还资源；设置了ticket.tokens_used时按实际用量修正TPM令牌桶
+        Args:
+            ticket: acquire返回的资源
+        """
+        lane = self._lane(ticket.model)
+        lane.active -= 1
+        self.active -= 1
+        if ticket.tokens_used is not None and lane.tokens is not None:
+            lane.tokens.adjust(ticket.tokens - ticket.tokens_used)
+        if self._waiters:
+            self._dispatch()
+
+    def _available(self, lane: ModelLane) -> bool:
+        """合计并发数和模型并发数是否还有空闲名额"""
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return False
+        return not lane.max_concurrency or lane.active < lane.max_concurrency
+
+    def _grant(self, lane: ModelLane, tokens: int, now: float):
+        """分配资源"""
+        lane.take(tokens, now)
+        self.active += 1
+
+    def _dispatch(self):
+        """按优先级放行排队中的调用
+        合计并发数用尽时停止放行；某个模型的并发数或限额不足时跳过该模型，较低优先级的其他模型仍可放行。
+        等待限额补充的调用在补足时由定时器再次放行
+        """
+        now = time.monotonic()
+        blocked = set()  # 本轮因自身并发数或限额不能放行的模型
+        retry_at = None
+        pending = []
+        for waiter in sorted(self._waiters):
+            _, _, model, tokens, future = waiter
+            if future.done():
+                # 调用方在排队时被取消
+                continue
+            if model in blocked or (self.max_concurrency and self.active >= self.max_concurrency):
+                pending.append(waiter)
+                continue
+            lane = self._lane(model)
+            if lane.max_concurrency and lane.active >= lane.max_concurrency:
+                blocked.add(model)
+                pending.append(waiter)
+                continue
+            delay = lane.delay(tokens, now)
+            if delay > 0:
+                blocked.add(model)
+                retry_at = now + delay if retry_at is None else min(retry_at, now + delay)
+                pending.append(waiter)
+                continue
+            self._grant(lane, tokens, now)
+            future.set_result(None)
+        self._waiters = pending
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if retry_at is not None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(retry_at - now, self._dispatch)
+
+
+def create_scheduler(config: Dict[str, Any]) -> ModelScheduler:
+    """按runtime.scheduler配置创建调度器
+    Args:
+        config: runtime.scheduler配置
+    Returns:
+        ModelScheduler: 调度器，enabled为false时不限制任何调用
+    """
+    if not config.get('enabled', True):
+        return ModelScheduler()
+    return ModelScheduler(config.get('max_concurrency', 0) or 0, config.get('models') or {})
+
+
+# 创建全局实例
+scheduler = create_scheduler(Config().get_runtime_config().get('scheduler', {}) or {})
+queue_depth.set_function(scheduler.queue_depth, 'model_scheduler')
@@ -0,0 +1,408 @@
+"""
+会话保持模块
+WebSocket断线重连时恢复原来的对话会话，而不是每个连接新建一个会话
+
+客户端连接后收到带HMAC签名的会话令牌，重连时通过?session=<令牌>带回；
+服务端在内存中保留断开后的空闲会话（LRU + 空闲超时），命中时直接复用DialogueManager，
+未命中时从会话状态存储（或messages表）恢复对话历史。只有空闲超时或被LRU淘汰的会话才标记为结束。
+
+会话状态（对话窗口、待并入摘要的消息、会话摘要）每次变化后写入会话状态存储，每轮开始前读取：
+进程内存储用于单个worker；多个worker时使用共享存储（SQLite文件或Redis），任一worker都能继续处理任一会话。
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from src.config import Config
+
+try:
+    import redis  # 可选依赖，使用Redis存储会话状态时需要
+except ImportError:
+    redis = None
+
+
+class SessionSigner:
+    """生成和校验会话令牌，防止客户端伪造他人的session_id"""
+
+    def __init__(self, secret: Optional[str] = None):
+        """初始化
+        Args:
+            secret: 签名密钥；为空时使用进程启动时随机生成的密钥（重启或多个worker之间令牌不通用）
+        """
+        self._key = secret.encode('utf-8') if secret else os.urandom(32)
+
+    def sign(self, session_id: int) -> str:
+        """生成会话令牌
+        Args:
+            session_id: 会话ID
+        Returns:
+            str: 格式为"会话ID.签名"的令牌
+        """
+        return f"{session_id}.{self._signature(session_id)}"
+
+    def verify(self, token: Optional[str]) -> Optional[int]:
+        """校验会话令牌
+        Args:
+            token: 客户端带回的令牌
+        Returns:
+            Optional[int]: 会话ID，令牌为空或校验失败时返回None
+        """
+        if not token or '.' not in token:
+            return None
+        session_part, signature = token.split('.', 1)
+        if not session_part.isdigit():
+            return None
+        session_id = int(session_part)
+        if not hmac.compare_digest(signature, self._signature(session_id)):
+            return None
+        return session_id
+
+    def _signature(self, session_id: int) -> str:
+        """计算会话ID的HMAC-SHA256签名（URL安全的base64）"""
+        digest = hmac.new(self._key, str(session_id).encode('utf-8'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+class SessionCache:
+    """保留活跃和空闲的对话管理器；空闲超时或超出容量时结束会话"""
+
+    def __init__(self, factory: Callable[[Optional[int]], Any], max_idle: int = 256,
+                 idle_ttl_seconds: float = 1800):
+        """初始化
+        Args:
+            factory: 创建对话管理器的函数，参数为要恢复的会话ID（None表示新建会话）
+            max_idle: 最多保留的空闲会话数，超出时结束最久未使用的
+            idle_ttl_seconds: 空闲会话的保留时间（秒）
+        """
+        self.factory = factory
+        self.max_idle = max_idle
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._active = {}  # 会话ID -> [对话管理器, 连接数]
+        self._idle = OrderedDict()  # 会话ID -> (断开时间, 对话管理器)
+        self._lock = threading.Lock()
+        self.resumed = 0  # 从内存中恢复的次数
+        self.rehydrated = 0  # 从数据库恢复的次数
+
+    def acquire(self, session_id: Optional[int] = None) -> Any:
+        """为新连接获取对话管理器
+        Args:
+            session_id: 客户端要恢复的会话ID，为None时新建会话
+        Returns:
+            Any: 对话管理器
+        """
+        expired = self._expire()
+        try:
+            with self._lock:
+                if session_id is not None:
+                    entry = self._active.get(session_id)
+                    if entry is not None:
+                        # 同一会话在另一个连接（如复制的标签页）中仍然活跃，共用对话管理器
+                        entry[1] += 1
+                        self.resumed += 1
+                        return entry[0]
+                    item = self._idle.pop(session_id, None)
+                    if item is not None:
+                        self._active[session_id] = [item[1], 1]
+                        self.resumed += 1
+                        return item[1]
+            # 未命中时新建或从数据库恢复，不持有锁
+            manager = self.factory(session_id)
+            with self._lock:
+                if session_id is not None and manager.session_id == session_id:
+                    self.rehydrated += 1
+                entry = self._active.setdefault(manager.session_id, [manager, 0])
+                entry[1] += 1
+                return entry[0]
+        finally:
+            self._end(expired)
+
+    def release(self, manager: Any):
+        """连接断开时归还对话管理器，最后一个连接断开后转为空闲
+        Args:
+            manager: acquire返回的对话管理器
+        """
+        evicted = []
+        with self._lock:
+            entry = self._active.get(manager.session_id)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._active[manager.session_id]
+            self._idle[manager.session_id] = (time.monotonic(), manager)
+            while len(self._idle) > self.max_idle:
+                evicted.append(self._idle.popitem(last=False)[1][1])
+        self._end(evicted)
+        self._end(self._expire())
+
+    def sweep(self) -> int:
+        """结束空闲超时的会话，由心跳任务定期调用
+        Returns:
+            int: 结束的会话数
+        """
+        expired = self._expire()
+        self._end(expired)
+        return len(expired)
+
+    def close(self) -> int:
+        """结束所有空闲会话（应用关闭时调用）
+        Returns:
+            int: 结束的会话数
+        """
+        with self._lock:
+            managers = [manager for _, manager in self._idle.values()]
+            self._idle.clear()
+        self._end(managers)
+        return len(managers)
+
+    def stats(self) -> Dict[str, Any]:
+        """获取活跃/空闲会话数和恢复次数"""
+        with self._lock:
+            return {
+                'active': len(self._active),
+                'idle': len(self._idle),
+                'max_idle': self.max_idle,
+                'idle_ttl_seconds': self.idle_ttl_seconds,
+                'resumed': self.resumed,
+                'rehydrated': self.rehydrated
+            }
+
+    def _expire(self) -> List[Any]:
+        """取出空闲超时的对话管理器"""
+        deadline = time.monotonic() - self.idle_ttl_seconds
+        expired = []
+        with self._lock:
+            while self._idle:
+                session_id, (released_at, manager) = next(iter(self._idle.items()))
+                if released_at > deadline:
+                    break
+                del self._idle[session_id]
+                expired.append(manager)
+        return expired
+
+    @staticmethod
+    def _end(managers: List[Any]):
+        """结束被淘汰的会话"""
+        for manager in managers:
+            try:
+                manager.end_session()
+            except Exception as e:
+                print(f"结束会话失败: {str(e)}")
+
+
+class SessionStore(ABC):
+    """会话状态存储的接口
+    状态为可JSON序列化的字典：version（每次保存递增）、history（对话窗口）、evicted（待并入摘要的消息）、summary
+    """
+
+    @abstractmethod
+    def load(self, session_id: int) -> Optional[Dict[str, Any]]:
+        """读取会话状态
+        Args:
+            session_id: 会话ID
+        Returns:
+            Optional[Dict[str, Any]]: 会话状态，不存在或已过期时返回None
+        """
+
+    @abstractmethod
+    def save(self, session_id: int, state: Dict[str, Any]):
+        """保存会话状态；已保存的版本不低于state['version']时忽略，避免旧状态覆盖其他worker写入的新状态
+        Args:
+            session_id: 会话ID
+            state: 会话状态
+        """
+
+    @abstractmethod
+    def delete(self, session_id: int):
+        """删除会话状态（会话结束时调用）
+        Args:
+            session_id: 会话ID
+        """
+
+
+class MemorySessionStore(SessionStore):
+    """进程内的会话状态存储，只适用于单个worker"""
+
+    def __init__(self, max_sessions: int = 10000, ttl_seconds: Optional[float] = None):
+        """初始化
+        Args:
+            max_sessions: 最多保存的会话数，超出时淘汰最久未更新的
+            ttl_seconds: 会话状态的保留时间（秒），为None时不过期
+        """
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._states = OrderedDict()  # 会话ID -> (更新时间, 会话状态)
+        self._lock = threading.Lock()
+
+    def load(self, session_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._states.get(session_id)
+            if item is None:
+                return None
+            updated_at, state = item
+            if self.ttl_seconds is not None and updated_at < time.monotonic() - self.ttl_seconds:
+                del self._states[session_id]
+                return None
+            # 返回副本，调用方修改列表不影响已保存的状态
+            return {**state, 'history': list(state['history']), 'evicted': list(state['evicted'])}
+
+    def save(self, session_id: int, state: Dict[str, Any]):
+        state = {**state, 'history': list(state['history']), 'evicted': list(state['evicted'])}
+        with self._lock:
+            item = self._states.get(session_id)
+            if item is not None and item[1]['version'] >= state['version']:
+                return
+            self._states[session_id] = (time.monotonic(), state)
+            self._states.move_to_end(session_id)
+            while len(self._states) > self.max_sessions:
+                self._states.popitem(last=False)
+
+    def delete(self, session_id: int):
+        with self._lock:
+            self._states.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """保存在SQLite文件中的会话状态，同一台机器上的多个worker共享"""
+
+    # 每保存该次数后清理一次过期的会话状态
+    CLEANUP_EVERY = 200
+
+    def __init__(self, path: str, ttl_seconds: Optional[float] = None, busy_timeout_ms: int = 5000):
+        """初始化
+        Args:
+            path: 数据库文件路径
+            ttl_seconds: 会话状态的保留时间（秒），为None时不过期
+            busy_timeout_ms: 数据库被锁定时的最长等待时间（毫秒）
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(f'PRAGMA busy_timeout={int(busy_timeout_ms)}')
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+        CREATE TABLE IF NOT EXISTS session_state (
+            session_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''')
+        self._lock = threading.Lock()
+        self._saves = 0
+
+    def load(self, session_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT state, updated_at FROM session_state WHERE session_id = ?', (session_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        if self.ttl_seconds is not None and row[1] < time.time() - self.ttl_seconds:
+            return None
+        return json.loads(row[0])
+
+    def save(self, session_id: int, state: Dict[str, Any]):
+        data = json.dumps(state, ensure_ascii=False, default=str)
+        with self._lock:
+            # 只有版本更新时才覆盖
+            self._conn.execute(
+                '''INSERT INTO session_state (session_id, version, state, updated_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(session_id) DO UPDATE SET
+                       version = excluded.version, state = excluded.state, updated_at = excluded.updated_at
+                   WHERE excluded.version > session_state.version''',
+                (session_id, state['version'], data, time.time())
+            )
+            self._saves += 1
+            if self.ttl_seconds is not None and self._saves % self.CLEANUP_EVERY == 0:
+                self._conn.execute('DELETE FROM session_state WHERE updated_at < ?', (time.time() - self.ttl_seconds,))
+
+    def delete(self, session_id: int):
+        with self._lock:
+            self._conn.execute('DELETE FROM session_state WHERE session_id = ?', (session_id,))
+
+
+class RedisSessionStore(SessionStore):
+    """保存在Redis中的会话状态，可供多台机器上的worker共享（需要安装redis包）"""
+
+    # 仅当新版本更高时写入，保证与SQLite存储相同的覆盖规则
+    _SAVE_SCRIPT = '''
+    local current = redis.call('HGET', KEYS[1], 'version')
+    if current and tonumber(current) >= tonumber(ARGV[1]) then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'version', ARGV[1], 'state', ARGV[2])
+    if tonumber(ARGV[3]) > 0 then
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+    end
+    return 1
+    '''
+
+    def __init__(self, url: str, ttl_seconds: Optional[float] = None, prefix: str = 'dual_sys:session:'):
+        """初始化
+        Args:
+            url: Redis地址，例如redis://localhost:6379/0
+            ttl_seconds: 会话状态的保留时间（秒），为None时不过期
+            prefix: 键名前缀
+        """
+        if redis is None:
+            raise ValueError("使用Redis存储会话状态需要安装redis包")
+        self.client = redis.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self._save = self.client.register_script(self._SAVE_SCRIPT)
+
+    def load(self, session_id: int) -> Optional[Dict[str, Any]]:
+        data = self.client.hget(f"{self.prefix}{session_id}", 'state')
+        return json.loads(data) if data else None
+
+    def save(self, session_id: int, state: Dict[str, Any]):
+        self._save(keys=[f"{self.prefix}{session_id}"],
+                   args=[state['version'], json.dumps(state, ensure_ascii=False, default=str),
+                         int(self.ttl_seconds or 0)])
+
+    def delete(self, session_id: int):
+        self.client.delete(f"{self.prefix}{session_id}")
+
+
+def create_session_store(config: Dict[str, Any]) -> SessionStore:
+    """按配置创建会话状态存储
+    Args:
+        config: sessions配置
+            - store: memory、sqlite或redis，也可用环境变量SESSION_STORE指定
+            - store_path: sqlite存储的文件路径，相对路径相对于项目根目录
+            - redis_url: redis存储的地址，也可用环境变量REDIS_URL指定
+            - state_ttl_seconds: 会话状态的保留时间（秒）
+    Returns:
+        SessionStore: 会话状态存储
+    """
+    backend = os.getenv('SESSION_STORE') or config.get('store', 'memory')
+    ttl_seconds = config.get('state_ttl_seconds')
+    if backend == 'memory':
+        return MemorySessionStore(ttl_seconds=ttl_seconds)
+    if backend == 'sqlite':
+        path = config.get('store_path') or os.path.join('data', 'session_state.db')
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), path)
+        return SQLiteSessionStore(path, ttl_seconds=ttl_seconds)
+    if backend == 'redis':
+        return RedisSessionStore(os.getenv('REDIS_URL') or config.get('redis_url', 'redis://localhost:6379/0'),
+                                 ttl_seconds=ttl_seconds)
+    raise ValueError(f"不支持的会话状态存储: {backend}")
+
+
+# 创建全局实例
+_sessions_config = Config().get_runtime_config().get('sessions', {}) or {}
+signer = SessionSigner(os.getenv('SESSION_SECRET') or _sessions_config.get('secret'))
+session_store = create_session_store(_sessions_config)
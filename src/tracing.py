@@ -0,0 +1,368 @@
+"""
+链路追踪模块
+为每轮对话生成trace，记录调度、Agent、prompt格式化、每次模型请求（含重试等待）和数据库写入的耗时
+
+当前span保存在contextvars中，同步调用、asyncio任务（包括推测执行的sys1任务）都会自动继承父span。
+一轮对话的根span结束时，该轮的所有span一起交给导出器：写入trace_spans表，或以OTLP-JSON格式追加到文件。
+不在任何trace中的调用（如后台写入、命令行工具）不产生span，开销只有一次contextvar读取。
+"""
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+from src.config import Config
+
+# 当前正在执行的span
+_current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """一个计时区间"""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'session_id', 'name',
+                 'start_time', 'end_time', 'status', 'message', 'attributes')
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None,
+                 session_id: Optional[int] = None, attributes: Optional[Dict[str, Any]] = None,
+                 start_time: Optional[float] = None):
+        """创建span
+        Args:
+            name: span名称
+            trace_id: 所属trace的ID（32位十六进制）
+            parent_id: 父span的ID，根span为None
+            session_id: 所属会话ID
+            attributes: 附加属性
+            start_time: 开始时间（Unix时间戳，秒），为None时取当前时间
+        """
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.session_id = session_id
+        self.name = name
+        self.start_time = time.time() if start_time is None else start_time
+        self.end_time = None
+        self.status = 'ok'
+        self.message = None
+        self.attributes = dict(attributes or {})
+
+    def set_attribute(self, key: str, value: Any):
+        """设置属性"""
+        self.attributes[key] = value
+
+    def set_status(self, status: str, message: Optional[str] = None):
+        """设置状态
+        Args:
+            status: ok、error或cancelled
+            message: 错误信息
+        """
+        self.status = status
+        self.message = message
+
+    @property
+    def duration_ms(self) -> float:
+        """耗时（毫秒），未结束时为到当前为止的耗时"""
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return (end_time - self.start_time) * 1000
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转为trace_spans表的一行"""
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'session_id': self.session_id,
+            'name': self.name,
+            'start_time': self.start_time,
+            'duration_ms': self.duration_ms,
+            'status': self.status,
+            'message': self.message,
+            'attributes': self.attributes,
+        }
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    """把属性值转为OTLP的AnyValue"""
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def to_otlp(spans: Sequence[Span], service_name: str) -> Dict[str, Any]:
+    """把span列表转为OTLP-JSON（ExportTraceServiceRequest）格式
+    Args:
+        spans: 已结束的span
+        service_name: resource中的service.name
+    Returns:
+        Dict[str, Any]: 可直接json.dumps的OTLP请求体
+    """
+    otlp_spans = []
+    for span in spans:
+        attributes = dict(span.attributes)
+        if span.session_id is not None:
+            attributes['session.id'] = span.session_id
+        item = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(int(span.start_time * 1e9)),
+            'endTimeUnixNano': str(int(span.end_time * 1e9)),
+            'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items()],
+            # STATUS_CODE_OK=1, STATUS_CODE_ERROR=2
+            'status': {'code': 1} if span.status == 'ok' else {'code': 2, 'message': span.message or span.status},
+        }
+        if span.parent_id:
+            item['parentSpanId'] = span.parent_id
+        otlp_spans.append(item)
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'src.tracing'}, 'spans': otlp_spans}]
+        }]
+    }
+
+
+class OTLPFileExporter:
+    """以OTLP-JSON格式把span追加到文件，每轮对话一行，可用OpenTelemetry Collector的otlpjsonfile接收器读取"""
+
+    def __init__(self, path: str, service_name: str = 'dual_sys_exp'):
+        """初始化
+        Args:
+            path: 输出文件路径
+            service_name: resource中的service.name
+        """
+        self.path = path
+        self.service_name = service_name
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def __call__(self, spans: List[Span]):
+        """追加一批span"""
+        line = json.dumps(to_otlp(spans, self.service_name), ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+
+class Tracer:
+    """创建span并在每轮对话结束时导出"""
+
+    def __init__(self, enabled: bool = True, sample_rate: float = 1.0, max_pending: int = 1000):
+        """初始化
+        Args:
+            enabled: 是否启用追踪
+            sample_rate: 记录trace的对话轮次比例
+            max_pending: 等待导出的trace数上限，超过时丢弃最早的（根span未正常结束的情况）
+        """
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self._exporters = []
+        self._pending = {}  # 进行中的trace_id -> 已结束但尚未导出的span
+        self._lock = threading.Lock()
+
+    def add_exporter(self, exporter: Callable[[List[Span]], None]):
+        """注册导出器
+        Args:
+            exporter: 接收一批已结束span的函数
+        """
+        self._exporters.append(exporter)
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        """获取当前span，不在trace中时返回None"""
+        return _current_span.get()
+
+    def current_trace_id(self) -> Optional[str]:
+        """获取当前trace的ID，不在trace中时返回None"""
+        span = _current_span.get()
+        return span.trace_id if span is not None else None
+
+    def set_status(self, status: str, message: Optional[str] = None):
+        """设置当前span的状态，用于不抛出异常、以返回值表示失败的调用
+        Args:
+            status: ok、error或cancelled
+            message: 错误信息
+        """
+        span = _current_span.get()
+        if span is not None:
+            span.set_status(status, message)
+
+    @contextmanager
+    def start_trace(self, name: str, session_id: Optional[int] = None, **attributes) -> Iterator[Optional[Span]]:
+        """开始一个新的trace（总是作为根span，不继承外层的span）
+        Args:
+            name: 根span名称
+            session_id: 会话ID
+            **attributes: 附加属性
+        Yields:
+            Optional[Span]: 根span，未启用或未被抽样时为None
+        """
+        if not self.enabled or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            token = _current_span.set(None)
+            try:
+                yield None
+            finally:
+                self._reset(token)
+            return
+        span = Span(name, os.urandom(16).hex(), None, session_id, attributes)
+        with self._lock:
+            self._pending[span.trace_id] = []
+            while len(self._pending) > self.max_pending:
+                self._pending.pop(next(iter(self._pending)))
+        with self._run(span):
+            yield span
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """在当前trace中创建子span
+        Args:
+            name: span名称
+            **attributes: 附加属性
+        Yields:
+            Optional[Span]: 子span，不在trace中时为None
+        """
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        with self._run(Span(name, parent.trace_id, parent.span_id, parent.session_id, attributes)) as span:
+            yield span
+
+    def record_span(self, name: str, start_time: float, end_time: float, **attributes):
+        """记录一个已知起止时间的子span（如backoff的重试等待）
+        Args:
+            name: span名称
+            start_time: 开始时间（Unix时间戳，秒）
+            end_time: 结束时间（Unix时间戳，秒）
+            **attributes: 附加属性
+        """
+        parent = _current_span.get()
+        if parent is None:
+            return
+        span = Span(name, parent.trace_id, parent.span_id, parent.session_id, attributes, start_time)
+        span.end_time = end_time
+        self._finish(span)
+
+    @contextmanager
+    def _run(self, span: Span) -> Iterator[Span]:
+        """把span设为当前span，结束时记录耗时和状态"""
+        token = _current_span.set(span)
+        try:
+            yield span
+        except GeneratorExit:
+            # 流式生成器被提前关闭
+            span.set_status('cancelled')
+            raise
+        except BaseException as e:
+            if isinstance(e, (asyncio.CancelledError, KeyboardInterrupt, SystemExit)):
+                span.set_status('cancelled')
+            else:
+                span.set_status('error', str(e))
+            raise
+        finally:
+            span.end_time = time.time()
+            self._reset(token)
+            self._finish(span)
+
+    @staticmethod
+    def _reset(token: contextvars.Token):
+        """恢复进入span前的当前span
+        异步生成器被垃圾回收时可能在另一个上下文中关闭，此时无需恢复
+        """
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            pass
+
+    def _finish(self, span: Span):
+        """收集已结束的span；根span结束时导出整个trace，根span结束后才结束的span单独导出"""
+        with self._lock:
+            if span.parent_id is None:
+                spans = self._pending.pop(span.trace_id, [])
+                spans.append(span)
+            elif span.trace_id in self._pending:
+                self._pending[span.trace_id].append(span)
+                return
+            else:
+                spans = [span]
+        self._export(spans)
+
+    def _export(self, spans: List[Span]):
+        """调用所有导出器；导出过程中的数据库写入不再产生span"""
+        token = _current_span.set(None)
+        try:
+            for exporter in self._exporters:
+                try:
+                    exporter(spans)
+                except Exception as e:
+                    print(f"导出trace失败: {str(e)}")
+        finally:
+            _current_span.reset(token)
+
+
+def traced(name: str, record_args: Sequence[str] = ()) -> Callable:
+    """装饰器：在当前trace中把函数调用记录为一个span，支持普通函数、协程函数和异步生成器
+    Args:
+        name: span名称
+        record_args: 作为span属性记录的参数名
+    Returns:
+        Callable: 装饰器
+    """
+    def decorator(func: Callable) -> Callable:
+        signature = inspect.signature(func)
+
+        def attributes(args, kwargs) -> Dict[str, Any]:
+            if not record_args:
+                return {}
+            bound = signature.bind_partial(*args, **kwargs).arguments
+            return {arg: bound[arg] for arg in record_args if arg in bound}
+
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def agen_wrapper(*args, **kwargs):
+                with tracer.span(name, **attributes(args, kwargs)):
+                    agen = func(*args, **kwargs)
+                    try:
+                        async for item in agen:
+                            yield item
+                    finally:
+                        # 提前关闭时立即关闭被包装的生成器，使其中的清理（如中断HTTP流）随之执行
+                        await agen.aclose()
+            return agen_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(name, **attributes(args, kwargs)):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name, **attributes(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# 创建全局实例
+_tracing_config = Config().get_runtime_config().get('tracing', {}) or {}
+tracer = Tracer(
+    enabled=_tracing_config.get('enabled', True),
+    sample_rate=_tracing_config.get('sample_rate', 1.0)
+)
+if _tracing_config.get('otlp_file'):
+    tracer.add_exporter(OTLPFileExporter(_tracing_config['otlp_file']))
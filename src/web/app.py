@@ -2,18 +2,23 @@
 Web应用主模块
 提供Web界面和WebSocket支持
 """
-from fastapi import FastAPI, WebSocket, Request, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, WebSocket, Request, WebSocketDisconnect, Query
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
 import json
+import os
 import asyncio
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
+from src.config import Config
 from src.dialogue_manager import DialogueManager
 from src.database import db
+from src.agents import flush_decision_caches, get_decision_cache, sync_decision_cache
+from src.metrics import event_loop_lag_seconds, registry, websocket_connections
+from src.session_store import SessionCache, signer
 
 # 创建FastAPI应用
 app = FastAPI(title="双系统实验")
@@ -29,6 +34,33 @@ app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
 # 创建模板引擎
 templates = Jinja2Templates(directory=str(templates_dir))
 
+def get_runtime_config() -> Dict[str, Any]:
+    """读取当前的运行时配置
+    与DialogueManager一样每次使用时读取（配置文件未修改时使用缓存），修改配置文件后无需重启；
+    只有runtime.metrics在启动时读取一次
+    Returns:
+        Dict[str, Any]: runtime配置
+    """
+    return Config().get_runtime_config()
+
+def get_dispatcher_config() -> Dict[str, Any]:
+    """读取当前的调度Agent配置"""
+    return Config().get_agents_config().get('dispatcher', {}) or {}
+
+# 指标文件目录和事件循环延迟的采样间隔在启动时确定
+metrics_config = get_runtime_config().get('metrics', {}) or {}
+
+# 断开后保留的空闲会话，客户端带会话令牌重连时恢复
+sessions = SessionCache(DialogueManager)
+
+def apply_session_config():
+    """按当前配置更新空闲会话的数量上限和保留时间"""
+    sessions_config = get_runtime_config().get('sessions', {}) or {}
+    sessions.max_idle = sessions_config.get('max_idle', 256)
+    sessions.idle_ttl_seconds = sessions_config.get('idle_ttl_seconds', 1800)
+
+apply_session_config()
+
 class ConnectionManager:
     """WebSocket连接管理器"""
     def __init__(self):
@@ -39,25 +71,40 @@ class ConnectionManager:
         # 心跳检测定时器
         self.heartbeat_task = None
         
-    async def connect(self, websocket: WebSocket):
-        """建立新的WebSocket连接"""
+    async def connect(self, websocket: WebSocket, session_token: Optional[str] = None):
+        """建立新的WebSocket连接
+        Args:
+            websocket: WebSocket连接
+            session_token: 重连时客户端带回的会话令牌
+        """
         await websocket.accept()
         self.active_connections.append(websocket)
-        # 为每个连接创建一个对话管理器实例
-        self.managers[websocket] = DialogueManager()
+        websocket_connections.inc()
+        # 令牌有效时恢复原会话，否则新建会话；新建或从数据库恢复时需要读取数据库，放到线程池中执行
+        session_id = signer.verify(session_token)
+        apply_session_config()
+        dialogue_manager = await asyncio.to_thread(sessions.acquire, session_id)
+        self.managers[websocket] = dialogue_manager
+        await websocket.send_json({
+            "type": "session",
+            "session_id": dialogue_manager.session_id,
+            "session_token": signer.sign(dialogue_manager.session_id),
+            "resumed": session_id is not None and dialogue_manager.session_id == session_id,
+            "timestamp": datetime.now().isoformat()
+        })
         
         # 启动心跳检测
         if not self.heartbeat_task:
             self.heartbeat_task = asyncio.create_task(self._heartbeat())
     
-    def disconnect(self, websocket: WebSocket):
-        """断开WebSocket连接"""
+    async def disconnect(self, websocket: WebSocket):
+        """断开WebSocket连接；会话转为空闲，在空闲超时前可通过重连恢复"""
         if websocket in self.active_connections:
             self.active_connections.remove(websocket)
+            websocket_connections.dec()
         if websocket in self.managers:
-            # 结束对话会话
-            self.managers[websocket].end_session()
-            del self.managers[websocket]
+            # 归还时可能结束被淘汰的会话（读写数据库和会话状态存储），在线程池中执行
+            await asyncio.to_thread(sessions.release, self.managers.pop(websocket))
             
         # 如果没有活跃连接，停止心跳检测
         if not self.active_connections and self.heartbeat_task:
@@ -83,10 +130,37 @@ class ConnectionManager:
                 except Exception:
                     # 如果发送失败，说明连接已断开
                     await self.disconnect(connection)
+            # 结束空闲超时的会话
+            await asyncio.to_thread(sessions.sweep)
 
 # 创建连接管理器实例
 manager = ConnectionManager()
 
+async def probe_event_loop_lag(interval: float):
+    """定期采样事件循环延迟：预定interval秒后唤醒，实际唤醒时间晚了多久即为延迟
+    Args:
+        interval: 采样间隔（秒）
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, loop.time() - expected))
+
+@app.on_event("startup")
+async def start_metrics():
+    """多进程模式下开始定期写入本进程的指标文件，并开始采样事件循环延迟"""
+    registry.start()
+    interval = metrics_config.get('loop_lag_interval_seconds', 0.1)
+    if interval:
+        app.state.loop_lag_task = asyncio.create_task(probe_event_loop_lag(interval))
+
+@app.on_event("shutdown")
+async def flush_database():
+    """应用关闭时结束空闲会话，并写入队列中剩余的数据库写入"""
+    sessions.close()
+    db.flush()
+
 @app.get("/", response_class=HTMLResponse)
 async def chat_page(request: Request):
     """聊天页面"""
@@ -103,12 +177,133 @@ async def logs_page(request: Request):
         {"request": request}
     )
 
+async def send_response(websocket: WebSocket, response: Dict[str, Any]):
+    """根据响应类型发送不同格式的消息
+    Args:
+        websocket: WebSocket连接
+        response: 对话管理器返回的回复
+    """
+    if response["type"] == "message":
+        # 普通消息直接发送
+        reply = {
+            "type": "message",
+            "role": "assistant",
+            "content": response["content"],
+            "timestamp": datetime.now().isoformat()
+        }
+        await websocket.send_json(reply)
+        
+    elif response["type"] == "sys2":
+        # sys2的思考过程和回复分开发送
+        
+        # 先发送思考过程
+        if response.get("thinking"):
+            thinking = {
+                "type": "sys2-thinking",
+                "content": response["thinking"],
+                "timestamp": datetime.now().isoformat()
+            }
+            await websocket.send_json(thinking)
+        
+        # 再发送回复
+        reply = {
+            "type": "sys2-response",
+            "content": response["response"],
+            "timestamp": datetime.now().isoformat()
+        }
+        await websocket.send_json(reply)
+        
+    elif response["type"] == "error":
+        # 错误消息
+        error_message = {
+            "type": "error",
+            "content": response["content"],
+            "timestamp": datetime.now().isoformat()
+        }
+        await websocket.send_json(error_message)
+
+def is_cancel_frame(message: str) -> bool:
+    """判断客户端消息是否为停止生成当前回复的控制帧 {"type": "cancel"}
+    Args:
+        message: 客户端发送的文本
+    Returns:
+        bool: 是否为cancel帧
+    """
+    if not message.startswith('{'):
+        return False
+    try:
+        frame = json.loads(message)
+    except ValueError:
+        return False
+    return isinstance(frame, dict) and frame.get('type') == 'cancel'
+
+async def run_turn(websocket: WebSocket, dialogue_manager: DialogueManager, message: str):
+    """处理一轮对话并推送回复
+    作为单独的任务运行，接收循环可以在生成过程中取消它（cancel帧、新消息或断开连接），
+    取消沿对话管理器和Agent传递到模型调用，中断HTTP请求
+    Args:
+        websocket: WebSocket连接
+        dialogue_manager: 该连接的对话管理器
+        message: 用户输入
+    """
+    try:
+        if get_runtime_config().get('streaming', False):
+            # 流式模式：边生成边推送增量消息，最后发送完整回复
+            events = dialogue_manager.astream_input(message)
+            try:
+                async for event in events:
+                    if event["type"].endswith("-delta"):
+                        await websocket.send_json({
+                            "type": event["type"],
+                            "content": event["content"],
+                            "timestamp": datetime.now().isoformat()
+                        })
+                    else:
+                        await send_response(websocket, event)
+            finally:
+                # 在推送消息时被取消也立即关闭事件流，不等垃圾回收
+                await events.aclose()
+        else:
+            # 调用对话管理器处理输入（异步调用，不阻塞其他连接）
+            response = await dialogue_manager.aprocess_input(message)
+            await send_response(websocket, response)
+        
+    except Exception as e:
+        # 发送错误消息；连接已断开时忽略
+        try:
+            await websocket.send_json({
+                "type": "error",
+                "content": f"处理失败: {str(e)}",
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception:
+            pass
+
+async def cancel_turn(turn: Optional[asyncio.Task]) -> bool:
+    """取消正在进行的一轮对话，并等待取消完成（被取消的模型调用已写入日志）
+    Args:
+        turn: run_turn任务
+    Returns:
+        bool: 是否取消了一轮进行中的对话
+    """
+    if turn is None or turn.done():
+        return False
+    turn.cancel()
+    await asyncio.wait([turn])
+    return True
+
 @app.websocket("/ws/chat")
-async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket端点，处理实时聊天"""
+async def websocket_endpoint(websocket: WebSocket, session: Optional[str] = None):
+    """WebSocket端点，处理实时聊天
+    生成回复的过程中仍然接收客户端消息：cancel帧停止当前回复，新消息取代当前回复，断开连接时取消当前回复
+    Args:
+        websocket: WebSocket连接
+        session: 重连时带回的会话令牌（连接后服务端发送的session_token）
+    """
+    turn = None  # 正在进行的一轮对话
     try:
         # 连接WebSocket
-        await manager.connect(websocket)
+        await manager.connect(websocket, session)
         
         while True:
             # 接收消息
@@ -129,63 +324,29 @@ async def websocket_endpoint(websocket: WebSocket):
                     })
                     continue
                 
-                # 处理用户输入
-                try:
-                    # 调用对话管理器处理输入
-                    response = dialogue_manager.process_input(message)
-                    
-                    # 根据响应类型发送不同格式的消息
-                    if response["type"] == "message":
-                        # 普通消息直接发送
-                        reply = {
-                            "type": "message",
-                            "role": "assistant",
-                            "content": response["content"],
-                            "timestamp": datetime.now().isoformat()
-                        }
-                        await websocket.send_json(reply)
-                        
-                    elif response["type"] == "sys2":
-                        # sys2的思考过程和回复分开发送
-                        
-                        # 先发送思考过程
-                        if response.get("thinking"):
-                            thinking = {
-                                "type": "sys2-thinking",
-                                "content": response["thinking"],
-                                "timestamp": datetime.now().isoformat()
-                            }
-                            await websocket.send_json(thinking)
-                        
-                        # 再发送回复
-                        reply = {
-                            "type": "sys2-response",
-                            "content": response["response"],
-                            "timestamp": datetime.now().isoformat()
-                        }
-                        await websocket.send_json(reply)
-                        
-                    elif response["type"] == "error":
-                        # 错误消息
-                        error_message = {
-                            "type": "error",
-                            "content": response["content"],
+                if is_cancel_frame(message):
+                    # 客户端要求停止生成当前回复
+                    if await cancel_turn(turn):
+                        await websocket.send_json({
+                            "type": "cancelled",
+                            "reason": "cancel",
                             "timestamp": datetime.now().isoformat()
-                        }
-                        await websocket.send_json(error_message)
-                    
-                except Exception as e:
-                    # 发送错误消息
-                    error_message = {
-                        "type": "error",
-                        "content": f"处理失败: {str(e)}",
+                        })
+                    continue
+                
+                if await cancel_turn(turn):
+                    # 新消息取代正在生成的回复
+                    await websocket.send_json({
+                        "type": "cancelled",
+                        "reason": "superseded",
                         "timestamp": datetime.now().isoformat()
-                    }
-                    await websocket.send_json(error_message)
+                    })
+                
+                # 处理用户输入
+                turn = asyncio.create_task(run_turn(websocket, dialogue_manager, message))
                 
             except WebSocketDisconnect:
                 # 客户端断开连接
-                manager.disconnect(websocket)
                 break
                 
             except Exception as e:
@@ -205,48 +366,40 @@ async def websocket_endpoint(websocket: WebSocket):
     except Exception as e:
         print(f"WebSocket错误: {str(e)}")
     finally:
-        # 断开连接
-        manager.disconnect(websocket)
+        # 先取消正在进行的回复（不再消耗token），再断开连接并把对话管理器交回会话缓存
+        await cancel_turn(turn)
+        await manager.disconnect(websocket)
 
 @app.get("/api/logs")
 async def get_logs(
     start_time: Optional[str] = None,
     end_time: Optional[str] = None,
-    search_text: Optional[str] = None
+    search_text: Optional[str] = None,
+    cursor: Optional[str] = None,
+    page_size: int = Query(50, ge=1, le=1000),
+    fields: Optional[str] = None
 ) -> Dict[str, Any]:
-    """获取系统日志
+    """分页获取系统日志
     Args:
         start_time: 开始时间（ISO格式）
         end_time: 结束时间（ISO格式）
-        search_text: 搜索文本
+        search_text: 搜索文本，3个字符以上时使用全文索引并按相关度排序
+        cursor: 上一页返回的next_cursor
+        page_size: 每页条数
+        fields: 逗号分隔的返回字段，例如"log_id,timestamp,output_preview"；不指定时返回全部字段
     Returns:
-        Dict: 日志数据
+        Dict: 日志数据和下一页游标
     """
     try:
-        # 从数据库查询日志
-        logs = db.get_logs(start_time, end_time, search_text)
-        
-        # 格式化日志数据
-        formatted_logs = []
-        for log in logs:
-            formatted_logs.append({
-                "session_id": log["session_id"],
-                "timestamp": log["timestamp"],  
-                "agent_name": log["agent_name"],
-                "input_text": log["input_text"],
-                "output_text": log["output_text"],
-                "response_time_ms": log["response_time_ms"],
-                "input_tokens": log["input_tokens"],
-                "output_tokens": log["output_tokens"],
-                "model_name": log["model_name"],
-                "status": log["status"],
-                "error_message": log["error_message"],
-                "session_start_time": log["session_start_time"]
-            })
-            
+        field_list = [name.strip() for name in fields.split(',') if name.strip()] if fields else None
+        # 在线程池中查询日志，不阻塞事件循环
+        page = await asyncio.to_thread(
+            db.get_logs_page, start_time, end_time, search_text, cursor, page_size, field_list
+        )
         return {
             "status": "success",
-            "data": formatted_logs
+            "data": page["logs"],
+            "next_cursor": page["next_cursor"]
         }
         
     except Exception as e:
@@ -254,3 +407,177 @@ async def get_logs(
             "status": "error",
             "message": str(e)
         }
+
+@app.get("/api/logs/{log_id}")
+async def get_log_detail(log_id: int) -> Dict[str, Any]:
+    """获取单条日志的完整内容
+    Args:
+        log_id: 日志ID
+    Returns:
+        Dict: 日志详情
+    """
+    try:
+        log = await asyncio.to_thread(db.get_log, log_id)
+        if log is None:
+            return {
+                "status": "error",
+                "message": f"日志不存在: {log_id}"
+            }
+        return {
+            "status": "success",
+            "data": log
+        }
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+
+@app.get("/api/traces/{trace_id}")
+async def get_trace(trace_id: str) -> Dict[str, Any]:
+    """获取一轮对话的调用链路，用于日志详情中的瀑布图
+    Args:
+        trace_id: trace ID（日志的trace_id字段）
+    Returns:
+        Dict: 按开始时间排序的span列表
+    """
+    try:
+        spans = await asyncio.to_thread(db.get_trace, trace_id)
+        if not spans:
+            return {
+                "status": "error",
+                "message": f"trace不存在: {trace_id}"
+            }
+        return {
+            "status": "success",
+            "data": spans
+        }
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+
+@app.get("/api/speculation/stats")
+async def get_speculation_stats() -> Dict[str, Any]:
+    """获取推测调度的命中率和浪费的token
+    Returns:
+        Dict: 统计数据
+    """
+    try:
+        return {
+            "status": "success",
+            "data": await asyncio.to_thread(db.get_speculation_stats)
+        }
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics() -> PlainTextResponse:
+    """以Prometheus文本格式导出监控指标
+    多进程模式下需要读取并合并各进程的指标文件，放到线程池中执行，不阻塞事件循环
+    """
+    return PlainTextResponse(
+        await asyncio.to_thread(registry.render),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+@app.get("/api/metrics")
+async def get_metrics(
+    granularity: str = "minute",
+    start_time: Optional[str] = None,
+    end_time: Optional[str] = None,
+    agent_name: Optional[str] = None,
+    model_name: Optional[str] = None
+) -> Dict[str, Any]:
+    """获取按Agent和模型分组的性能指标（来自汇总表，不扫描日志）
+    Args:
+        granularity: 时间粒度（minute/hour/day）
+        start_time: 开始时间（ISO格式），不指定时返回最近一段时间
+        end_time: 结束时间（ISO格式）
+        agent_name: 只统计该Agent
+        model_name: 只统计该模型
+    Returns:
+        Dict: 各时间桶的调用次数、错误率、token吞吐量和p50/p95/p99响应时间，以及整个时间范围的汇总
+    """
+    try:
+        return {
+            "status": "success",
+            "data": await asyncio.to_thread(
+                db.get_metrics, granularity, start_time, end_time, agent_name, model_name
+            )
+        }
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+
+@app.get("/api/routing/stats")
+async def get_routing_stats() -> Dict[str, Any]:
+    """获取本地/远程路由的来源分布和一致率
+    Returns:
+        Dict: 统计数据
+    """
+    try:
+        return {
+            "status": "success",
+            "data": await asyncio.to_thread(db.get_routing_stats)
+        }
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+
+# 未启用调度决策缓存时管理接口的返回值
+DECISION_CACHE_DISABLED = {
+    "status": "disabled",
+    "message": "调度决策缓存未启用（agents.dispatcher.decision_cache.enabled）"
+}
+
+@app.get("/api/admin/routing-cache")
+async def get_routing_cache_stats() -> Dict[str, Any]:
+    """获取调度决策缓存的统计信息
+    缓存在每个worker进程内，统计的只是处理本次请求的进程（data.pid）
+    Returns:
+        Dict: 缓存大小、命中次数和命中率；未启用缓存时status为disabled
+    """
+    cache_config = get_dispatcher_config().get('decision_cache') or {}
+    if not cache_config.get('enabled', False):
+        return DECISION_CACHE_DISABLED
+    cache = get_decision_cache(cache_config)
+    sync_decision_cache()
+    return {
+        "status": "success",
+        "data": {**cache.stats(), "scope": "process", "pid": os.getpid()}
+    }
+
+@app.get("/api/admin/sessions")
+async def get_session_stats() -> Dict[str, Any]:
+    """获取活跃/空闲会话数和断线重连的恢复次数
+    Returns:
+        Dict: 统计数据
+    """
+    return {
+        "status": "success",
+        "data": sessions.stats()
+    }
+
+@app.post("/api/admin/routing-cache/flush")
+async def flush_routing_cache() -> Dict[str, Any]:
+    """清空所有worker的调度决策缓存
+    本进程立即清空，其他worker通过数据目录中的清空标记文件在下次查询缓存前清空
+    Returns:
+        Dict: 本进程清除的条目数；未启用缓存时status为disabled
+    """
+    if not (get_dispatcher_config().get('decision_cache') or {}).get('enabled', False):
+        return DECISION_CACHE_DISABLED
+    flushed = await asyncio.to_thread(flush_decision_caches)
+    return {
+        "status": "success",
+        "data": {"flushed": flushed, "pid": os.getpid(), "broadcast": True}
+    }